@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+""" Compares the frame table reader of read_dicom (one tag path plan per
+series, float64 columns) against the original per-frame reader, which built
+an ImageFrame with Decimal values for every Per-Frame Functional Group. The
+input is a synthetic enhanced multi-frame DICOM with the Philips private
+tags, written to a temporary file and read back with pydicom, so the lazy
+element conversion of pydicom is part of both timings. The two readers are
+also checked to give the same values.
+
+Run from the repository root:
+    python -m benchmarks.dicom_frames --slices 60 --dynamics 400
+"""
+from __future__ import division, print_function
+import argparse
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+try:
+    import dicom
+    from dicom.dataset import Dataset, FileDataset
+    from dicom.sequence import Sequence
+except ImportError:
+    import pydicom as dicom
+    from pydicom.dataset import Dataset, FileDataset
+    from pydicom.sequence import Sequence
+
+from project.DICOMFile import DICOMFile, ImageFrame, MRFrame
+from project.read_dicom import _read_frame_table
+
+
+def make_functional_groups(nr_slices=30, nr_dynamics=1, res=(64, 64)):
+    """ Returns a dataset with the Per-Frame and Shared Functional Groups
+        Sequences of an enhanced Philips fMRI series """
+    ds = Dataset()
+    shared = Dataset()
+    shared.add_new(0x00189125, 'SQ', Sequence([_make_item(
+        [(0x00180093, 'DS', '100')])]))
+    ds.add_new(0x52009229, 'SQ', Sequence([shared]))
+    fgs = []
+    for dyn in range(nr_dynamics):
+        for sl in range(nr_slices):
+            fg = Dataset()
+            fg.add_new(0x2005140f, 'SQ', Sequence([_make_item([
+                (0x2001100a, 'IS', str(sl + 1)),
+                (0x00180086, 'IS', '1'),
+                (0x00200100, 'IS', str(dyn + 1)),
+                (0x20011008, 'IS', '1'),
+                (0x20051412, 'IS', '1'),
+                (0x20051413, 'IS', '1'),
+                (0x20051011, 'CS', 'M'),
+                (0x2005106e, 'CS', 'FFE'),
+                (0x2005100e, 'FL', 0.0123),
+                (0x20051004, 'CS', 'NONE'),
+                (0x20051063, 'SS', 0),
+                (0x20011007, 'CS', 'U'),
+                (0x00180081, 'DS', '30'),
+                (0x200510a0, 'FL', dyn * 2.0),
+                (0x00181060, 'DS', '0'),
+                (0x20011003, 'FL', 0.0),
+                (0x00180083, 'DS', '1'),
+                (0x00181314, 'DS', '90'),
+                (0x00181088, 'IS', '0'),
+                (0x00181081, 'IS', '0'),
+                (0x00181082, 'IS', '0'),
+                (0x00180091, 'IS', '0'),
+                (0x00180082, 'DS', '0'),
+                (0x00189147, 'CS', 'FRACTIONAL'),
+                (0x200510b1, 'FL', 0.0),
+                (0x200510b2, 'FL', 0.0),
+                (0x200510b0, 'FL', 0.0),
+            ])]))
+            fg.add_new(0x00289145, 'SQ', Sequence([_make_item([
+                (0x00281052, 'DS', '0'),
+                (0x00281053, 'DS', '1.53455')])]))
+            fg.add_new(0x00289132, 'SQ', Sequence([_make_item([
+                (0x00281050, 'DS', '1000'),
+                (0x00281051, 'DS', '2000')])]))
+            fg.add_new(0x00289110, 'SQ', Sequence([_make_item([
+                (0x00180050, 'DS', '3'),
+                (0x00280030, 'DS', ['2.5', '2.5'])])]))
+            fg.add_new(0x00189226, 'SQ', Sequence([_make_item([
+                (0x00089209, 'CS', 'T2_STAR')])]))
+            fg.add_new(0x00209111, 'SQ', Sequence([_make_item([
+                (0x00209056, 'SH', '1'),
+                (0x00209128, 'UL', dyn + 1)])]))
+            fg.add_new(0x00209113, 'SQ', Sequence([_make_item([
+                (0x00200032, 'DS', ['-80.1', '-95.3', str(sl * 3.3 - 40)])
+                ])]))
+            fg.add_new(0x00209116, 'SQ', Sequence([_make_item([
+                (0x00200037, 'DS', ['0.99', '0', '0.1', '0', '1', '0'])])]))
+            fgs.append(fg)
+    ds.add_new(0x52009230, 'SQ', Sequence(fgs))
+    return ds
+
+def make_dicom_file(nr_slices, nr_dynamics, res=(64, 64)):
+    """ Returns the DICOMFile attributes the frame readers use """
+    dcm = DICOMFile()
+    dcm.px_size = 16
+    dcm.res_x, dcm.res_y = res
+    dcm.space_bt_slices = Decimal('3.3')
+    mr = MRFrame()
+    mr.ang_ap, mr.ang_fh, mr.ang_rl = Decimal('5.5'), Decimal(0), Decimal(2)
+    mr.view_axis = 'FH'
+    dcm.mr_stack = [mr]
+    dcm.num_stacks = nr_dynamics
+    return dcm
+
+def read_table(ds, dcm):
+    _read_frame_table(dcm, ds.PerFrameFunctionalGroupsSequence,
+        ds.SharedFunctionalGroupsSequence[0])
+    return dcm.frames
+
+def read_legacy(ds, dcm):
+    dcm.stacks = [[] for i in range(dcm.num_stacks)]
+    for fg in ds.PerFrameFunctionalGroupsSequence:
+        _read_functional_group(dcm, fg, ds.SharedFunctionalGroupsSequence)
+    return [frame for stack in dcm.stacks for frame in stack]
+
+def check_equal(frames, legacy):
+    """ Raises AssertionError when the readers disagree """
+    assert len(frames) == len(legacy)
+    for name in frames.dtype.names:
+        if name == 'frame_index':
+            continue
+        column = frames[name]
+        expected = [getattr(frame, name) for frame in legacy]
+        if column.dtype == object:
+            assert list(column) == expected, name
+        else:
+            expected = np.array(expected, np.float64)
+            assert np.allclose(column, expected, rtol=1e-12, atol=0), name
+
+def run(nr_slices, nr_dynamics, repeat=3):
+    tmp_dir = tempfile.mkdtemp(prefix='raw2nii_bench_')
+    try:
+        fname = os.path.join(tmp_dir, 'frames.dcm')
+        _write_dataset(fname, make_functional_groups(nr_slices, nr_dynamics))
+        dcm = make_dicom_file(nr_slices, nr_dynamics)
+        check_equal(read_table(dicom.read_file(fname, force=True), dcm),
+            read_legacy(dicom.read_file(fname, force=True), dcm))
+        results = {}
+        for name, func in (('legacy', read_legacy), ('table', read_table)):
+            seconds = []
+            for i in range(repeat):
+                #A fresh dataset, the elements are converted on first access
+                ds = dicom.read_file(fname, force=True)
+                t0 = time.time()
+                func(ds, dcm)
+                seconds.append(time.time() - t0)
+            results[name] = min(seconds)
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slices', type=int, default=40)
+    parser.add_argument('--dynamics', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args()
+    nr_frames = options.slices * options.dynamics
+    results = run(options.slices, options.dynamics, options.repeat)
+    for name in ('legacy', 'table'):
+        print('{0:8s} {1:8.3f} s {2:10.0f} frames/s'.format(name,
+            results[name], nr_frames / results[name]))
+    print('speed-up {0:.1f}x'.format(results['legacy'] / results['table']))
+
+def _write_dataset(fname, ds):
+    """ Writes ds as an explicit VR little endian DICOM file """
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4.1'
+    file_meta.MediaStorageSOPInstanceUID = '1.2.3.4'
+    file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    file_ds = FileDataset(fname, ds, file_meta=file_meta,
+        preamble=b'\0' * 128)
+    file_ds.is_little_endian = True
+    file_ds.is_implicit_VR = False
+    dicom.write_file(fname, file_ds)
+
+def _make_item(elements):
+    item = Dataset()
+    for tag, vr, value in elements:
+        item.add_new(tag, vr, value)
+    return item
+
+#The per-frame reader read_dicom used before the frame table, kept unchanged
+#as the reference
+def _read_functional_group(dcm, fg, shared_fgs):
+    frame = ImageFrame()
+    private_tag = fg[0x2005140f][0]
+    frame.slice_num = np.int(private_tag[0x2001100a].value)
+    frame.echo_num = np.int(private_tag[0x00180086].value)
+    frame.dynamic = np.int(private_tag[0x00200100].value)
+    frame.cardiac_phase = np.int(private_tag[0x20011008].value)
+    frame.bvalue = np.int(private_tag[0x20051412].value)
+    frame.grad_orient = np.int(private_tag[0x20051413].value)
+    label_type = private_tag.get(0x20051429)
+    if label_type:
+        frame.label_type = label_type.value
+    else:
+        frame.label_type = '-'
+    frame.img_type = private_tag[0x20051011].value
+    frame.img_seq = private_tag[0x2005106e].value
+    frame.px_size = dcm.px_size
+    if hasattr(fg, 'MRFOVGeometrySequence'):
+        frame.scan_prct = Decimal(fg.MRFOVGeometrySequence[0].PercentSampling)
+    else:
+        frame.scan_prct = Decimal(
+            shared_fgs[0].MRFOVGeometrySequence[0].PercentSampling)
+    frame.res_x = dcm.res_x
+    frame.res_y = dcm.res_y
+    pvts = fg.PixelValueTransformationSequence[0]
+    frame.rescale_interc = Decimal(pvts.RescaleIntercept)
+    frame.rescale_slope = Decimal(pvts.RescaleSlope)
+    frame.scale_slope = Decimal(private_tag[0x2005100e].value)
+    fvls = fg.FrameVOILUTSequence[0]
+    frame.window_center = np.int(fvls.WindowCenter)
+    frame.window_width = np.int(fvls.WindowWidth)
+    pms = fg.PixelMeasuresSequence[0]
+    if hasattr(pms, 'SliceThickness'):
+        frame.sl_thickness = Decimal(pms.SliceThickness)
+    else:
+        frame.sl_thickness = Decimal(private_tag.SliceThickness)
+    frame.sl_gap = dcm.space_bt_slices - frame.sl_thickness
+    frame.dsply_orient = private_tag[0x20051004].value
+    frame.fmri_stat_indication = np.int(private_tag[0x20051063].value)
+    frame.img_type_ed_es = private_tag[0x20011007].value
+    frame.px_spacing = np.array(pms.PixelSpacing, Decimal)
+    frame.echo_t = Decimal(private_tag[0x00180081].value)
+    frame.dyn_scan_begin_t = Decimal(private_tag[0x200510a0].value)
+    trigger_t = private_tag.get(0x00181060)
+    if trigger_t:
+        frame.trigger_t = Decimal(trigger_t.value)
+    else:
+        frame.trigger_t = 0.0
+    frame.diff_b_factor = Decimal(private_tag[0x20011003].value)
+    frame.no_avgs = np.int(private_tag[0x00180083].value)
+    frame.img_flip_ang = Decimal(private_tag[0x00181314].value)
+    frame.cardiac_freq = np.int(private_tag[0x00181088].value)
+    frame.min_rr_interval = np.int(private_tag[0x00181081].value)
+    frame.max_rr_interval = np.int(private_tag[0x00181082].value)
+    frame.turbo_factor = np.int(private_tag[0x00180091].value)
+    frame.inversion_delay = Decimal(private_tag[0x00180082].value)
+    frame.diff_anisotropy_type = private_tag[0x00189147].value
+    frame.contrast_type = fg.MRImageFrameTypeSequence[0].AcquisitionContrast
+    frame.diff_ap = Decimal(private_tag[0x200510b1].value)
+    frame.diff_fh = Decimal(private_tag[0x200510b2].value)
+    frame.diff_rl = Decimal(private_tag[0x200510b0].value)
+    fcs = fg.FrameContentSequence[0]
+    frame.mr_stack_id = np.int(fcs[0x00209056].value) - 1
+    mr_frame = dcm.mr_stack[frame.mr_stack_id]
+    frame.ang_ap = mr_frame.ang_ap
+    frame.ang_fh = mr_frame.ang_fh
+    frame.ang_rl = mr_frame.ang_rl
+    img_pos = np.array(fg.PlanePositionSequence[0].ImagePositionPatient,
+        Decimal)
+    img_orient = np.array(fg.PlaneOrientationSequence[0]
+        .ImageOrientationPatient, Decimal)
+    frame.offcenter_ap = img_pos[1] + (
+        (dcm.res_y * frame.px_spacing[0] * img_orient[1]) +
+        (dcm.res_x * frame.px_spacing[1] * img_orient[4])) / 2
+    frame.offcenter_fh = img_pos[2] + (
+        (dcm.res_y * frame.px_spacing[0] * img_orient[2]) +
+        (dcm.res_x * frame.px_spacing[1] * img_orient[5])) / 2
+    frame.offcenter_rl = img_pos[0] + (
+        (dcm.res_y * frame.px_spacing[0] * img_orient[0]) +
+        (dcm.res_x * frame.px_spacing[1] * img_orient[3])) / 2
+    frame.slice_orient = mr_frame.view_axis
+    frame.temporal_pos_index = np.int(fcs[0x00209128].value) - 1
+    dcm.stacks[frame.temporal_pos_index].append(frame)
+
+if __name__ == '__main__':
+    main()
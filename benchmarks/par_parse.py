@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+""" Measures the slice table parse throughput (lines/s) of the bulk PAR
+parser in read_par against np.loadtxt.
+
+Run from the repository root:
+    python -m benchmarks.par_parse --lines 100000
+"""
+from __future__ import division, print_function
+import argparse
+import numpy as np
+import time
+from StringIO import StringIO
+
+from project import d2p_defines
+from project.PARFile import PARFile
+from project.read_par import _parse_definition_V4X, _read_slice_table_V4X
+
+
+def make_slice_lines(par, nr_lines):
+    """ Returns the text of nr_lines random slice lines in the par layout """
+    rng = np.random.RandomState(0)
+    columns = []
+    fmt = []
+    for name, type_code in par.fields:
+        if type_code is np.int64:
+            columns.append(rng.randint(0, 1000, nr_lines))
+            fmt.append('%d')
+        else:
+            columns.append(rng.uniform(-100, 100, nr_lines))
+            fmt.append('%.3f')
+    out = StringIO()
+    np.savetxt(out, np.column_stack(columns), fmt=fmt)
+    return out.getvalue()
+
+def parse_loadtxt(par, text):
+    return np.loadtxt(StringIO(text), dtype=par.fields, ndmin=1).view(
+        np.recarray)
+
+def parse_bulk(par, text):
+    return _read_slice_table_V4X(par, StringIO(text))
+
+def run(nr_lines=100000, repeat=3):
+    """ Returns a dict with the best time and lines/s of each parser """
+    par = PARFile()
+    _parse_definition_V4X(par, StringIO(d2p_defines.PAR_MIDDLE_SECTION))
+    text = make_slice_lines(par, nr_lines)
+    results = {}
+    for name, parser in (('loadtxt', parse_loadtxt), ('bulk', parse_bulk)):
+        times = []
+        for i in range(repeat):
+            t0 = time.time()
+            parser(par, text)
+            times.append(time.time() - t0)
+        best = min(times)
+        results[name] = {'seconds': best, 'lines_per_s': nr_lines / best}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args()
+    results = run(options.lines, options.repeat)
+    for name in ('loadtxt', 'bulk'):
+        r = results[name]
+        print('{0:8s} {1:8.3f} s {2:12.0f} lines/s'.format(name, r['seconds'],
+            r['lines_per_s']))
+    print('speedup  {0:8.1f}x'.format(results['loadtxt']['seconds'] /
+        results['bulk']['seconds']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+""" Compares the memory-mapped REC gather of read_rec against the original
+per-slice seek + array.fromfile loop on a synthetic 4D dataset.
+
+Run from the repository root:
+    python -m benchmarks.rec_read --dim 80 80 40 --dynamics 300
+"""
+from __future__ import division, print_function
+import argparse
+import array
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+from project.PARFile import PARFile
+from project.read_rec import REC_DTYPE_TABLE, open_rec, read_rec_slices
+
+
+def make_synthetic_rec(dirname, dim, nr_dyn, bit):
+    """ Writes a REC file with volumes stored in slice order (the slowest
+        case for the per-slice loop) and returns a matching PARFile """
+    nx, ny, nz = dim
+    par = PARFile()
+    par.rec_fname = os.path.join(dirname, 'synthetic.REC')
+    par.bit = bit
+    par.dim = np.array(dim)
+    nr_images = nz * nr_dyn
+    par.slices = np.recarray((nr_images,), dtype=[
+        ('slice_number', np.int64), ('dynamic_scan_number', np.int64),
+        ('index_in_rec_file', np.int64), ('recon_resolution_x', np.int64),
+        ('recon_resolution_y', np.int64)])
+    par.slices.slice_number = np.repeat(np.arange(1, nz + 1), nr_dyn)
+    par.slices.dynamic_scan_number = np.tile(np.arange(1, nr_dyn + 1), nz)
+    par.slices.index_in_rec_file = np.arange(nr_images)
+    par.slices.recon_resolution_x = nx
+    par.slices.recon_resolution_y = ny
+    par.slices_sorted = par.slices[np.lexsort((par.slices.slice_number,
+        par.slices.dynamic_scan_number))]
+    dtype = REC_DTYPE_TABLE[bit]
+    rng = np.random.RandomState(0)
+    with open(par.rec_fname, 'wb') as f:
+        for i in range(nr_dyn):
+            rng.randint(0, 2 ** (bit - 2), nz * nx * ny).astype(dtype).tofile(f)
+    return par
+
+def read_loop(par):
+    """ The original reader: one seek and one array.fromfile per slice """
+    par_dt = {8: 'b', 16: 'h', 32: 'i'}[par.bit]
+    nbytes = par.bit // 8
+    total = 0
+    with open(par.rec_fname, 'rb') as rec:
+        for sl in par.slices_sorted:
+            rec.seek(sl.index_in_rec_file * sl.recon_resolution_x *
+                sl.recon_resolution_y * nbytes)
+            sl_arr = array.array(par_dt)
+            sl_arr.fromfile(rec, sl.recon_resolution_x *
+                sl.recon_resolution_y)
+            sl_data = np.reshape(sl_arr, (sl.recon_resolution_x,
+                sl.recon_resolution_y)).T
+            total += sl_data[0, 0]
+    return total
+
+def read_gather(par):
+    """ The memory-mapped reader: one gather per volume """
+    rec = open_rec(par)
+    nslice = par.dim[2]
+    total = 0
+    for start in range(0, par.slices_sorted.shape[0], nslice):
+        data = read_rec_slices(rec, par.slices_sorted[start:start + nslice])
+        total += data[:, 0, 0].sum()
+    return total
+
+def run(dim=(80, 80, 40), nr_dyn=300, bit=16, repeat=3):
+    """ Returns a dict with the best time and throughput of each reader """
+    tmpdir = tempfile.mkdtemp(prefix='raw2nii_bench_')
+    try:
+        par = make_synthetic_rec(tmpdir, dim, nr_dyn, bit)
+        nbytes = os.path.getsize(par.rec_fname)
+        results = {}
+        for name, reader in (('loop', read_loop), ('gather', read_gather)):
+            times = []
+            for i in range(repeat):
+                t0 = time.time()
+                reader(par)
+                times.append(time.time() - t0)
+            best = min(times)
+            results[name] = {'seconds': best, 'mb_per_s': nbytes / best / 2**20,
+                'slices_per_s': par.slices.shape[0] / best}
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dim', type=int, nargs=3, default=[80, 80, 40])
+    parser.add_argument('--dynamics', type=int, default=300)
+    parser.add_argument('--bit', type=int, choices=(8, 16, 32), default=16)
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args()
+    results = run(options.dim, options.dynamics, options.bit, options.repeat)
+    for name in ('loop', 'gather'):
+        r = results[name]
+        print('{0:8s} {1:8.3f} s {2:9.1f} MB/s {3:10.0f} slices/s'.format(
+            name, r['seconds'], r['mb_per_s'], r['slices_per_s']))
+    print('speedup  {0:8.1f}x'.format(results['loop']['seconds'] /
+        results['gather']['seconds']))
+
+if __name__ == '__main__':
+    main()
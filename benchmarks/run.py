@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+""" Benchmark suite on synthetic PAR/REC data: PAR parsing, NIfTI header
+creation and packing, REC gathers, NIfTI and .nii.gz writing and DICOM ->
+PAR writing. Every benchmark runs in its own process, so its peak RSS is its
+own, and reports the best time of --repeat runs and its throughput.
+
+Results can be saved as a baseline and later runs compared against it. The
+suite exits with 1 when a benchmark got slower than the baseline by more
+than --threshold (a fraction, 0.2 = 20%).
+
+Run from the repository root:
+    python -m benchmarks.run --size medium --save baseline.json
+    python -m benchmarks.run --size medium --compare baseline.json
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import make_dicom, make_parrec
+
+
+#Maps size name -> make_parrec / make_dicom keyword arguments
+SIZES = {
+    'small': dict(res=(64, 64), nr_slices=30, nr_dynamics=20),
+    'medium': dict(res=(96, 96), nr_slices=40, nr_dynamics=100),
+    'large': dict(res=(128, 128), nr_slices=40, nr_dynamics=400),
+}
+BENCHMARKS = ('parse', 'header', 'gather', 'write', 'write_gz', 'dicom2par')
+#ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+def bench_parse(data_dir, repeat):
+    from project.read_par import read_par
+    par_fname, rec_fname = _get_fnames(data_dir)
+    seconds = _best_time(lambda: read_par(par_fname, rec_fname), repeat)
+    par = read_par(par_fname, rec_fname)
+    return seconds, par.slices.shape[0], 'slices'
+
+def bench_header(data_dir, repeat):
+    import io
+    from project.nii import _create_nii_header, _write_nii_header
+    from project.read_par import read_par
+    par = read_par(*_get_fnames(data_dir))
+    nr_calls = 100
+    def run():
+        for i in range(nr_calls):
+            _write_nii_header(_create_nii_header(par), io.BytesIO())
+    return _best_time(run, repeat), nr_calls, 'headers'
+
+def bench_gather(data_dir, repeat):
+    from project.read_par import read_par
+    from project.read_rec import open_rec, read_rec_slices
+    par = read_par(*_get_fnames(data_dir))
+    nslice = par.dim[2]
+    slices_sorted = par.slices_sorted
+    def run():
+        rec = open_rec(par)
+        for start in range(0, slices_sorted.shape[0], nslice):
+            read_rec_slices(rec, slices_sorted[start:start + nslice])
+    return (_best_time(run, repeat), os.path.getsize(par.rec_fname) / 2 ** 20,
+        'MB')
+
+def bench_write(data_dir, repeat):
+    from project.nii import write_nii_from_par
+    from project.read_par import read_par
+    par_fname, rec_fname = _get_fnames(data_dir)
+    nii_fname = os.path.join(data_dir, 'bench.nii')
+    seconds = []
+    for i in range(repeat):
+        #The DTI reordering changes the par, so every run gets a fresh one
+        par = read_par(par_fname, rec_fname)
+        t0 = time.time()
+        write_nii_from_par(nii_fname, par)
+        seconds.append(time.time() - t0)
+    return min(seconds), os.path.getsize(nii_fname) / 2 ** 20, 'MB'
+
+def bench_write_gz(data_dir, repeat):
+    from project.nii import write_nii_from_par
+    from project.read_par import read_par
+    par_fname, rec_fname = _get_fnames(data_dir)
+    nii_fname = os.path.join(data_dir, 'bench.nii.gz')
+    seconds = []
+    for i in range(repeat):
+        par = read_par(par_fname, rec_fname)
+        t0 = time.time()
+        write_nii_from_par(nii_fname, par)
+        seconds.append(time.time() - t0)
+    #Throughput of the uncompressed data
+    return min(seconds), os.path.getsize(rec_fname) / 2 ** 20, 'MB'
+
+def bench_dicom2par(data_dir, repeat):
+    from project.write_parrec_from_dicom import write_parrec_from_dicom
+    with open(os.path.join(data_dir, 'params.json')) as f:
+        params = json.load(f)
+    dcm = make_dicom(**params)
+    par_fname = os.path.join(data_dir, 'bench_dcm.PAR')
+    rec_fname = os.path.join(data_dir, 'bench_dcm.REC')
+    seconds = _best_time(lambda: write_parrec_from_dicom(par_fname,
+        rec_fname, dcm), repeat)
+    return seconds, len(dcm.frames), 'frames'
+
+def run_child(name, data_dir, repeat):
+    """ Runs one benchmark in this process and returns its result dict """
+    logging.getLogger('raw2nii').setLevel(logging.ERROR)
+    seconds, amount, unit = globals()['bench_' + name](data_dir, repeat)
+    return {
+        'seconds': seconds,
+        'amount': amount,
+        'unit': unit,
+        'throughput': amount / seconds if seconds > 0 else None,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss *
+            _MAXRSS_UNIT,
+    }
+
+def run(names, params, repeat=3, data_dir=None):
+    """ Generates the data and runs every benchmark in a new process """
+    keep = data_dir is not None
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='raw2nii_bench_')
+    elif not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    try:
+        par_fname, rec_fname = _get_fnames(data_dir)
+        params_fname = os.path.join(data_dir, 'params.json')
+        #Data kept in --data-dir is reused when it was made with the same
+        #parameters
+        stored = None
+        if os.path.exists(params_fname) and os.path.exists(rec_fname):
+            with open(params_fname) as f:
+                stored = json.load(f)
+        if stored != json.loads(json.dumps(params)):
+            make_parrec(par_fname, **params)
+            with open(params_fname, 'w') as f:
+                json.dump(params, f)
+        results = {}
+        for name in names:
+            out = subprocess.check_output([sys.executable, '-m',
+                'benchmarks.run', '--child', name, '--data-dir', data_dir,
+                '--repeat', str(repeat)])
+            results[name] = json.loads(out.decode('utf-8').splitlines()[-1])
+        return results
+    finally:
+        if not keep:
+            shutil.rmtree(data_dir)
+
+def compare(results, baseline, threshold):
+    """ Returns the names of the benchmarks that regressed by more than
+        threshold, and prints the comparison """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        change = result['seconds'] / baseline[name]['seconds'] - 1
+        failed = change > threshold
+        if failed:
+            regressions.append(name)
+        print('{0:10s} {1:8.4f} s -> {2:8.4f} s {3:+7.1%} {4}'.format(name,
+            baseline[name]['seconds'], result['seconds'], change,
+            'FAIL' if failed else 'ok'))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--bench', choices=BENCHMARKS, action='append',
+        help='benchmark to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data-dir', default=None,
+        help='keep the generated data in this directory and reuse it')
+    parser.add_argument('--save', metavar='FILE', default=None,
+        help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', default=None,
+        help='compare against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='allowed slow down against the baseline (default: 0.2)')
+    parser.add_argument('--child', choices=BENCHMARKS,
+        help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.child:
+        print(json.dumps(run_child(options.child, options.data_dir,
+            options.repeat)))
+        return 0
+    params = SIZES[options.size]
+    results = run(options.bench or BENCHMARKS, params, options.repeat,
+        options.data_dir)
+    for name in options.bench or BENCHMARKS:
+        r = results[name]
+        print('{0:10s} {1:8.4f} s {2:12.1f} {3}/s {4:8.1f} MB peak RSS'.format(
+            name, r['seconds'], r['throughput'], r['unit'],
+            r['peak_rss'] / 2 ** 20))
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'size': options.size, 'results': results}, f,
+                indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if baseline['size'] != options.size:
+            print('Baseline was run with size {0}'.format(baseline['size']))
+            return 1
+        if compare(results, baseline['results'], options.threshold):
+            return 1
+    return 0
+
+def _get_fnames(data_dir):
+    return (os.path.join(data_dir, 'bench.PAR'),
+        os.path.join(data_dir, 'bench.REC'))
+
+def _best_time(func, repeat):
+    seconds = []
+    for i in range(repeat):
+        t0 = time.time()
+        func()
+        seconds.append(time.time() - t0)
+    return min(seconds)
+
+if __name__ == '__main__':
+    sys.exit(main())
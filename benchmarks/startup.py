@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+""" Measures the start-up cost of each conversion path: the time a fresh
+interpreter needs to import raw2nii and everything the converter imports,
+and which of the heavy modules get loaded. The converters are run on a
+missing input file, so only their imports and argument handling are timed.
+
+Run from the repository root:
+    python -m benchmarks.startup --repeat 10
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'project')
+#Modules whose import cost dominates the start-up
+HEAVY_MODULES = ('numpy', 'nibabel', 'dicom', 'pydicom', 'd2p_defines',
+    'read_dicom', 'nii', 'read_par')
+#Maps conversion path -> (input file, output file) of the raw_convert call,
+#None only imports raw2nii
+PATHS = (
+    ('python', None),
+    ('cli', None),
+    ('par2nii', ('missing.PAR', 'missing.nii')),
+    ('dcm2par', ('missing.dcm', 'missing.PAR')),
+)
+_SNIPPET = """
+import time
+t0 = time.time()
+import json, logging, sys
+sys.path.insert(0, {project_dir!r})
+if {import_raw2nii!r}:
+    import raw2nii
+    logging.disable(logging.CRITICAL)
+    if {files!r} is not None:
+        try:
+            raw2nii.raw_convert({files!r}[0], {files!r}[1],
+                no_angulation=True, no_rescale=True, dti_revertb0=False)
+        except Exception:
+            pass
+print(json.dumps({{'seconds': time.time() - t0,
+    'modules': len(sys.modules),
+    'heavy': sorted(m for m in {heavy!r} if m in sys.modules)}}))
+"""
+
+def measure(name, files, repeat=5):
+    """ Runs the path in repeat fresh interpreters. Returns a dict with the
+        median wall time (including interpreter start-up), the import time
+        inside the interpreter, and the loaded modules. """
+    code = _SNIPPET.format(project_dir=PROJECT_DIR,
+        import_raw2nii=name != 'python', files=files, heavy=HEAVY_MODULES)
+    walls = []
+    imports = []
+    for i in range(repeat):
+        t0 = time.time()
+        out = subprocess.check_output([sys.executable, '-c', code])
+        walls.append(time.time() - t0)
+        info = json.loads(out.decode('utf-8'))
+        imports.append(info['seconds'])
+    return {
+        'wall': sorted(walls)[len(walls) // 2],
+        'imports': sorted(imports)[len(imports) // 2],
+        'modules': info['modules'],
+        'heavy': info['heavy'],
+    }
+
+def run(repeat=5):
+    return dict((name, measure(name, files, repeat)) for name, files in PATHS)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    options = parser.parse_args()
+    results = run(options.repeat)
+    for name, files in PATHS:
+        r = results[name]
+        print('{0:8s} {1:7.3f} s wall {2:7.3f} s imports {3:5d} modules  '
+            '{4}'.format(name, r['wall'], r['imports'], r['modules'],
+            ' '.join(r['heavy'])))
+
+if __name__ == '__main__':
+    main()
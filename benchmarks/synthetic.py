@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+""" Generator of synthetic V4.2 PAR/REC pairs for tests and benchmarks. The
+PAR file is written with the d2p_defines templates (the same ones the
+DICOM -> PAR conversion uses) and the REC file is filled with random pixel
+values, so any size can be produced without real scanner data.
+
+Run from the repository root:
+    python -m benchmarks.synthetic out_dir/fmri.PAR --res 64 64 --slices 30
+        --dynamics 100
+"""
+from __future__ import division, print_function
+import argparse
+import numpy as np
+import os
+from decimal import Decimal
+
+from project import d2p_defines
+from project.DICOMFile import DICOMFile, FRAME_DTYPE
+
+
+#Maps slice orientation name -> slice orientation code in the PAR file
+ORIENTATIONS = {
+    'tra': 1,
+    'sag': 2,
+    'cor': 3,
+}
+#Maps image pixel size (in bits) -> dtype of the REC file
+_REC_DTYPES = {
+    8: np.dtype('<i1'),
+    16: np.dtype('<i2'),
+    32: np.dtype('<i4'),
+}
+#Number of images generated and written to the REC file at once
+_REC_CHUNK_IMAGES = 256
+#Format of one slice line, in the column order of PAR_MIDDLE_SECTION
+_SLICE_LINE_FORMAT = ' '.join([
+    '%3d %3d %4d %2d %d %d %5d %3d %5d %4d %4d',  # sl ec dyn ph ty seq idx..
+    '%11.5f %9.5f %.5e %5d %5d',  # rescale intercept/slope, scale, window
+    '%6.2f %6.2f %6.2f %7.2f %7.2f %7.2f',  # angulation, offcentre
+    '%.3f %.3f %d %d %d %d',  # thickness, gap, display/slice orientation..
+    '%6.3f %6.3f %6.2f %7.2f %8.2f %7.2f',  # spacing, echo/dyn/trigger, b
+    '%3d %7.2f %5d %4d %4d %5d %5.1f',  # averages, flip .. inversion delay
+    '%2d %3d %4d %4d %7.3f %8.3f %8.3f %2d',  # b nr, grad nr .. label type
+])
+
+def get_volumes(nr_dynamics=1, nr_bvalues=1, nr_grad_orients=1):
+    """ Returns the (dynamic, b value number, gradient number) of every
+        volume. Diffusion scans have one b0 volume followed by every
+        gradient orientation of every other b value. """
+    if nr_bvalues > 1 or nr_grad_orients > 1:
+        return [(1, 1, 1)] + [(1, b, g) for b in range(2, nr_bvalues + 1)
+            for g in range(1, nr_grad_orients + 1)]
+    return [(d, 1, 1) for d in range(1, nr_dynamics + 1)]
+
+def make_slice_table(nr_slices=30, nr_dynamics=1, nr_echoes=1, nr_bvalues=1,
+        nr_grad_orients=1, multi_scaling=False, shuffle=False, seed=0):
+    """ Returns a dict of slice table columns (one entry per image) """
+    rng = np.random.RandomState(seed)
+    volumes = get_volumes(nr_dynamics, nr_bvalues, nr_grad_orients)
+    nr_images = len(volumes) * nr_echoes * nr_slices
+    vol, echo, sl = np.unravel_index(np.arange(nr_images),
+        (len(volumes), nr_echoes, nr_slices))
+    volumes = np.array(volumes)
+    index = np.arange(nr_images)
+    if shuffle:
+        rng.shuffle(index)
+    columns = {
+        'slice': sl + 1,
+        'echo': echo + 1,
+        'dynamic': volumes[vol, 0],
+        'index': index,
+        'rescale_slope': (1.5 + 0.01 * vol if multi_scaling else
+            np.full(nr_images, 1.5)),
+        'offcentre': (sl - (nr_slices - 1) / 2) * 3.0,
+        'echo_time': 30.0 + 10.0 * echo,
+        'dyn_time': (volumes[vol, 0] - 1) * 2.0,
+        'b_factor': np.where(volumes[vol, 1] > 1,
+            1000.0 * (volumes[vol, 1] - 1), 0.0),
+        'b_number': volumes[vol, 1],
+        'grad_number': volumes[vol, 2],
+    }
+    #Unit gradient directions, b0 volumes have none
+    theta = rng.uniform(0, np.pi, len(volumes))
+    phi = rng.uniform(0, 2 * np.pi, len(volumes))
+    directions = np.column_stack((np.sin(theta) * np.cos(phi),
+        np.sin(theta) * np.sin(phi), np.cos(theta)))
+    directions[volumes[:, 1] == 1] = 0
+    columns['diffusion'] = directions[vol]
+    return columns
+
+def make_parrec(par_fname, res=(64, 64), nr_slices=30, nr_dynamics=1,
+        nr_echoes=1, nr_bvalues=1, nr_grad_orients=1, bit=16,
+        multi_scaling=False, orientation='tra', shuffle=False, seed=0):
+    """ Writes a V4.2 PAR file and its REC file. Returns a dict with the
+        file names, the number of images and the REC size in bytes.
+        multi_scaling: use a different rescale slope for every volume
+        shuffle: store the images in the REC file in random order """
+    res_x, res_y = res
+    diffusion = nr_bvalues > 1 or nr_grad_orients > 1
+    columns = make_slice_table(nr_slices, nr_dynamics, nr_echoes, nr_bvalues,
+        nr_grad_orients, multi_scaling, shuffle, seed)
+    nr_images = columns['index'].shape[0]
+    nr_volumes = nr_images // (nr_slices * nr_echoes)
+    gen_info = {
+        'patient_name': 'Synthetic',
+        'exam_name': 'Synthetic',
+        'protocol_name': 'SYNTHETIC',
+        'exam_date': '2010.01.01',
+        'exam_time': '10:00:00',
+        'series_type': 'MRSERIES',
+        'acquisition_nr': 1,
+        'recon_nr': 1,
+        'scan_duration': '{0:.1f}'.format(2.0 * nr_volumes),
+        'max_n_cardiac_phases': 1,
+        'max_n_echoes': nr_echoes,
+        'max_n_slices': nr_slices,
+        'max_n_dynamics': 1 if diffusion else nr_dynamics,
+        'max_n_mixes': 1,
+        'patient_pos': 'HeadFirstSupine',
+        'preparation_dir': 'Anterior-Posterior',
+        'technique': 'DwiSE' if diffusion else 'FEEPI',
+        'scan_res_x': res_x,
+        'scan_res_y': res_y,
+        'scan_mode': 'MS',
+        'rep_time': '2000.000',
+        'fov_ap': '{0:.3f}'.format(res_x * 2.0),
+        'fov_fh': '{0:.3f}'.format(nr_slices * 3.0),
+        'fov_rl': '{0:.3f}'.format(res_y * 2.0),
+        'water_fat_shift': '1.000',
+        'ang_midslice_ap': '5.000',
+        'ang_midslice_fh': '0.000',
+        'ang_midslice_rl': '2.000',
+        'offcenter_midslice_ap': '1.000',
+        'offcenter_midslice_fh': '2.000',
+        'offcenter_midslice_rl': '3.000',
+        'flow_compensation': 0,
+        'presaturation': 0,
+        'phase_encoding_velocity_0': '0.000000',
+        'phase_encoding_velocity_1': '0.000000',
+        'phase_encoding_velocity_2': '0.000000',
+        'mtc': 0,
+        'spir': 0,
+        'epi_factor': 1,
+        'dynamic_scan': int(nr_dynamics > 1 and not diffusion),
+        'diffusion': int(diffusion),
+        'diff_echo_time': '0.0000',
+        'max_n_diff_values': nr_bvalues,
+        'max_n_grad_orients': nr_grad_orients,
+        'n_label_types': 0,
+    }
+    ones = np.ones(nr_images)
+    rows = np.column_stack([
+        columns['slice'], columns['echo'], columns['dynamic'], ones,
+        0 * ones, 2 * ones, columns['index'], bit * ones, 100 * ones,
+        res_x * ones, res_y * ones,
+        0 * ones, columns['rescale_slope'], 1.2345e-2 * ones,
+        100 * ones, 200 * ones,
+        5 * ones, 0 * ones, 2 * ones,
+        ones, 2 + columns['offcentre'], 3 * ones,
+        3 * ones, 0 * ones, 0 * ones, ORIENTATIONS[orientation] * ones,
+        0 * ones, 2 * ones,
+        2 * ones, 2 * ones, columns['echo_time'], columns['dyn_time'],
+        0 * ones, columns['b_factor'],
+        ones, 90 * ones, 0 * ones, 0 * ones, 0 * ones, 0 * ones, 0 * ones,
+        columns['b_number'], columns['grad_number'], 0 * ones, 0 * ones,
+        columns['diffusion'][:, 0], columns['diffusion'][:, 1],
+        columns['diffusion'][:, 2], ones,
+    ])
+    with open(par_fname, 'w') as f:
+        f.write(d2p_defines.PAR_HEADER.format(dataset_name='synthetic',
+            tool_info='benchmarks.synthetic', par_version='V4.2'))
+        f.write(d2p_defines.PAR_GEN_INFO.format(**gen_info))
+        f.write(d2p_defines.PAR_MIDDLE_SECTION)
+        np.savetxt(f, rows, fmt=_SLICE_LINE_FORMAT)
+        f.write(d2p_defines.PAR_FOOTER)
+    rec_fname = os.path.splitext(par_fname)[0] + (
+        '.REC' if par_fname.endswith('.PAR') else '.rec')
+    write_rec(rec_fname, nr_images, res, bit, seed)
+    return {
+        'par_fname': par_fname,
+        'rec_fname': rec_fname,
+        'nr_images': nr_images,
+        'rec_bytes': nr_images * res_x * res_y * _REC_DTYPES[bit].itemsize,
+    }
+
+def write_rec(rec_fname, nr_images, res=(64, 64), bit=16, seed=0):
+    """ Writes nr_images random images in chunks, so the REC size is not
+        limited by memory """
+    rng = np.random.RandomState(seed)
+    dtype = _REC_DTYPES[bit]
+    high = 2 ** (bit - 2)
+    with open(rec_fname, 'wb') as f:
+        for start in range(0, nr_images, _REC_CHUNK_IMAGES):
+            n = min(_REC_CHUNK_IMAGES, nr_images - start)
+            rng.randint(0, high, (n,) + tuple(res)).astype(dtype).tofile(f)
+
+def make_dicom(res=(64, 64), nr_slices=30, nr_dynamics=1, nr_echoes=1,
+        nr_bvalues=1, nr_grad_orients=1, bit=16, multi_scaling=False,
+        orientation='tra', seed=0):
+    """ Returns a DICOMFile with the attributes read_dicom would set for an
+        enhanced Philips DICOM of the same layout, for benchmarking the
+        DICOM -> PAR writer without real scanner data """
+    columns = make_slice_table(nr_slices, nr_dynamics, nr_echoes, nr_bvalues,
+        nr_grad_orients, multi_scaling, False, seed)
+    diffusion = nr_bvalues > 1 or nr_grad_orients > 1
+    nr_images = columns['index'].shape[0]
+    dcm = DICOMFile()
+    dcm.patient_name = 'Synthetic'
+    dcm.exam_name = 'Synthetic'
+    dcm.protocol_name = 'SYNTHETIC'
+    dcm.exam_date = '20100101'
+    dcm.exam_time = '100000'
+    dcm.series_date = '20100101'
+    dcm.series_time = '100000.00'
+    dcm.series_data_type = 'PIXEL'
+    dcm.acquisition_nr = 1
+    dcm.recon_nr = 1
+    dcm.acquisition_dur = Decimal('10.0')
+    dcm.max_n_phases_mr = 1
+    dcm.max_n_echoes = nr_echoes
+    dcm.max_n_slices = nr_slices
+    dcm.max_n_dyn = 1 if diffusion else nr_dynamics
+    dcm.max_n_mixes = 1
+    dcm.max_n_bvalues = nr_bvalues
+    dcm.max_n_grad_orients = nr_grad_orients
+    dcm.num_label_types = 0
+    dcm.patient_pos = 'HFS'
+    dcm.preparation_dir = 'AP'
+    dcm.technique = 'DwiSE' if diffusion else 'FEEPI'
+    dcm.scan_res_x, dcm.scan_res_y = res
+    dcm.scan_mode = 'MS'
+    dcm.rep_time = Decimal('2000.0')
+    dcm.fov_ap = dcm.fov_rl = Decimal(res[0] * 2)
+    dcm.fov_fh = Decimal(nr_slices * 3)
+    dcm.water_fat_shift = Decimal('1.0')
+    dcm.ang_ap, dcm.ang_fh, dcm.ang_rl = Decimal(5), Decimal(0), Decimal(2)
+    dcm.offcenter_ap = Decimal(1)
+    dcm.offcenter_fh = Decimal(2)
+    dcm.offcenter_rl = Decimal(3)
+    dcm.flow_compensation = dcm.presaturation = dcm.mtc = dcm.spir = 'N'
+    dcm.phase_encoding_velocity = np.array([Decimal(0)] * 3)
+    dcm.epi_factor = 1
+    dcm.dyn_scan = 'Y' if nr_dynamics > 1 and not diffusion else 'N'
+    dcm.diffusion = 'Y' if diffusion else 'N'
+    dcm.diff_echo_time = Decimal(0)
+    dcm.px_size = bit
+    dcm.res_x, dcm.res_y = res
+    nr_stacks = nr_images // nr_slices
+    dcm.num_stacks = nr_stacks
+    slice_orient = dict((code, name) for name, code in
+        d2p_defines.SLICE_ORIENT_ENUM.items())[ORIENTATIONS[orientation]]
+    frames = np.recarray((nr_images,), dtype=FRAME_DTYPE)
+    frames.frame_index = np.arange(nr_images)
+    frames.slice_num = columns['slice']
+    frames.echo_num = columns['echo']
+    frames.dynamic = columns['dynamic']
+    frames.cardiac_phase = 1
+    frames.bvalue = columns['b_number']
+    frames.grad_orient = columns['grad_number']
+    frames.label_type = '-'
+    frames.img_type = 'M'
+    frames.img_seq = 'FFE'
+    frames.scan_prct = 100
+    frames.rescale_interc = 0
+    frames.rescale_slope = columns['rescale_slope']
+    frames.scale_slope = 0.012345
+    frames.window_center = 100
+    frames.window_width = 200
+    frames.sl_thickness = 3
+    frames.sl_gap = 0
+    frames.dsply_orient = 'NONE'
+    frames.fmri_stat_indication = 0
+    frames.img_type_ed_es = 'U'
+    frames.px_spacing = 2
+    frames.echo_t = columns['echo_time']
+    frames.dyn_scan_begin_t = columns['dyn_time']
+    frames.trigger_t = 0
+    frames.diff_b_factor = columns['b_factor']
+    frames.no_avgs = 1
+    frames.img_flip_ang = 90
+    frames.cardiac_freq = 0
+    frames.min_rr_interval = 0
+    frames.max_rr_interval = 0
+    frames.turbo_factor = 0
+    frames.inversion_delay = 0
+    frames.diff_anisotropy_type = '-'
+    frames.contrast_type = 'DIFFUSION' if diffusion else 'T2_STAR'
+    frames.diff_ap = columns['diffusion'][:, 0]
+    frames.diff_fh = columns['diffusion'][:, 1]
+    frames.diff_rl = columns['diffusion'][:, 2]
+    frames.mr_stack_id = 0
+    frames.ang_ap, frames.ang_fh, frames.ang_rl = 5, 0, 2
+    frames.offcenter_ap = 1
+    frames.offcenter_fh = 2 + columns['offcentre']
+    frames.offcenter_rl = 3
+    frames.slice_orient = slice_orient
+    frames.temporal_pos_index = np.arange(nr_images) // nr_slices
+    dcm.frames = frames
+    rng = np.random.RandomState(seed)
+    dcm.raw_data = rng.randint(0, 2 ** (bit - 2),
+        nr_images * res[0] * res[1]).astype(_REC_DTYPES[bit]).tostring()
+    return dcm
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('par_fname')
+    parser.add_argument('--res', type=int, nargs=2, default=(64, 64))
+    parser.add_argument('--slices', type=int, default=30)
+    parser.add_argument('--dynamics', type=int, default=1)
+    parser.add_argument('--echoes', type=int, default=1)
+    parser.add_argument('--bvalues', type=int, default=1)
+    parser.add_argument('--gradients', type=int, default=1)
+    parser.add_argument('--bit', type=int, choices=sorted(_REC_DTYPES),
+        default=16)
+    parser.add_argument('--multi-scaling', action='store_true')
+    parser.add_argument('--orientation', choices=sorted(ORIENTATIONS),
+        default='tra')
+    parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    info = make_parrec(options.par_fname, options.res, options.slices,
+        options.dynamics, options.echoes, options.bvalues, options.gradients,
+        options.bit, options.multi_scaling, options.orientation,
+        options.shuffle, options.seed)
+    print('Wrote {0} images ({1} bytes) to {2}'.format(info['nr_images'],
+        info['rec_bytes'], info['rec_fname']))
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,63 @@
+import numpy as np
+
+
+#Columns of DICOMFile.frames, the frame table with one row per image frame in
+#the order of the PAR file
+FRAME_DTYPE = [
+    ('frame_index', np.int64),  # index of the frame in the DICOM file
+    ('slice_num', np.int64),
+    ('echo_num', np.int64),
+    ('dynamic', np.int64),
+    ('cardiac_phase', np.int64),
+    ('bvalue', np.int64),
+    ('grad_orient', np.int64),
+    ('label_type', object),
+    ('img_type', object),
+    ('img_seq', object),
+    ('scan_prct', np.float64),
+    ('rescale_interc', np.float64),
+    ('rescale_slope', np.float64),
+    ('scale_slope', np.float64),
+    ('window_center', np.int64),
+    ('window_width', np.int64),
+    ('sl_thickness', np.float64),
+    ('sl_gap', np.float64),
+    ('dsply_orient', object),
+    ('fmri_stat_indication', np.int64),
+    ('img_type_ed_es', object),
+    ('px_spacing', np.float64, (2,)),
+    ('echo_t', np.float64),
+    ('dyn_scan_begin_t', np.float64),
+    ('trigger_t', np.float64),
+    ('diff_b_factor', np.float64),
+    ('no_avgs', np.int64),
+    ('img_flip_ang', np.float64),
+    ('cardiac_freq', np.int64),
+    ('min_rr_interval', np.int64),
+    ('max_rr_interval', np.int64),
+    ('turbo_factor', np.int64),
+    ('inversion_delay', np.float64),
+    ('diff_anisotropy_type', object),
+    ('contrast_type', object),
+    ('diff_ap', np.float64),
+    ('diff_fh', np.float64),
+    ('diff_rl', np.float64),
+    ('mr_stack_id', np.int64),
+    ('ang_ap', np.float64),
+    ('ang_fh', np.float64),
+    ('ang_rl', np.float64),
+    ('offcenter_ap', np.float64),
+    ('offcenter_fh', np.float64),
+    ('offcenter_rl', np.float64),
+    ('slice_orient', object),
+    ('temporal_pos_index', np.int64),
+]
+
 class DICOMFile(object):
+    #(file name, pixel data offset, pixel data length) of every frame of a
+    #series stored one frame per file, in frame_index order
+    frame_files = None
+
     def __repr__(self):
         return 'DICOMFile' + repr(self.__dict__)
 
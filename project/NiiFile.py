@@ -1,21 +1,99 @@
+import numpy as np
+import struct
+
+
 #Reference for NIFTI header values can be found at:
 #http://nifti.nimh.nih.gov/pub/dist/src/niftilib/nifti1.h
-HEADER_FIELD_NAMES = ('HdrSz', 'Data_Type', 'db_name', 'extents',
-    'session_error', 'regular', 'dim_info', 'dim', 'intent_p123', 'intent_code',
-    'datatype', 'bitpix', 'slice_start', 'pixdim', 'vox_offset', 'scl_slope',
-    'scl_inter', 'slice_end', 'slice_code', 'xyzt_units', 'cal_maxmin',
-    'slice_duration', 'toffset', 'glmaxmin', 'descrip', 'aux_file',
-    'qform_code', 'sform_code', 'quatern_bcd', 'qoffset_xyz', 'srow_xyz',
-    'intent_name', 'magic')
+#The NIFTI-1 header layout, shared by the writer and the readers in tools/:
+#(name, struct format of one element, shape). Matrices are stored in C order
+#of the file, NiiHdr and the readers keep them transposed (Fortran order).
+HEADER_FIELDS = (
+    ('HdrSz', 'i', ()),
+    ('Data_Type', '10s', ()),
+    ('db_name', '18s', ()),
+    ('extents', 'i', ()),
+    ('session_error', 'h', ()),
+    ('regular', 'B', ()),
+    ('dim_info', 'B', ()),
+    ('dim', 'h', (8,)),
+    ('intent_p123', 'f', (3,)),
+    ('intent_code', 'h', ()),
+    ('datatype', 'h', ()),
+    ('bitpix', 'h', ()),
+    ('slice_start', 'h', ()),
+    ('pixdim', 'f', (8,)),
+    ('vox_offset', 'f', ()),
+    ('scl_slope', 'f', ()),
+    ('scl_inter', 'f', ()),
+    ('slice_end', 'h', ()),
+    ('slice_code', 'B', ()),
+    ('xyzt_units', 'B', ()),
+    ('cal_maxmin', 'f', (2,)),
+    ('slice_duration', 'f', ()),
+    ('toffset', 'f', ()),
+    ('glmaxmin', 'i', (2,)),
+    ('descrip', '80s', ()),
+    ('aux_file', '24s', ()),
+    ('qform_code', 'h', ()),
+    ('sform_code', 'h', ()),
+    ('quatern_bcd', 'f', (3,)),
+    ('qoffset_xyz', 'f', (3,)),
+    ('srow_xyz', 'f', (3, 4)),
+    ('intent_name', '16s', ()),
+    ('magic', 'i', ()),
+)
+HEADER_FIELD_NAMES = tuple(name for name, fmt, shape in HEADER_FIELDS)
+HEADER_SIZE = 348
+#Header, the 4 extension bytes and the start of the data of a .nii file
+NII_VOX_OFFSET = 352
+#Little endian, as written by NiiHdr.tobytes
+HEADER_STRUCT = struct.Struct('<' + ''.join(
+    '{0}{1}'.format(int(np.prod(shape)), fmt) if shape else fmt
+    for name, fmt, shape in HEADER_FIELDS))
+HEADER_DTYPE = np.dtype([(name, '<' + ('S' + fmt[:-1] if fmt[-1] == 's'
+    else fmt), shape) for name, fmt, shape in HEADER_FIELDS])
+#HEADER_DTYPE followed by the extension bytes, the first 352 bytes of a .nii
+NII_HEADER_DTYPE = np.dtype(HEADER_DTYPE.descr + [('extension', 'u1', (4,))])
+assert HEADER_STRUCT.size == HEADER_DTYPE.itemsize == HEADER_SIZE
 
 class NiiHdr:
+    def tobytes(self):
+        """ The header packed in one call, in file layout """
+        values = []
+        for name, fmt, shape in HEADER_FIELDS:
+            val = getattr(self, name).val
+            if shape:
+                #Matrices are kept transposed, in Fortran order
+                values.extend(np.asarray(val).T.ravel().tolist())
+            else:
+                values.append(val)
+        return HEADER_STRUCT.pack(*values)
+
     def __repr__(self):
         s = []
-        for key in self.fieldnames():
+        for key in HEADER_FIELD_NAMES:
             val = getattr(self, key)
             s.append('{0}="{1}"'.format(key, val))
         return '<NiiHdr {0}>'.format(' '.join(s))
 
+def unpack_header(header_bytes):
+    """ Header fields of the first HEADER_SIZE bytes as a dict, in either
+        byte order. Arrays are numpy arrays, matrices transposed (Fortran
+        order) like in NiiHdr. """
+    dtype = HEADER_DTYPE
+    if np.frombuffer(header_bytes, '<i4', 1)[0] != HEADER_SIZE:
+        dtype = dtype.newbyteorder('>')
+    record = np.frombuffer(header_bytes, dtype, 1)[0]
+    header = {}
+    for name, fmt, shape in HEADER_FIELDS:
+        val = record[name]
+        if len(shape) > 1:
+            val = val.T
+        elif not shape:
+            val = val.item()
+        header[name] = val
+    return header
+
 class NiiHdrField:
     """ Arbitrary structure """
     def __init__(self, val, prec):
@@ -6,6 +6,29 @@ class PARFile:
         self.slices = None
         self.problem_reading = False
         self.version = None
+        #Where the images are: rec_size bytes from rec_offset in rec_fname
+        #(None: up to the end of the file), rec_data when they are held in
+        #memory, or rec_files, the (file name, offset) of every image when
+        #they are stored one per file
+        self.rec_offset = 0
+        self.rec_size = None
+        self.rec_data = None
+        self.rec_files = None
+
+    def defer(self, loader):
+        """ Postpones loading of the slice table: loader(self) is called on
+            the first access of an attribute that has not been set yet """
+        self.__dict__.pop('slices', None)
+        self._loader = loader
+
+    def __getattr__(self, name):
+        #Only called when normal lookup fails, so loaded attributes cost
+        #nothing extra
+        if name.startswith('__') or '_loader' not in self.__dict__:
+            raise AttributeError(name)
+        loader = self.__dict__.pop('_loader')
+        loader(self)
+        return getattr(self, name)
 
     def __repr__(self):
         s = []
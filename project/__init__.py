@@ -1 +1 @@
-from raw2nii import raw_convert
+from raw2nii import raw_convert, repatch
@@ -0,0 +1,337 @@
+""" Batch conversion of many input files in a pool of worker processes. Each
+worker imports raw2nii (and NumPy) once and then converts one file after
+the other, so the interpreter start-up is paid once per worker instead of
+once per file. Jobs are started largest REC first, every job runs with an
+optional timeout, and a worker that crashes or times out is replaced
+without affecting the other jobs.
+
+function find_inputs
+    inputs: list of files, directories and glob patterns
+    list_fname: optional file with one input per line
+returns:
+    sorted list of unique input files
+
+function make_jobs
+    input_fnames: list of input files
+    output_dir: directory the outputs are written to (default: next to
+        the input)
+returns:
+    list of job dicts, largest first
+
+function run_batch
+    jobs: list of job dicts as returned by make_jobs
+    options: keyword arguments passed to raw_convert
+    nr_workers: number of worker processes (default: CPU count)
+    timeout: maximum number of seconds per job (default: no timeout)
+returns:
+    list of result dicts in the order the jobs were given
+"""
+from __future__ import division
+import glob
+import logging
+import multiprocessing
+import os
+import select
+import time
+import traceback
+
+from read_par import get_rec_fname
+
+
+__all__ = ['ConversionPool', 'find_inputs', 'make_jobs', 'run_batch',
+    'summarize']
+
+#Maps input file extension -> output file extension
+_OUTPUT_EXT_TABLE = {
+    '.par': '.nii',
+    '.dcm': '.PAR',
+}
+#Seconds between checks of the busy workers
+_POLL_INTERVAL = 0.05
+
+def find_inputs(inputs, list_fname=None):
+    """ Expands directories (recursively) and glob patterns into the list of
+        convertible input files """
+    inputs = list(inputs)
+    if list_fname is not None:
+        with open(list_fname) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    inputs.append(line)
+    fnames = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for dirpath, dirnames, filenames in os.walk(item):
+                fnames.update(os.path.join(dirpath, fname)
+                    for fname in filenames if _is_input(fname))
+        elif os.path.exists(item):
+            fnames.add(item)
+        else:
+            fnames.update(fname for fname in glob.glob(item)
+                if _is_input(fname))
+    return sorted(fnames)
+
+def make_jobs(input_fnames, output_dir=None):
+    """ Builds one job per input file. The size of a job is the size of the
+        data it converts (the REC file for PAR input), and jobs are returned
+        largest first so that the longest conversions do not end up
+        starting last. """
+    jobs = []
+    for input_fname in input_fnames:
+        base, ext = os.path.splitext(input_fname)
+        output_ext = _OUTPUT_EXT_TABLE.get(ext.lower())
+        if output_ext is None:
+            raise ValueError('Unsupported input file "{0}"'.format(
+                input_fname))
+        if output_dir is not None:
+            base = os.path.join(output_dir, os.path.basename(base))
+        if ext.lower() == '.par':
+            data_fname = get_rec_fname(input_fname)
+        else:
+            data_fname = input_fname
+        try:
+            size = os.path.getsize(data_fname)
+        except OSError:
+            size = 0
+        jobs.append({
+            'input_file': input_fname,
+            'output_file': base + output_ext,
+            'size': size,
+        })
+    jobs.sort(key=lambda job: job['size'], reverse=True)
+    return jobs
+
+def run_batch(jobs, options, nr_workers=None, timeout=None):
+    """ Converts all jobs and waits for them to finish """
+    logger = logging.getLogger('raw2nii')
+    pool = ConversionPool(options, nr_workers, timeout)
+    results = {}
+    try:
+        for i, job in enumerate(jobs):
+            pool.submit(job, i)
+        while len(results) < len(jobs):
+            for tag, result in pool.poll():
+                results[tag] = result
+                logger.info('[{0}/{1}] {2}: {3} ({4:.1f} s)'.format(
+                    len(results), len(jobs), result['status'],
+                    result['input_file'], result['seconds']))
+    finally:
+        pool.close()
+    return [results[i] for i in range(len(jobs))]
+
+def summarize(results, wall_time):
+    """ Totals of a batch run: number of jobs per status and throughput """
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    total_bytes = sum(result['size'] for result in results
+        if result['status'] == 'ok')
+    return {
+        'jobs': len(results),
+        'statuses': statuses,
+        'wall_time': wall_time,
+        'bytes': total_bytes,
+        'mb_per_s': total_bytes / 2 ** 20 / wall_time if wall_time else None,
+        'results': results,
+    }
+
+class ConversionPool:
+    """ Pool of worker processes that run raw_convert. Jobs are started in
+        the order they were submitted; poll returns (tag, result) for the
+        jobs that finished. A result has the keys of the job plus status
+        ('ok', 'failed', 'error', 'timeout' or 'crashed'), seconds,
+        mb_per_s and error. A job may carry its own 'options' that override
+        the options of the pool. The modules in preload are imported by
+        every worker when it starts, before it gets its first job. """
+    def __init__(self, options, nr_workers=None, timeout=None, preload=()):
+        self.options = options
+        self.nr_workers = nr_workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.preload = tuple(preload)
+        self.pending = []
+        self.workers = []
+        for i in range(self.nr_workers):
+            self.workers.append(_Worker(options, self.preload))
+
+    def submit(self, job, tag=None):
+        self.pending.append((tag, job))
+
+    def nr_busy(self):
+        return len(self.pending) + sum(1 for worker in self.workers
+            if worker.job is not None)
+
+    def poll(self, wait=_POLL_INTERVAL):
+        """ Starts pending jobs on idle workers and returns the finished
+            ones. Sleeps up to wait seconds if nothing finished. """
+        finished = self._collect()
+        if not finished and wait:
+            self.wait(wait)
+            finished = self._collect()
+        return finished
+
+    def busy_conns(self):
+        """ Pipes of the busy workers, readable when a worker has something
+            to report """
+        return [worker.conn for worker in self.workers
+            if worker.job is not None]
+
+    def time_left(self):
+        """ Seconds until the first running job times out, None without
+            timeout or running jobs """
+        if self.timeout is None:
+            return None
+        start_times = [worker.start_time for worker in self.workers
+            if worker.job is not None]
+        if not start_times:
+            return None
+        return max(0, min(start_times) + self.timeout - time.time())
+
+    def wait(self, timeout):
+        """ Sleeps until a busy worker has something to report or timeout
+            seconds have passed """
+        conns = self.busy_conns()
+        if not conns:
+            time.sleep(timeout)
+            return
+        try:
+            select.select(conns, [], [], timeout)
+        except (ValueError, select.error, IOError, OSError):
+            #A worker was replaced while waiting, the next poll sorts it out
+            pass
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def _collect(self):
+        finished = []
+        for i, worker in enumerate(self.workers):
+            if worker.job is not None:
+                result = worker.check(self.timeout)
+                if result is not None:
+                    finished.append((worker.tag, result))
+                    worker.job = worker.tag = None
+                    if result['status'] in ('timeout', 'crashed'):
+                        worker.stop()
+                        self.workers[i] = worker = _Worker(self.options,
+                            self.preload)
+            if worker.job is None and self.pending:
+                tag, job = self.pending.pop(0)
+                worker.start(job, tag)
+        return finished
+
+class _Worker:
+    def __init__(self, options, preload=()):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main,
+            args=(child_conn, options, preload))
+        self.process.daemon = True
+        self.process.start()
+        #Close our copy of the child end, so that a dying worker shows up as
+        #EOF on the pipe
+        child_conn.close()
+        self.job = self.tag = None
+        self.start_time = None
+
+    def start(self, job, tag):
+        self.job, self.tag = job, tag
+        self.start_time = time.time()
+        self.conn.send(job)
+
+    def check(self, timeout):
+        """ Returns the result of the running job, or None if it is still
+            running """
+        seconds = time.time() - self.start_time
+        try:
+            if self.conn.poll():
+                status, error, seconds = self.conn.recv()
+                return _make_result(self.job, status, seconds, error)
+        except (EOFError, IOError, OSError):
+            pass
+        else:
+            if self.process.is_alive():
+                if timeout is None or seconds < timeout:
+                    return None
+                self._kill()
+                return _make_result(self.job, 'timeout', seconds,
+                    'Timed out after {0:.1f} s'.format(seconds))
+        self.process.join()
+        _remove_output(self.job)
+        return _make_result(self.job, 'crashed', seconds,
+            'Worker exited with code {0}'.format(self.process.exitcode))
+
+    def stop(self):
+        if self.process.is_alive():
+            if self.job is None:
+                try:
+                    self.conn.send(None)
+                except (IOError, OSError):
+                    pass
+                self.process.join(1)
+            if self.process.is_alive():
+                self._kill()
+        self.conn.close()
+
+    def _kill(self):
+        self.process.terminate()
+        self.process.join()
+        _remove_output(self.job)
+
+def _worker_main(conn, options, preload=()):
+    """ Runs in the worker process: converts jobs until it receives None """
+    from raw2nii import raw_convert
+    logger = logging.getLogger('raw2nii')
+    for module_name in preload:
+        try:
+            #With the globals of this module, so that the project modules
+            #are found relative to its package, as by the import statements
+            #of the converters
+            __import__(module_name, globals())
+        except ImportError as e:
+            logger.warning('Failed to preload {0}: {1}'.format(module_name,
+                e))
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+        start = time.time()
+        job_options = dict(options)
+        job_options.update(job.get('options') or {})
+        try:
+            if raw_convert(job['input_file'], job['output_file'],
+                    **job_options):
+                result = ('failed', 'Conversion returned an error')
+            else:
+                result = ('ok', None)
+        except Exception as e:
+            logger.error('Failed to convert "{0}": {1}'.format(
+                job['input_file'], e))
+            result = ('error', traceback.format_exc())
+        conn.send(result + (time.time() - start,))
+
+def _make_result(job, status, seconds, error=None):
+    result = dict(job)
+    result['status'] = status
+    result['seconds'] = seconds
+    result['error'] = error
+    if status == 'ok' and seconds > 0:
+        result['mb_per_s'] = job['size'] / 2 ** 20 / seconds
+    else:
+        result['mb_per_s'] = None
+    return result
+
+def _remove_output(job):
+    """ Removes the partial output of a job whose worker was killed """
+    if job is not None and os.path.exists(job['output_file']):
+        try:
+            os.remove(job['output_file'])
+        except OSError:
+            pass
+
+def _is_input(fname):
+    return os.path.splitext(fname)[1].lower() in _OUTPUT_EXT_TABLE
@@ -0,0 +1,221 @@
+""" SQLite catalog of the DICOM studies, series and files in a directory
+tree. The catalog is a nibabel.dft cache database, so nibabel.dft can query
+it, but it is filled here: only the headers are read (stopping before the
+pixel data), in a thread pool, and only of files that are new or whose
+mtime changed. Files that disappeared are dropped.
+
+function update_catalog
+    root_dir: directory that is searched recursively for DICOM files
+    db_fname: SQLite file the catalog is written to
+    jobs: number of threads reading headers (default: CPU count)
+returns:
+    (number of read files, number of removed files, number of unchanged)
+
+function list_series
+    db_fname: SQLite catalog file
+returns:
+    list of dicts with the study and series information and the number of
+    images of every series
+
+function get_series_files
+    db_fname: SQLite catalog file
+    series_uid: SeriesInstanceUID
+returns:
+    file names of the series, one per image, by instance number
+"""
+from __future__ import division
+import logging
+import multiprocessing
+import nibabel
+import nibabel.dft
+import os
+from multiprocessing.pool import ThreadPool
+try:
+    import dicom
+except ImportError:
+    import pydicom as dicom
+
+
+__all__ = ['update_catalog', 'list_series', 'get_series_files',
+    'is_dicom_catalog', 'DEFAULT_CATALOG_NAME']
+
+DEFAULT_CATALOG_NAME = 'raw2nii_dicom.sqlite'
+#Rows are committed in batches so that an interrupted scan keeps its work
+_COMMIT_EVERY = 1000
+_SQLITE_MAGIC = b'SQLite format 3\0'
+
+_INSERT_STUDY = ('INSERT OR IGNORE INTO study (uid, date, time, comments, '
+    'patient_name, patient_id, patient_birth_date, patient_sex) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+_INSERT_SERIES = ('INSERT OR IGNORE INTO series (uid, study, number, '
+    'description, rows, columns, bits_allocated, bits_stored) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+_INSERT_STORAGE_INSTANCE = ('INSERT OR IGNORE INTO storage_instance (uid, '
+    'instance_number, series) VALUES (?, ?, ?)')
+_INSERT_FILE = ('INSERT OR REPLACE INTO file (directory, name, mtime, '
+    'storage_instance) VALUES (?, ?, ?, ?)')
+
+def update_catalog(root_dir, db_fname, jobs=None):
+    logger = logging.getLogger('raw2nii')
+    root_dir = os.path.realpath(root_dir)
+    conn = _open_catalog(db_fname)
+    found = {}
+    dir_mtimes = {}
+    skip_fname = os.path.realpath(db_fname)
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        dir_mtimes[dirpath] = os.stat(dirpath).st_mtime
+        for fname in sorted(filenames):
+            path = os.path.join(dirpath, fname)
+            if path.startswith(skip_fname):
+                continue  # the catalog and its journal
+            try:
+                found[dirpath, fname] = os.lstat(path).st_mtime
+            except OSError:
+                pass
+    known = dict(((row[0], row[1]), row[2]) for row in conn.execute(
+        'SELECT directory, name, mtime FROM file'))
+    stale = [key for key in sorted(found) if known.get(key) != found[key]]
+    removed = [key for key in known if key not in found and
+        _is_below(key[0], root_dir)]
+    logger.info('Scanning {0}: {1} new or changed, {2} removed, {3} '
+        'unchanged files'.format(root_dir, len(stale), len(removed),
+        len(found) - len(stale)))
+    conn.executemany('DELETE FROM file WHERE directory = ? AND name = ?',
+        removed)
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs == 1 or len(stale) < 2:
+        rows = (_read_catalog_row(key) for key in stale)
+        pool = None
+    else:
+        pool = ThreadPool(jobs)
+        rows = pool.imap(_read_catalog_row, stale, chunksize=16)
+    try:
+        for i, (key, row) in enumerate(rows):
+            storage_instance = None
+            if row is not None:
+                study, series, storage_instance = row
+                conn.execute(_INSERT_STUDY, study)
+                conn.execute(_INSERT_SERIES, series)
+                conn.execute(_INSERT_STORAGE_INSTANCE, storage_instance)
+                storage_instance = storage_instance[0]
+            conn.execute(_INSERT_FILE, key + (found[key], storage_instance))
+            if (i + 1) % _COMMIT_EVERY == 0:
+                conn.commit()
+                logger.info('  ...{0} of {1}'.format(i + 1, len(stale)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    #Keep the directory table of nibabel.dft up to date, so that
+    #nibabel.dft.update_cache does not read the scanned directories again
+    conn.executemany('INSERT OR REPLACE INTO directory (path, mtime) '
+        'VALUES (?, ?)', sorted(dir_mtimes.items()))
+    conn.executemany('DELETE FROM directory WHERE path = ?',
+        [(path,) for path, in conn.execute('SELECT path FROM directory')
+        if path not in dir_mtimes and _is_below(path, root_dir)])
+    conn.commit()
+    return len(stale), len(removed), len(found) - len(stale)
+
+def list_series(db_fname):
+    _open_catalog(db_fname)
+    nr_images = dict(nibabel.dft.DB.execute('SELECT storage_instance.series, '
+        'COUNT(DISTINCT storage_instance.uid) FROM file JOIN storage_instance '
+        'ON file.storage_instance = storage_instance.uid '
+        'GROUP BY storage_instance.series'))
+    result = []
+    for study in nibabel.dft.get_studies():
+        for series in study.series:
+            if series.uid not in nr_images:
+                continue  # All files of the series are gone
+            result.append({
+                'study_uid': study.uid,
+                'study_date': study.date,
+                'patient_name': study.patient_name,
+                'patient_id': study.patient_id,
+                'series_uid': series.uid,
+                'series_number': series.number,
+                'description': series.description,
+                'rows': series.rows,
+                'columns': series.columns,
+                'images': nr_images[series.uid],
+            })
+    result.sort(key=lambda s: (s['study_date'], s['study_uid'],
+        _to_int(s['series_number'])))
+    return result
+
+def get_series_files(db_fname, series_uid):
+    conn = _open_catalog(db_fname)
+    fnames = []
+    seen = set()
+    for uid, directory, name in conn.execute('SELECT storage_instance.uid, '
+            'file.directory, file.name FROM file JOIN storage_instance ON '
+            'file.storage_instance = storage_instance.uid WHERE '
+            'storage_instance.series = ? ORDER BY '
+            'storage_instance.instance_number, file.directory, file.name',
+            (series_uid,)):
+        #One file of every image, copies of a file share its SOPInstanceUID
+        if uid not in seen:
+            seen.add(uid)
+            fnames.append(os.path.join(directory, name))
+    if not fnames:
+        raise ValueError('DICOM series {0} not found in catalog "{1}"'
+            .format(series_uid, db_fname))
+    return fnames
+
+def is_dicom_catalog(fname):
+    """ True when fname is an SQLite file """
+    try:
+        with open(fname, 'rb') as f:
+            return f.read(len(_SQLITE_MAGIC)) == _SQLITE_MAGIC
+    except (IOError, OSError):
+        return False
+
+def _open_catalog(db_fname):
+    """ Points nibabel.dft at db_fname, creating its tables if needed """
+    if nibabel.dft.DB is None or nibabel.dft.DB_FNAME != db_fname:
+        if nibabel.dft.DB is not None:
+            nibabel.dft.DB.close()
+        nibabel.dft.DB_FNAME = db_fname
+        nibabel.dft._init_db(verbose=False)
+    return nibabel.dft.DB
+
+def _read_catalog_row(key):
+    """ (key, (study, series, storage instance) rows) of the DICOM file
+        key = (directory, name). The rows are None for other files and
+        DICOM files without the catalog attributes. """
+    return key, _read_catalog_rows(os.path.join(*key))
+
+def _read_catalog_rows(path):
+    logger = logging.getLogger('raw2nii')
+    try:
+        ds = dicom.read_file(path, stop_before_pixels=True)
+    except dicom.filereader.InvalidDicomError:
+        logger.debug('Skipping "{0}": not a DICOM file'.format(path))
+        return None
+    except (IOError, ValueError) as e:
+        logger.warning('Skipping "{0}": {1}'.format(path, e))
+        return None
+    try:
+        study = (str(ds.StudyInstanceUID), ds.StudyDate, ds.StudyTime,
+            getattr(ds, 'StudyComments', ''), str(ds.PatientName),
+            ds.PatientID, ds.PatientBirthDate, ds.PatientSex)
+        series = (str(ds.SeriesInstanceUID), str(ds.StudyInstanceUID),
+            ds.SeriesNumber, ds.SeriesDescription, ds.Rows, ds.Columns,
+            ds.BitsAllocated, ds.BitsStored)
+        storage_instance = (str(ds.SOPInstanceUID), ds.InstanceNumber,
+            str(ds.SeriesInstanceUID))
+    except AttributeError as e:
+        logger.debug('Skipping "{0}": {1}'.format(path, e))
+        return None
+    return study, series, storage_instance
+
+def _is_below(path, root_dir):
+    return path == root_dir or path.startswith(root_dir + os.sep)
+
+def _to_int(val):
+    try:
+        return int(val)
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,245 @@
+""" Streaming gzip compression in a thread pool. The written data is cut into
+blocks that are deflated independently by the threads (zlib releases the
+GIL), and the compressed blocks are written in order as they finish, so
+only a few blocks per thread are held in memory.
+
+By default the blocks are joined into one standard gzip member: every
+block but the last ends with a sync flush, and the CRC-32 of the whole
+stream is combined from the CRCs of the blocks. With bgzf=True every block
+is its own gzip member with the BGZF 'BC' extra field (as written by
+bgzip/htslib), followed by the BGZF end-of-file block, and the block
+offsets can be written as a bgzip .gzi index for random access. Both are
+read by any gzip reader.
+
+class ParallelGzipWriter
+    fileobj: binary file the compressed stream is written to
+    level: zlib compression level (default: DEFAULT_LEVEL)
+    jobs: number of compressing threads (default: CPU count)
+    bgzf: write BGZF blocks instead of one gzip member
+    index_fname: optional .gzi file the BGZF block offsets are written to
+methods:
+    write(data): data is a string or an object with the buffer interface
+        (e.g. a contiguous numpy array), it is copied before returning
+    close(): compresses the remaining data and writes the gzip trailer (or
+        the BGZF end-of-file block and the index)
+"""
+from __future__ import division
+import collections
+import logging
+import multiprocessing
+import numpy as np
+import struct
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+
+__all__ = ['ParallelGzipWriter', 'DEFAULT_LEVEL', 'DEFAULT_BLOCK_SIZE']
+
+DEFAULT_LEVEL = 6
+#Uncompressed bytes per block of a gzip member
+DEFAULT_BLOCK_SIZE = 2 ** 20
+#Uncompressed bytes per BGZF block, so that a deflated block always fits the
+#16 bit BSIZE field
+_BGZF_BLOCK_SIZE = 0xff00
+_BGZF_EOF = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'
+    b'\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+#Blocks waiting to be written, per thread
+_QUEUE_DEPTH = 2
+_GZIP_OS_UNKNOWN = 255
+_CRC32_POLY = 0xedb88320
+
+class ParallelGzipWriter:
+    def __init__(self, fileobj, level=None, jobs=None, bgzf=False,
+            index_fname=None):
+        if level is None:
+            level = DEFAULT_LEVEL
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        self.fileobj = fileobj
+        self.level = level
+        self.bgzf = bgzf
+        self.index_fname = index_fname
+        self.block_size = _BGZF_BLOCK_SIZE if bgzf else DEFAULT_BLOCK_SIZE
+        self._pool = ThreadPool(jobs) if jobs > 1 else None
+        self._max_queued = _QUEUE_DEPTH * jobs
+        self._queued = collections.deque()
+        self._rest = b''
+        self._crc = 0
+        self._size = 0
+        self._compressed_size = 0
+        #(compressed offset, uncompressed offset) of every BGZF block
+        self._index = []
+        self._closed = False
+        if not bgzf:
+            self._write_compressed(_gzip_header(level))
+
+    def write(self, data):
+        #A byte view, only the blocks are copied
+        data = np.frombuffer(data, np.uint8)
+        start = 0
+        if self._rest:
+            start = min(len(data), self.block_size - len(self._rest))
+            self._rest += data[:start].tobytes()
+            if len(self._rest) < self.block_size:
+                return
+            self._submit(self._rest)
+            self._rest = b''
+        end = start + (len(data) - start) // self.block_size * self.block_size
+        for offset in range(start, end, self.block_size):
+            self._submit(data[offset:offset + self.block_size].tobytes())
+        self._rest = data[end:].tobytes()
+
+    def close(self):
+        logger = logging.getLogger('raw2nii')
+        if self._closed:
+            return
+        start = time.time()
+        if self.bgzf:
+            if self._rest:
+                self._submit(self._rest)
+        else:
+            #The last block finishes the deflate stream, even when empty
+            self._submit(self._rest, is_last=True)
+        self._rest = b''
+        while self._queued:
+            self._write_block(self._queued.popleft())
+        if self.bgzf:
+            self._write_compressed(_BGZF_EOF)
+            if self.index_fname is not None:
+                self._write_index()
+        else:
+            self._write_compressed(struct.pack('<II', self._crc,
+                self._size & 0xffffffff))
+        self._shutdown()
+        self._closed = True
+        logger.debug('Compressed {0} bytes to {1} (waited {2:.2f} s at '
+            'close)'.format(self._size, self._compressed_size,
+            time.time() - start))
+
+    def abort(self):
+        """ Stops the threads without finishing the stream """
+        self._queued.clear()
+        self._shutdown()
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _submit(self, block, is_last=False):
+        args = (block, self.level, is_last, self.bgzf)
+        if self._pool is None:
+            self._write_block(_compress_block(args))
+            return
+        self._queued.append(self._pool.apply_async(_compress_block, (args,)))
+        while len(self._queued) > self._max_queued:
+            self._write_block(self._queued.popleft())
+
+    def _write_block(self, result):
+        if not isinstance(result, tuple):
+            result = result.get()
+        compressed, crc, size = result
+        if self.bgzf:
+            self._index.append((self._compressed_size, self._size))
+        else:
+            self._crc = _crc32_combine(self._crc, crc, size)
+        self._size += size
+        self._write_compressed(compressed)
+
+    def _write_compressed(self, data):
+        self.fileobj.write(data)
+        self._compressed_size += len(data)
+
+    def _write_index(self):
+        #bgzip .gzi layout: the number of entries and the offsets of every
+        #block but the first, as little endian 64 bit integers
+        entries = self._index[1:]
+        with open(self.index_fname, 'wb') as f:
+            f.write(struct.pack('<Q', len(entries)))
+            f.write(b''.join(struct.pack('<QQ', *entry)
+                for entry in entries))
+
+    def _shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+def _compress_block(args):
+    """ (compressed block, CRC-32, uncompressed size) of one block """
+    block, level, is_last, bgzf = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    if bgzf or is_last:
+        deflated = compressor.compress(block) + compressor.flush(
+            zlib.Z_FINISH)
+    else:
+        #A sync flush ends the block on a byte boundary without ending the
+        #deflate stream, so that the next block can be appended
+        deflated = compressor.compress(block) + compressor.flush(
+            zlib.Z_SYNC_FLUSH)
+    crc = zlib.crc32(block) & 0xffffffff
+    if not bgzf:
+        return deflated, crc, len(block)
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0,
+        _GZIP_OS_UNKNOWN, 6, ord('B'), ord('C'), 2, len(deflated) + 25)
+    trailer = struct.pack('<II', crc, len(block))
+    return header + deflated + trailer, crc, len(block)
+
+def _gzip_header(level):
+    if level >= 9:
+        extra_flags = 2  # maximum compression
+    elif level == 1:
+        extra_flags = 4  # fastest
+    else:
+        extra_flags = 0
+    return struct.pack('<4BI2B', 0x1f, 0x8b, 8, 0, int(time.time()),
+        extra_flags, _GZIP_OS_UNKNOWN)
+
+#Maps block length -> GF(2) matrix that appends length zero bytes to a CRC
+_crc32_shift_matrices = {}
+
+def _crc32_combine(crc1, crc2, len2):
+    """ CRC-32 of the concatenation of two blocks from their CRCs, as
+        crc32_combine of zlib """
+    if len2 == 0:
+        return crc1
+    matrix = _crc32_shift_matrices.get(len2)
+    if matrix is None:
+        matrix = _crc32_shift_matrix(len2)
+        _crc32_shift_matrices[len2] = matrix
+    return _gf2_matrix_times(matrix, crc1) ^ crc2
+
+def _crc32_shift_matrix(length):
+    #Operator for one zero bit, squared up to one zero byte...
+    odd = [_CRC32_POLY] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    #...and then combined for the bits of length
+    result = None
+    while length:
+        even = _gf2_matrix_square(odd)
+        odd, even = even, odd
+        if length & 1:
+            result = odd if result is None else [
+                _gf2_matrix_times(odd, column) for column in result]
+        length >>= 1
+    return result
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, column) for column in matrix]
+
+def _gf2_matrix_times(matrix, vector):
+    result = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
@@ -0,0 +1,191 @@
+""" Per-stage instrumentation of the conversions. Code marks a stage with
+
+    with stage('read_par', fname=par_fname) as st:
+        ...
+        st.add(bytes_read=n, slices=m)
+
+and every finished stage produces a record with its wall time, bytes read
+and written, slices (and slices/s), and the peak resident memory of the
+process. Records are kept in memory for write_profile (JSON) and
+write_chrome_trace (chrome://tracing / Perfetto), and passed to the
+listeners added with add_listener.
+
+Instrumentation is off by default. stage() then returns a shared no-op
+stage, so an instrumented function only pays for one function call.
+Stages are recorded per process, conversions running in batch, watch or
+serve workers are not collected.
+"""
+from __future__ import division
+import json
+import logging
+import os
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+__all__ = ['stage', 'enable', 'disable', 'is_enabled', 'add_listener',
+    'remove_listener', 'get_records', 'clear', 'get_summary',
+    'write_profile', 'write_chrome_trace']
+
+_enabled = False
+_records = []
+_listeners = []
+_lock = threading.Lock()
+_local = threading.local()
+#ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+_COUNTERS = ('bytes_read', 'bytes_written', 'slices')
+
+def stage(name, **info):
+    """ Returns a context manager that records the stage name. info is
+        stored with the record (e.g. the file name). """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, info)
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def add_listener(callback):
+    """ callback(record) is called for every finished stage, in the thread
+        that ran it. Adding a listener enables the instrumentation. """
+    with _lock:
+        _listeners.append(callback)
+    enable()
+
+def remove_listener(callback):
+    with _lock:
+        _listeners.remove(callback)
+
+def get_records():
+    with _lock:
+        return list(_records)
+
+def clear():
+    with _lock:
+        del _records[:]
+
+def get_summary(records=None):
+    """ Totals per stage name: count, seconds, counters and slices/s """
+    if records is None:
+        records = get_records()
+    summary = {}
+    for record in records:
+        total = summary.setdefault(record['name'], dict(count=0, seconds=0,
+            **dict.fromkeys(_COUNTERS, 0)))
+        total['count'] += 1
+        total['seconds'] += record['seconds']
+        for key in _COUNTERS:
+            total[key] += record[key]
+    for total in summary.values():
+        total['slices_per_s'] = _rate(total['slices'], total['seconds'])
+    return summary
+
+def write_profile(fname):
+    """ Writes the records and the per-stage summary as JSON """
+    records = get_records()
+    with open(fname, 'w') as f:
+        json.dump({'stages': records, 'summary': get_summary(records)}, f,
+            indent=2, sort_keys=True)
+
+def write_chrome_trace(fname):
+    """ Writes the records in the Chrome trace event format """
+    events = []
+    for record in get_records():
+        args = dict(record['info'])
+        for key in _COUNTERS + ('slices_per_s', 'peak_rss'):
+            args[key] = record[key]
+        events.append({
+            'name': record['name'],
+            'ph': 'X',
+            'ts': record['start'] * 1e6,
+            'dur': record['seconds'] * 1e6,
+            'pid': record['pid'],
+            'tid': record['tid'],
+            'args': args,
+        })
+    with open(fname, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def get_peak_rss():
+    """ Peak resident memory of the process in bytes, None if unknown """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+def _rate(count, seconds):
+    return count / seconds if count and seconds > 0 else None
+
+class _NullStage:
+    """ Shared stage returned while the instrumentation is disabled """
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def add(self, **counts):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    enabled = True
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.counts = dict.fromkeys(_COUNTERS, 0)
+
+    def __enter__(self):
+        self.depth = getattr(_local, 'depth', 0)
+        _local.depth = self.depth + 1
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = time.time() - self.start
+        _local.depth = self.depth
+        record = {
+            'name': self.name,
+            'info': self.info,
+            'start': self.start,
+            'seconds': seconds,
+            'depth': self.depth,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'slices_per_s': _rate(self.counts['slices'], seconds),
+            'peak_rss': get_peak_rss(),
+            'error': None if exc_type is None else repr(exc_value),
+        }
+        record.update(self.counts)
+        with _lock:
+            _records.append(record)
+            listeners = list(_listeners)
+        for callback in listeners:
+            try:
+                callback(record)
+            except Exception as e:
+                logging.getLogger('raw2nii').warning('Instrumentation '
+                    'listener failed: {0}'.format(e))
+        return False
+
+    def add(self, **counts):
+        """ Adds to the bytes_read, bytes_written and slices counters """
+        for key, val in counts.items():
+            self.counts[key] += int(val)
@@ -1,24 +1,29 @@
 from __future__ import division
-import array
 import binascii
+import io
 import itertools
 import logging
 import numpy as np
 import os
-import struct
 
 import nifti_defines
 import par_defines
 import raw2nii_version
-from NiiFile import NiiHdr, NiiHdrField, HEADER_FIELD_NAMES
+from NiiFile import HEADER_SIZE, NII_VOX_OFFSET, NiiHdr, NiiHdrField, \
+    unpack_header
+from instrument import stage
+from read_rec import REC_DTYPE_TABLE, open_rec, read_rec_slices
 
 
-__all__ = ['NiiHdr', 'NiiHdrField', 'write_nii_from_par']
+__all__ = ['NiiHdr', 'NiiHdrField', 'write_nii_from_par',
+    'repatch_nii_from_par', 'is_nii_gz', 'DEFAULT_MAX_MEMORY']
 
 #Reference for NIFTI header values can be found at:
 #http://nifti.nimh.nih.gov/pub/dist/src/niftilib/nifti1.h
-_HEADER_SIZE = 348
+_NII_EXTENSION = binascii.unhexlify('6e2b3100')
 _FILLER_CHAR = ' '  # Used to pad strings
+#Default memory budget for the slice buffers of the nifti writer
+DEFAULT_MAX_MEMORY = 256 * 2 ** 20
 _DATATYPE_TABLE = {
     8: nifti_defines.kDT_UNSIGNED_CHAR,
     16: nifti_defines.kDT_SIGNED_SHORT,
@@ -38,7 +43,7 @@ def _create_nii_header(par):
     M, realvoxsize = _calc_angulation(par, True)
     qoffset_xyz, quatern_bcd, qfac = _nifti_mat44_to_quatern(M)
     hdr = NiiHdr()
-    hdr.HdrSz = NiiHdrField(_HEADER_SIZE, 'i')
+    hdr.HdrSz = NiiHdrField(HEADER_SIZE, 'i')
     hdr.Data_Type = NiiHdrField(_FILLER_CHAR * 10, 's')
     hdr.db_name = NiiHdrField(_FILLER_CHAR * 18, 's')
     hdr.extents = NiiHdrField(0, 'i')
@@ -79,7 +84,7 @@ def _create_nii_header(par):
     hdr.slice_start = NiiHdrField(0, 'h')
     #vox_offset=352.0 means that the data starts immediately after the NIFTI-1
     #header
-    hdr.vox_offset = NiiHdrField(352, 'f')
+    hdr.vox_offset = NiiHdrField(NII_VOX_OFFSET, 'f')
     #Using a form of ternary statements here
     rs = {False: par.rescale_slope, True: 1}[hdr.multi_scaling_factors]
     ri = {False: par.rescale_interc, True: 0}[hdr.multi_scaling_factors]
@@ -263,91 +268,195 @@ def _nifti_mat44_to_quatern(A):
     quatern_bcd = np.array([b, c, d])
     return qoffset_xyz, quatern_bcd, qfac
 
-def write_nii_from_par(nii_fname, par):
-    """ Write the nifti to a file """
+def write_nii_from_par(nii_fname, par, max_memory=None, gzip_level=None,
+        gzip_jobs=None, bgzf=False):
+    """ Write the nifti to a file, gzip compressed when its name ends with
+        .nii.gz
+        max_memory : approximate number of bytes the slice buffers may use.
+                     Whole volumes are buffered when they fit, otherwise
+                     as many slices as fit (at least one).
+        gzip_level : zlib compression level of .nii.gz files (default:
+                     gzip_writer.DEFAULT_LEVEL)
+        gzip_jobs  : number of compressing threads (default: CPU count)
+        bgzf       : write .nii.gz files as BGZF blocks, with a .gzi block
+                     index next to them, instead of one gzip member
+    """
+    with stage('write_nii_from_par', fname=nii_fname) as st:
+        fd = _write_nii_from_par(nii_fname, par, max_memory, gzip_level,
+            gzip_jobs, bgzf)
+        if st.enabled and os.path.exists(nii_fname):
+            st.add(bytes_written=os.path.getsize(nii_fname),
+                slices=par.slices_sorted.shape[0])
+    return fd
+
+def _write_nii_from_par(nii_fname, par, max_memory, gzip_level, gzip_jobs,
+        bgzf):
     logger = logging.getLogger('raw2nii')
-    hdr = _create_nii_header(par)
+    with stage('create_nii_header'):
+        hdr = _create_nii_header(par)
     if par.dti_revertb0:
-        _write_dynamics_files(nii_fname, par)
+        with stage('write_dynamics_files'):
+            _write_dynamics_files(nii_fname, par)
     try:
         logger.info('Writing file: {0}...'.format(nii_fname))
         with open(nii_fname, 'wb') as fd:
-            _write_nii_header(hdr, fd)  # write header to nii binary
-            #now add 4 extra bytes in space between header and offset for data
-            #indicating that single .nii file ("n+1\0") rather than separate
-            #img/hdr files were written. see http://nifti.nimh.nih.gov
-            fd.write(bytearray(binascii.unhexlify('6e2b3100')))
-            #add remaining 0s (probably not required)
-            fd.write(bytearray([0] * (hdr.vox_offset.val - hdr.HdrSz.val - 4)))
-            #Get the datatype to actually write the slices with
-            if hdr.bitpix.val in (8, 16, 32, 64):
-                if hdr.multi_scaling_factors and hdr.bitpix.val == 32:
-                    bitpixstr = 'float32'
-                else:
-                    #Using a form of ternary statements here to prepend 'u' to
-                    #bitpixstr if datatype is present in the _UDATATYPE_TABLE
-                    u_prefix = {True: 'u', False: ''}[
-                        hdr.datatype.val == _UDATATYPE_TABLE[hdr.bitpix.val]]
-                    bitpixstr = '{0}int{1}'.format(u_prefix, hdr.bitpix.val)
-            par_dt = {8: 'b', 16: 'h', 32: 'i'}[par.bit]
-            #Read the REC file slice by slice and write to the nii right away.
-            #This significantly reduces the memory required to process the REC.
-            with open(par.rec_fname, 'rb') as rec:
-                for slicenr, sl in enumerate(par.slices_sorted):
-                    rec.seek(sl.index_in_rec_file * sl.recon_resolution_x *
-                        sl.recon_resolution_y * 2)
-                    sl_arr = array.array(par_dt)
-                    sl_arr.fromfile(rec, sl.recon_resolution_x *
-                        sl.recon_resolution_y)
-                    sl_data = np.reshape(sl_arr, (sl.recon_resolution_x,
-                        sl.recon_resolution_y)).T
-                    if par.multi_scaling_factors:
-                        sl_data = ((sl_data * sl.rescale_slope +
-                            sl.rescale_intercept) / (sl.scale_slope *
-                            sl.rescale_slope))
-                    #Flip data left-to-right for radiological order then
-                    #transpose matrix before writing to get Fortran order
-                    np.fliplr(sl_data).astype(bitpixstr).T.tofile(fd)
+            if is_nii_gz(nii_fname):
+                from gzip_writer import ParallelGzipWriter
+                index_fname = nii_fname + '.gzi' if bgzf else None
+                with ParallelGzipWriter(fd, gzip_level, gzip_jobs, bgzf,
+                        index_fname) as gz_fd:
+                    _write_nii_file(gz_fd, hdr, par, max_memory)
+            else:
+                _write_nii_file(fd, hdr, par, max_memory)
         logger.info('  ...done')
     except IOError as e:
         logger = logging.getLogger('raw2nii')
         logger.error('Write failed: {0}'.format(e))
     return fd
 
+def _write_nii_file(fd, hdr, par, max_memory):
+    _write_nii_header(hdr, fd)  # write header to nii binary
+    #Get the datatype to actually write the slices with
+    if hdr.bitpix.val in (8, 16, 32, 64):
+        if hdr.multi_scaling_factors and hdr.bitpix.val == 32:
+            bitpixstr = 'float32'
+        else:
+            #Using a form of ternary statements here to prepend 'u' to
+            #bitpixstr if datatype is present in the _UDATATYPE_TABLE
+            u_prefix = {True: 'u', False: ''}[
+                hdr.datatype.val == _UDATATYPE_TABLE[hdr.bitpix.val]]
+            bitpixstr = '{0}int{1}'.format(u_prefix, hdr.bitpix.val)
+    _write_nii_body(fd, par, bitpixstr, max_memory)
+
+def is_nii_gz(nii_fname):
+    """ True when the nifti file name is of a gzip compressed nifti """
+    return nii_fname.lower().endswith('.nii.gz')
+
+def repatch_nii_from_par(nii_fname, par):
+    """ Recomputes the header of an existing nifti from the PAR and
+        overwrites only the header bytes (up to vox_offset), leaving the
+        image data as it is. Raises ValueError when the existing file does
+        not have the dims, datatype, bitpix and vox_offset of the new header,
+        so that its data would not match it.
+        returns : True when the header was rewritten, False when it was
+                  already up to date
+    """
+    with stage('repatch_nii_from_par', fname=nii_fname):
+        return _repatch_nii_from_par(nii_fname, par)
+
+def _repatch_nii_from_par(nii_fname, par):
+    logger = logging.getLogger('raw2nii')
+    if is_nii_gz(nii_fname):
+        raise ValueError('Cannot repatch "{0}" in place: it is compressed'
+            .format(nii_fname))
+    with stage('create_nii_header'):
+        hdr = _create_nii_header(par)
+    new_header = io.BytesIO()
+    _write_nii_header(hdr, new_header)
+    new_header = new_header.getvalue()
+    with open(nii_fname, 'r+b') as fd:
+        old_header = fd.read(len(new_header))
+        if (len(old_header) < HEADER_SIZE or
+                old_header[344:348] not in (b'n+1\0', b'ni1\0')):
+            raise ValueError('"{0}" is not a NIFTI file'.format(nii_fname))
+        old = unpack_header(old_header)
+        new = unpack_header(new_header)
+        for key in ('dim', 'datatype', 'bitpix', 'vox_offset'):
+            if not np.array_equal(old[key], new[key]):
+                raise ValueError('Cannot repatch "{0}": its {1} is {2}, the '
+                    'PAR gives {3}'.format(nii_fname, key, old[key], new[key]))
+        nr_bytes = (int(np.prod(new['dim'][1:new['dim'][0] + 1])) *
+            new['bitpix'] // 8)
+        file_size = os.fstat(fd.fileno()).st_size
+        if file_size < new['vox_offset'] + nr_bytes:
+            raise ValueError('Cannot repatch "{0}": it is shorter than its '
+                'image data ({1} < {2} bytes)'.format(nii_fname, file_size,
+                int(new['vox_offset']) + nr_bytes))
+        if old_header == new_header:
+            logger.info('Header of {0} is up to date'.format(nii_fname))
+            return False
+        logger.info('Repatching header of {0}'.format(nii_fname))
+        fd.seek(0)
+        fd.write(new_header)
+    return True
+
+def _get_block_size(par, bitpixstr, max_memory):
+    """ Number of slices that are gathered, converted and written at once """
+    nr_images = par.slices_sorted.shape[0]
+    nslice = par.dim[2]
+    slice_px = par.dim[0] * par.dim[1]
+    #Every slice in a block needs room in the REC input buffer, the output
+    #buffer and, when rescaling, the float64 work buffer
+    slice_bytes = slice_px * (REC_DTYPE_TABLE[par.bit].itemsize +
+        np.dtype(bitpixstr).itemsize)
+    if par.multi_scaling_factors:
+        slice_bytes += slice_px * np.dtype(np.float64).itemsize
+    block_size = max(1, max_memory // slice_bytes)
+    #Prefer whole volumes when more than one fits
+    if block_size > nslice:
+        block_size -= block_size % nslice
+    return int(min(block_size, nr_images))
+
+def _write_nii_body(fd, par, bitpixstr, max_memory=None):
+    """ Gathers blocks of slices from the REC into reusable buffers, flips,
+        rescales and casts the whole block with vectorized operations and
+        writes each block with a single call """
+    logger = logging.getLogger('raw2nii')
+    if max_memory is None:
+        max_memory = DEFAULT_MAX_MEMORY
+    rec = open_rec(par)
+    block_size = _get_block_size(par, bitpixstr, max_memory)
+    logger.debug('Writing {0} slices per block'.format(block_size))
+    shape = (block_size, par.dim[0], par.dim[1])
+    in_buf = np.empty(shape, dtype=rec.dtype)
+    out_buf = np.empty(shape, dtype=bitpixstr)
+    if par.multi_scaling_factors:
+        work_buf = np.empty(shape, dtype=np.float64)
+    for start in range(0, par.slices_sorted.shape[0], block_size):
+        slices = par.slices_sorted[start:start + block_size]
+        n = slices.shape[0]
+        with stage('read_rec') as st:
+            data = read_rec_slices(rec, slices, out=in_buf[:n])
+            st.add(bytes_read=data.nbytes, slices=n)
+        #Flip data left-to-right for radiological order. The images are
+        #stored transposed in the REC, so this reverses the first image
+        #axis and each slice is then written out in Fortran order
+        data = data[:, ::-1, :]
+        with stage('scale_slices') as st:
+            if par.multi_scaling_factors:
+                rs = slices.rescale_slope[:, np.newaxis, np.newaxis]
+                ri = slices.rescale_intercept[:, np.newaxis, np.newaxis]
+                ss = slices.scale_slope[:, np.newaxis, np.newaxis]
+                work = work_buf[:n]
+                np.multiply(data, rs, out=work)
+                work += ri
+                work /= ss * rs
+                data = work
+            out = out_buf[:n]
+            np.copyto(out, data, casting='unsafe')
+            st.add(slices=n)
+        with stage('write_slices') as st:
+            #tofile needs a real file, a compressing writer gets the buffer
+            if hasattr(fd, 'fileno'):
+                out.tofile(fd)
+            else:
+                fd.write(out)
+            st.add(bytes_written=out.nbytes, slices=n)
+    del rec
+
 def _write_nii_header(hdr, fd):
+    """ Writes the header, the extension bytes and the padding up to
+        vox_offset with a single write """
     logger = logging.getLogger('raw2nii')
     logger.debug('Writing NHdr...')
-    for key in HEADER_FIELD_NAMES:
-        hdrfield = getattr(hdr, key)
-        prec = hdrfield.prec
-        val = hdrfield.val
-        if not isinstance(val, np.ndarray):  # If writing simple value
-            if prec == 's':  # Writing a string
-                packed = val
-                #logger.debug("Field {0}[{1}] (prec={2}, val='{3}', "
-                #    "packed string='{4}')".format(key, fd.tell(), prec,
-                #    val, packed))
-                fd.write(packed)
-            else:
-                packed = struct.pack(prec, val)
-                #logger.debug("Field {0}[{1}] (prec={2}, val='{3}', "
-                #    "packed bytes='{4}')".format(key, fd.tell(), prec,
-                #    val, binascii.hexlify(packed)))
-                fd.write(packed)
-        else: # If writing array
-            if len(val.shape) == 1:  # If 1D array
-                packed = struct.pack(prec * len(val), *list(val))
-                #logger.debug("Field {0}[{1}] (prec={2}, val='{3}', "
-                #    "packed array='{4}')".format(key, fd.tell(), prec,
-                #    val, binascii.hexlify(packed)))
-                fd.write(packed)
-            else:
-                #Transpose matrix before writing to get Fortran order
-                packed = val.astype(prec).T
-                #logger.debug("Field {0}[{1}] (prec={2}, val='{3}', "
-                #    "packed matrix='{4}')".format(key, fd.tell(), prec,
-                #    val, binascii.hexlify(packed.tobytes())))
-                packed.tofile(fd)
+    header = bytearray(int(hdr.vox_offset.val))
+    header[:hdr.HdrSz.val] = hdr.tobytes()
+    #Add 4 extra bytes in space between header and offset for data
+    #indicating that single .nii file ("n+1\0") rather than separate
+    #img/hdr files were written. see http://nifti.nimh.nih.gov
+    #The remaining bytes up to vox_offset are 0s (probably not required)
+    header[hdr.HdrSz.val:hdr.HdrSz.val + 4] = _NII_EXTENSION
+    fd.write(header)
 
 def _write_dynamics_files(nii_fname, par):
     logger = logging.getLogger('raw2nii')
@@ -398,6 +507,8 @@ def _write_dynamics_files(nii_fname, par):
         par.slices_sorted[:-nslice])).view(np.recarray)
     
     name, ext = os.path.splitext(nii_fname)
+    if is_nii_gz(nii_fname):
+        name, ext = os.path.splitext(name)
     bval_filename = name + '-x-bval.txt'
     bvec_filename = name + '-x-bvec.txt'
     try:
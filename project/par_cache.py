@@ -0,0 +1,151 @@
+""" Persistent cache of parsed PAR files. The parsed general info, the slice
+table definition, the slice table and its sort order are stored as one
+binary .npz sidecar per PAR file in a cache directory, so converting the
+same exam again does not need to parse the text PAR.
+
+Entries are keyed by the PAR path, size, mtime and a hash of its contents.
+The directory is kept under a size cap by evicting the least recently used
+entries.
+"""
+from __future__ import division
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import tempfile
+
+
+__all__ = ['get_cache_key', 'load_par_cache', 'store_par_cache',
+    'DEFAULT_CACHE_SIZE']
+
+#Default size cap of the cache directory in bytes
+DEFAULT_CACHE_SIZE = 2 ** 30
+#Bumped whenever the layout of the stored entries changes
+_CACHE_VERSION = 1
+_CACHE_EXT = '.npz'
+_HASH_CHUNK_SIZE = 2 ** 20
+
+def get_cache_key(par_fname):
+    """ Returns the cache key of a PAR file from its absolute path, size,
+        mtime and content hash """
+    st = os.stat(par_fname)
+    content_hash = hashlib.sha1()
+    with open(par_fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    key = '\0'.join((os.path.abspath(par_fname), str(st.st_size),
+        repr(st.st_mtime), content_hash.hexdigest()))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def load_par_cache(cache_dir, key):
+    """ Returns a dict with the version, gen_info, fields, slices and
+        sort_index stored for key, or None if there is no valid entry """
+    logger = logging.getLogger('raw2nii')
+    entry_fname = _get_entry_fname(cache_dir, key)
+    if not os.path.exists(entry_fname):
+        return None
+    try:
+        with np.load(entry_fname) as npz:
+            meta = json.loads(npz['meta'].item())
+            if meta['cache_version'] != _CACHE_VERSION:
+                raise ValueError('Cache version {0} is not {1}'.format(
+                    meta['cache_version'], _CACHE_VERSION))
+            entry = {
+                'version': _decode_value(meta['version']),
+                'gen_info': dict((key, _decode_value(val))
+                    for key, val in meta['gen_info'].items()),
+                'fields': [(str(name), np.dtype(type_name).type)
+                    for name, type_name in meta['fields']],
+                'slices': npz['slices'].view(np.recarray),
+                'sort_index': npz['sort_index'],
+            }
+    except Exception as e:
+        logger.warning('Discarding invalid PAR cache entry "{0}": {1}'.format(
+            entry_fname, e))
+        _remove(entry_fname)
+        return None
+    #Touch the entry so that eviction keeps recently used entries
+    try:
+        os.utime(entry_fname, None)
+    except OSError:
+        pass
+    logger.debug('Loaded PAR cache entry "{0}"'.format(entry_fname))
+    return entry
+
+def store_par_cache(cache_dir, key, par, gen_info, cache_size=None):
+    """ Stores the parsed par under key. gen_info is a dict of the general
+        info as parsed, before any of the checks adjusted it. """
+    logger = logging.getLogger('raw2nii')
+    if cache_size is None:
+        cache_size = DEFAULT_CACHE_SIZE
+    meta = {
+        'cache_version': _CACHE_VERSION,
+        'version': _encode_value(par.version),
+        'gen_info': dict((key, _encode_value(val))
+            for key, val in gen_info.items()),
+        'fields': [(name, np.dtype(type_code).name)
+            for name, type_code in par.fields],
+    }
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        #Write to a temporary file first so that readers never see a
+        #partial entry
+        fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)),
+                slices=par.slices.view(np.ndarray), sort_index=par.sort_index)
+        os.rename(tmp_fname, _get_entry_fname(cache_dir, key))
+    except (IOError, OSError) as e:
+        logger.warning('Failed to write PAR cache entry for "{0}": {1}'.format(
+            par.par_fname, e))
+        return
+    _evict(cache_dir, cache_size)
+
+def _evict(cache_dir, cache_size):
+    """ Removes the least recently used entries until the cache directory is
+        no larger than cache_size """
+    logger = logging.getLogger('raw2nii')
+    entries = []
+    for fname in os.listdir(cache_dir):
+        if not fname.endswith(_CACHE_EXT):
+            continue
+        path = os.path.join(cache_dir, fname)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= cache_size:
+            break
+        logger.debug('Evicting PAR cache entry "{0}"'.format(path))
+        _remove(path)
+        total -= size
+
+def _get_entry_fname(cache_dir, key):
+    return os.path.join(cache_dir, key + _CACHE_EXT)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _encode_value(val):
+    """ Makes a gen_info value JSON serializable. Strings are kept as latin-1
+        so that arbitrary bytes in e.g. patient names survive. """
+    if isinstance(val, np.ndarray):
+        return {'array': val.tolist()}
+    elif isinstance(val, bytes):
+        return {'bytes': val.decode('latin-1')}
+    return val
+
+def _decode_value(val):
+    if isinstance(val, dict):
+        if 'array' in val:
+            return np.array(val['array'])
+        return val['bytes'].encode('latin-1')
+    return val
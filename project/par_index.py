@@ -0,0 +1,197 @@
+""" SQLite catalog of the PAR/REC files in a directory tree. Each PAR header
+is read with read_par(lazy=True), so building the catalog never loads a
+slice table or touches the REC data. Re-running update_index only parses
+PAR files that are new, whose PAR or REC mtime changed or that could not be
+read before, and drops rows of files that disappeared.
+
+function update_index
+    root_dir: directory that is searched recursively for PAR files
+    db_fname: SQLite file the catalog is written to
+    jobs: number of processes reading PAR headers (default: CPU count)
+returns:
+    (number of parsed files, number of removed rows, number of unchanged)
+"""
+from __future__ import division
+import logging
+import multiprocessing
+import numpy as np
+import os
+import re
+import sqlite3
+import sys
+
+from read_par import get_rec_fname, read_par
+
+
+__all__ = ['update_index', 'DEFAULT_INDEX_NAME']
+
+DEFAULT_INDEX_NAME = 'raw2nii_index.sqlite'
+_COLUMNS = (
+    ('par_fname', 'TEXT PRIMARY KEY'),
+    ('par_mtime', 'REAL'),
+    ('par_size', 'INTEGER'),
+    ('rec_fname', 'TEXT'),
+    ('rec_mtime', 'REAL'),
+    ('rec_size', 'INTEGER'),
+    ('version', 'TEXT'),
+    ('protocol_name', 'TEXT'),
+    ('series_type', 'TEXT'),
+    ('technique', 'TEXT'),
+    ('scan_mode', 'TEXT'),
+    ('acquisition_nr', 'INTEGER'),
+    ('dim_x', 'INTEGER'),
+    ('dim_y', 'INTEGER'),
+    ('dim_z', 'INTEGER'),
+    ('nr_dynamics', 'INTEGER'),
+    ('nr_echoes', 'INTEGER'),
+    ('nr_cardiac_phases', 'INTEGER'),
+    ('nr_bvalues', 'INTEGER'),
+    ('nr_grad_orients', 'INTEGER'),
+    ('pixel_size', 'INTEGER'),
+    ('slice_orientation', 'INTEGER'),
+    ('diffusion', 'INTEGER'),
+    ('rt', 'REAL'),
+    ('error', 'TEXT'),
+)
+_CREATE_TABLE = 'CREATE TABLE IF NOT EXISTS parrec ({0})'.format(', '.join(
+    '{0} {1}'.format(name, decl) for name, decl in _COLUMNS))
+_INSERT_ROW = 'INSERT OR REPLACE INTO parrec VALUES ({0})'.format(', '.join(
+    '?' * len(_COLUMNS)))
+#Rows are committed in batches so that an interrupted scan keeps its work
+_COMMIT_EVERY = 1000
+
+def update_index(root_dir, db_fname, jobs=None):
+    logger = logging.getLogger('raw2nii')
+    conn = sqlite3.connect(db_fname)
+    try:
+        conn.execute(_CREATE_TABLE)
+        #Rows with an error are read again, the files may be complete now
+        known = dict((key, None if error else (par_mtime, rec_mtime))
+            for key, par_mtime, rec_mtime, error in conn.execute(
+            'SELECT par_fname, par_mtime, rec_mtime, error FROM parrec'))
+        found = {}
+        stale = []
+        unchanged = 0
+        for par_fname in _find_par_files(root_dir):
+            mtimes = _get_mtimes(par_fname)
+            if mtimes is None:
+                #Removed since it was listed
+                continue
+            key = _to_text(par_fname)
+            found[key] = par_fname
+            if known.get(key) == mtimes:
+                unchanged += 1
+            else:
+                stale.append(par_fname)
+        removed = [key for key in known if key not in found]
+        logger.info('Indexing {0}: {1} new or changed, {2} removed, {3} '
+            'unchanged PAR files'.format(root_dir, len(stale), len(removed),
+            unchanged))
+        conn.executemany('DELETE FROM parrec WHERE par_fname = ?',
+            ((key,) for key in removed))
+        if jobs == 1 or len(stale) < 2:
+            rows = (_read_index_row(par_fname) for par_fname in stale)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(jobs)
+            rows = pool.imap_unordered(_read_index_row, stale, chunksize=16)
+        try:
+            for i, row in enumerate(rows):
+                conn.execute(_INSERT_ROW, row)
+                if (i + 1) % _COMMIT_EVERY == 0:
+                    conn.commit()
+                    logger.info('  ...{0} of {1}'.format(i + 1, len(stale)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        conn.commit()
+    finally:
+        conn.close()
+    return len(stale), len(removed), unchanged
+
+def _find_par_files(root_dir):
+    for dirpath, dirnames, filenames in os.walk(os.path.abspath(root_dir)):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if re.search(r'\.par$', fname, re.I):
+                yield os.path.join(dirpath, fname)
+
+def _get_mtimes(par_fname):
+    """ Returns the mtimes of the PAR and its REC (None if missing), or
+        None if the PAR file is missing """
+    try:
+        par_mtime = os.path.getmtime(par_fname)
+    except OSError:
+        return None
+    rec_fname = get_rec_fname(par_fname)
+    try:
+        rec_mtime = os.path.getmtime(rec_fname)
+    except OSError:
+        rec_mtime = None
+    return par_mtime, rec_mtime
+
+def _read_index_row(par_fname):
+    """ Reads the header of one PAR file into a catalog row. Runs in the
+        worker processes, so errors are recorded in the row instead of being
+        raised. """
+    logger = logging.getLogger('raw2nii')
+    row = dict.fromkeys(name for name, decl in _COLUMNS)
+    row['par_fname'] = _to_text(par_fname)
+    rec_fname = get_rec_fname(par_fname)
+    row['rec_fname'] = _to_text(rec_fname)
+    try:
+        st = os.stat(par_fname)
+        row['par_mtime'] = st.st_mtime
+        row['par_size'] = st.st_size
+        if os.path.exists(rec_fname):
+            st = os.stat(rec_fname)
+            row['rec_mtime'] = st.st_mtime
+            row['rec_size'] = st.st_size
+        par = read_par(par_fname, rec_fname, lazy=True)
+        if par.problem_reading:
+            raise IOError('Failed to read PAR file')
+        gen_info = par.gen_info
+        row['version'] = _to_text(par.version)
+        row['protocol_name'] = _to_text(getattr(gen_info, 'protocol_name',
+            None))
+        row['series_type'] = _to_text(getattr(gen_info, 'series_type', None))
+        row['technique'] = _to_text(getattr(gen_info, 'technique', None))
+        row['scan_mode'] = _to_text(getattr(gen_info, 'scan_mode', None))
+        row['acquisition_nr'] = _to_int(getattr(gen_info, 'acquisition_nr',
+            None))
+        row['nr_dynamics'] = _to_int(getattr(gen_info,
+            'max_number_of_dynamics', None))
+        row['nr_echoes'] = _to_int(getattr(gen_info, 'max_number_of_echoes',
+            None))
+        row['nr_cardiac_phases'] = _to_int(getattr(gen_info,
+            'max_number_of_cardiac_phases', None))
+        row['nr_bvalues'] = _to_int(getattr(gen_info,
+            'max_number_of_diffusion_values', None))
+        row['nr_grad_orients'] = _to_int(getattr(gen_info,
+            'max_number_of_gradient_orients', None))
+        row['diffusion'] = _to_int(getattr(gen_info, 'diffusion', None))
+        if par.version in ('V4', 'V4.1', 'V4.2'):
+            row['dim_x'], row['dim_y'], row['dim_z'] = (int(x)
+                for x in par.dim)
+            row['pixel_size'] = int(par.bit)
+            row['slice_orientation'] = int(par.sliceorient)
+            if not np.isnan(par.RT):
+                row['rt'] = float(par.RT)
+    except Exception as e:
+        logger.warning('Failed to index "{0}": {1}'.format(par_fname, e))
+        row['error'] = _to_text(str(e))
+    return tuple(row[name] for name, decl in _COLUMNS)
+
+def _to_text(val):
+    """ sqlite3 only accepts text, so byte strings (e.g. Python 2 paths and
+        header values) are decoded """
+    if isinstance(val, bytes):
+        return val.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+    return val
+
+def _to_int(val):
+    try:
+        return int(val)
+    except (TypeError, ValueError):
+        return None
@@ -2,40 +2,83 @@
 from __future__ import division
 import argparse
 import logging
-import numpy as np
 import os
 import re
 import sys
 
-from nii import write_nii_from_par
-from write_parrec_from_dicom import write_parrec_from_dicom
-from read_dicom import read_dicom
-from read_par import read_par
+#The conversion modules are imported inside the converters, so that a run
+#only pays for the modules of its own conversion (e.g. PAR -> NIfTI never
+#imports nibabel or the DICOM -> PAR tables)
 
+#Maps memory size suffixes -> number of bytes
+_MEMORY_SIZE_SUFFIXES = {
+    '': 1,
+    'K': 2 ** 10,
+    'M': 2 ** 20,
+    'G': 2 ** 30,
+    'T': 2 ** 40,
+}
+
+#Maps file extensions -> file format
+_EXT_FORMATS = {
+    '.dcm': 'dcm',
+    '.par': 'par',
+    '.nii': 'nii',
+    '.nii.gz': 'nii',
+}
+#Number of bytes read from the start of a file to sniff its format
+_SNIFF_SIZE = 348
 
 def raw_convert(input_file, output_file, **options):
     logger = logging.getLogger('raw2nii')
-    #Convert from DCM to PAR
-    if re.search('.dcm$', input_file, re.I) and re.search('.par$', output_file,
-            re.I):
-        return convert_dcm2par(input_file, output_file, **options)
-    #Convert from PAR to NII
-    if re.search('.par$', input_file, re.I) and re.search('.nii$', output_file,
-            re.I):
-        return convert_par2nii(input_file, output_file, **options)
-    #Error
-    logger.error('Conversion not supported')
-
-def _get_rec_fname(par_fname):
-    rec_fname, ext = os.path.splitext(par_fname)
-    if '.par' == ext:
-        rec_fname += '.rec'
-    elif '.PAR' == ext:
-        rec_fname += '.REC'
-    return rec_fname
+    input_format = sniff_file_format(input_file)
+    output_format = get_file_format(output_file)
+    try:
+        converter = _CONVERTERS[input_format, output_format]
+    except KeyError:
+        logger.error('Conversion not supported: {0} -> {1}'.format(
+            input_format, output_format))
+        return 1
+    return converter(input_file, output_file, **options)
+
+def register_converter(input_format, output_format, converter):
+    """ Registers converter(input_file, output_file, **options) for a pair
+        of formats. Converters should import their modules lazily. """
+    _CONVERTERS[input_format, output_format] = converter
+
+def get_file_format(fname):
+    """ Returns the format of a file name from its extension, or None """
+    name, ext = os.path.splitext(fname.lower())
+    if ext == '.gz':
+        ext = os.path.splitext(name)[1] + ext
+    return _EXT_FORMATS.get(ext)
+
+def sniff_file_format(fname):
+    """ Returns the format of an existing file from its magic bytes: DICM at
+        byte 128 (DICOM), the PAR header line or the NIfTI-1 magic at byte
+        344. Falls back to the file extension. A directory is read as a
+        series of single-frame DICOM files and an SQLite file as a catalog
+        of raw2nii dicom-scan. """
+    if os.path.isdir(fname):
+        return 'dcm'
+    try:
+        with open(fname, 'rb') as f:
+            head = f.read(_SNIFF_SIZE)
+    except (IOError, OSError):
+        return get_file_format(fname)
+    if head[128:132] == b'DICM':
+        return 'dcm'
+    if head.startswith(b'SQLite format 3\0'):
+        return 'dcm'
+    if head.startswith(b'# === DATA DESCRIPTION FILE'):
+        return 'par'
+    if head[344:348] in (b'n+1\0', b'ni1\0'):
+        return 'nii'
+    return get_file_format(fname)
 
 def convert_par2nii(par_fname, nii_fname, no_angulation, no_rescale,
-        dti_revertb0):
+        dti_revertb0, max_memory=None, par_cache=None, par_cache_size=None,
+        gzip_level=None, gzip_jobs=None, bgzf=False, **options):
     """
         no_angulation   : when True: do NOT include affine transformation as defined in PAR
                        file in hdr part of Nifti file (nifti only, EXPERIMENTAL!)
@@ -44,15 +87,50 @@ def convert_par2nii(par_fname, nii_fname, no_angulation, no_rescale,
         dti_revertb0 : when False (default), philips ordering is used for DTI data
                        (eg b0 image last). When True, b0 is saved as first image
                        in 3D or 4D data
+        max_memory   : approximate number of bytes the nifti writer may use
+                       to buffer slices (default: nii.DEFAULT_MAX_MEMORY)
+        par_cache    : directory of the persistent parsed-PAR cache, or None
+                       to always parse the PAR file
+        par_cache_size : size cap of the cache directory in bytes (default:
+                       par_cache.DEFAULT_CACHE_SIZE)
+        gzip_level   : compression level of .nii.gz output (default:
+                       gzip_writer.DEFAULT_LEVEL)
+        gzip_jobs    : number of threads compressing .nii.gz output
+                       (default: number of CPUs)
+        bgzf         : write .nii.gz output as BGZF blocks with a .gzi
+                       index, for random access
     """
+    from read_par import get_rec_fname, read_par
     logger = logging.getLogger('raw2nii')
-    rec_fname = _get_rec_fname(par_fname)
+    rec_fname = get_rec_fname(par_fname)
     #extract the bval and bvec from the PAR file
-    par = read_par(par_fname, rec_fname)
+    par = read_par(par_fname, rec_fname, cache_dir=par_cache,
+        cache_size=par_cache_size)
     if par.problem_reading:
         logger.warning('Skipping volume {0} because of reading errors.'
             .format(par_fname))
         return 1
+    return _write_nii(nii_fname, par, no_angulation, no_rescale, max_memory,
+        gzip_level, gzip_jobs, bgzf)
+
+def convert_dcm2nii(dcm_fname, nii_fname, no_angulation, no_rescale,
+        dti_revertb0, max_memory=None, series_uid=None, gzip_level=None,
+        gzip_jobs=None, bgzf=False, **options):
+    """ Converts a DICOM file to NIfTI without an intermediate PAR/REC: the
+        PARFile is built from the DICOM frame table and the images are read
+        from the DICOM pixel data. The options are those of convert_par2nii
+        and convert_dcm2par.
+    """
+    from read_par import read_par_from_dicom
+    dcm = _read_dicom_input(dcm_fname, series_uid)
+    par = read_par_from_dicom(dcm)
+    return _write_nii(nii_fname, par, no_angulation, no_rescale, max_memory,
+        gzip_level, gzip_jobs, bgzf)
+
+def _write_nii(nii_fname, par, no_angulation, no_rescale, max_memory,
+        gzip_level, gzip_jobs, bgzf):
+    from nii import write_nii_from_par
+    logger = logging.getLogger('raw2nii')
     if 'V3' == par.version:
         raise NotImplementedError
     elif par.version in ('V4', 'V4.1', 'V4.2'):
@@ -66,20 +144,88 @@ def convert_par2nii(par_fname, nii_fname, no_angulation, no_rescale,
             logger.warning('Assuming rescaling parameters (see PAR-file) '
                 'are identical for all slices in volume and all scans in '
                 '(4D) volume!')
-        write_nii_from_par(nii_fname, par)
+        write_nii_from_par(nii_fname, par, max_memory, gzip_level, gzip_jobs,
+            bgzf)
     else:
         logger.warning('Sorry, but data format extracted using Philips '
             'Research File format {0} was not known at the time the '
             'raw2nii software was developed'.format(par.version))
     return 0
 
-def convert_dcm2par(dcm_fname, par_fname, **options):
+def convert_dcm2par(dcm_fname, par_fname, series_uid=None, **options):
+    """
+        dcm_fname    : enhanced multi-frame DICOM file, a directory of
+                       single-frame DICOM files or a raw2nii dicom-scan
+                       catalog
+        series_uid   : SeriesInstanceUID of the series to convert when the
+                       directory holds more than one series, or from the
+                       catalog
+    """
+    from read_par import get_rec_fname
+    from write_parrec_from_dicom import write_parrec_from_dicom
     logger = logging.getLogger('raw2nii')
-    dcm = read_dicom(dcm_fname)
-    rec_fname = _get_rec_fname(par_fname)
+    dcm = _read_dicom_input(dcm_fname, series_uid)
+    rec_fname = get_rec_fname(par_fname)
     write_parrec_from_dicom(par_fname, rec_fname, dcm)
     return 0
 
+def repatch(input_file, nii_fname, par_cache=None, par_cache_size=None,
+        series_uid=None, **options):
+    """ Recomputes the header of an existing NIfTI from its PAR (or DICOM)
+        input and overwrites only the header, not the image data. The
+        options are those of convert_par2nii and convert_dcm2nii; only the
+        ones that read the input are used.
+        returns : True when the header was rewritten, False when it was
+                  already up to date. Raises ValueError when the dims,
+                  datatype or vox_offset of the file do not match.
+    """
+    from nii import repatch_nii_from_par
+    from read_par import get_rec_fname, read_par, read_par_from_dicom
+    input_format = sniff_file_format(input_file)
+    if input_format == 'par':
+        par = read_par(input_file, get_rec_fname(input_file),
+            cache_dir=par_cache, cache_size=par_cache_size)
+        if par.problem_reading:
+            raise ValueError('Failed to read "{0}"'.format(input_file))
+    elif input_format == 'dcm':
+        par = read_par_from_dicom(_read_dicom_input(input_file, series_uid))
+    else:
+        raise ValueError('Cannot repatch from a {0} file'.format(
+            input_format))
+    return repatch_nii_from_par(nii_fname, par)
+
+def _read_dicom_input(dcm_fname, series_uid):
+    from dicom_catalog import get_series_files, is_dicom_catalog
+    from read_dicom import read_dicom, read_dicom_files, read_dicom_series
+    if os.path.isdir(dcm_fname):
+        return read_dicom_series(dcm_fname, series_uid)
+    if is_dicom_catalog(dcm_fname):
+        if series_uid is None:
+            raise ValueError('Pick the series to convert from the catalog '
+                'with --series')
+        #Only the headers of the files of this series are read
+        fnames = get_series_files(dcm_fname, series_uid)
+        if len(fnames) == 1:
+            return read_dicom(fnames[0])
+        return read_dicom_files(fnames)
+    return read_dicom(dcm_fname)
+
+#Maps (input format, output format) -> conversion function
+_CONVERTERS = {
+    ('dcm', 'nii'): convert_dcm2nii,
+    ('dcm', 'par'): convert_dcm2par,
+    ('par', 'nii'): convert_par2nii,
+}
+
+def parse_memory_size(size):
+    """ Converts a memory size such as '512M' or '2G' to a number of bytes """
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', size, re.I)
+    if not m:
+        raise argparse.ArgumentTypeError('Invalid memory size: {0}'.format(
+            size))
+    number, suffix = m.group(1, 2)
+    return int(float(number) * _MEMORY_SIZE_SUFFIXES[suffix.upper()])
+
 def _generate_filename(sl):
     if nr_dyn > 1:
         dyn_suffix = '-{0:04d}'.format(
@@ -126,6 +272,323 @@ def _generate_filename(sl):
         bval_suffix = ''
         bval_ndsuffix = ''
 
+def _add_convert_arguments(parser):
+    """ Adds the options shared by all commands that convert files """
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument('--no-rescale', action='store_false')
+    parser.add_argument('--no-angulation', action='store_false')
+    parser.add_argument('--dti_revertb0', action='store_true')
+    parser.add_argument('--max-memory', type=parse_memory_size, default=None,
+        help='memory budget for buffering slices while writing, e.g. 512M '
+        'or 4G')
+    parser.add_argument('--par-cache', metavar='DIR', default=None,
+        help='reuse parsed PAR files cached in this directory')
+    parser.add_argument('--par-cache-size', type=parse_memory_size,
+        default=None, help='size cap of the PAR cache directory, e.g. 1G')
+    parser.add_argument('--series', metavar='UID', dest='series_uid',
+        default=None,
+        help='SeriesInstanceUID to convert from a directory of DICOM '
+        'files')
+    parser.add_argument('--gzip-level', type=int, choices=range(10),
+        metavar='0-9', default=None,
+        help='compression level of .nii.gz output (default: 6)')
+    parser.add_argument('--gzip-jobs', type=int, default=None,
+        help='number of threads compressing .nii.gz output (default: number '
+        'of CPUs)')
+    parser.add_argument('--bgzf', action='store_true',
+        help='write .nii.gz output as BGZF blocks with a .gzi index, for '
+        'random access')
+
+def _get_convert_options(options):
+    """ Returns the raw_convert keyword arguments of parsed options """
+    return {
+        'no_rescale': options.no_rescale,
+        'no_angulation': options.no_angulation,
+        'dti_revertb0': options.dti_revertb0,
+        'max_memory': options.max_memory,
+        'par_cache': options.par_cache,
+        'par_cache_size': options.par_cache_size,
+        'series_uid': options.series_uid,
+        'gzip_level': options.gzip_level,
+        'gzip_jobs': options.gzip_jobs,
+        'bgzf': options.bgzf,
+    }
+
+def _batch_main(argv):
+    """ raw2nii batch <input>...: converts many files in a process pool """
+    import json
+    import time
+    from batch import find_inputs, make_jobs, run_batch, summarize
+    logger = logging.getLogger('raw2nii')
+    parser = argparse.ArgumentParser(prog='raw2nii batch',
+        description='Convert many PAR (-> nii) or DICOM (-> PAR) files in '
+        'parallel, largest first.')
+    _add_convert_arguments(parser)
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--timeout', type=float, default=None,
+        help='maximum number of seconds per file')
+    parser.add_argument('--output-dir', '-o', default=None,
+        help='directory the outputs are written to (default: next to the '
+        'inputs)')
+    parser.add_argument('--list', metavar='FILE', default=None,
+        help='file with one input file per line')
+    parser.add_argument('--summary', metavar='FILE', default=None,
+        help='write per-file status and throughput as JSON')
+    parser.add_argument('inputs', nargs='*',
+        help='input files, directories or glob patterns')
+    options = parser.parse_args(argv)
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    input_fnames = find_inputs(options.inputs, options.list)
+    if not input_fnames:
+        logger.error('No input files found')
+        return 1
+    if options.output_dir is not None and not os.path.isdir(
+            options.output_dir):
+        os.makedirs(options.output_dir)
+    jobs = make_jobs(input_fnames, options.output_dir)
+    start = time.time()
+    results = run_batch(jobs, _get_convert_options(options), options.jobs,
+        options.timeout)
+    summary = summarize(results, time.time() - start)
+    logger.info('Converted {0} files in {1:.1f} s ({2:.1f} MB/s): {3}'.format(
+        summary['jobs'], summary['wall_time'], summary['mb_per_s'] or 0,
+        ', '.join('{0} {1}'.format(nr, status)
+        for status, nr in sorted(summary['statuses'].items()))))
+    if options.summary is not None:
+        with open(options.summary, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    return 0 if summary['statuses'].get('ok', 0) == len(results) else 1
+
+def _watch_main(argv):
+    """ raw2nii watch <dir>: converts PAR/REC pairs as they arrive """
+    import signal
+    from watch import DEFAULT_STATE_NAME, watch
+    logger = logging.getLogger('raw2nii')
+    parser = argparse.ArgumentParser(prog='raw2nii watch',
+        description='Watch a directory tree and convert PAR/REC pairs once '
+        'they have been completely written.')
+    _add_convert_arguments(parser)
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--timeout', type=float, default=None,
+        help='maximum number of seconds per conversion')
+    parser.add_argument('--output-dir', '-o', default=None,
+        help='directory the outputs are written to (default: next to the '
+        'inputs)')
+    parser.add_argument('--state', metavar='FILE', default=None,
+        help='state file of converted pairs (default: {0} in the output '
+        'directory)'.format(DEFAULT_STATE_NAME))
+    parser.add_argument('--interval', type=float, default=5,
+        help='maximum number of seconds between scans')
+    parser.add_argument('--settle', type=float, default=2,
+        help='number of seconds file sizes must be stable before converting')
+    parser.add_argument('watch_dir', type=str)
+    options = parser.parse_args(argv)
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    if options.output_dir is not None and not os.path.isdir(
+            options.output_dir):
+        os.makedirs(options.output_dir)
+    #Stop cleanly (finishing the state file) when the service is stopped
+    def _terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        watch(options.watch_dir, _get_convert_options(options),
+            options.output_dir, options.state, options.jobs, options.timeout,
+            options.interval, options.settle)
+    except KeyboardInterrupt:
+        logger.info('Stopped watching {0}'.format(options.watch_dir))
+    return 0
+
+def _serve_main(argv):
+    """ raw2nii serve: runs the conversion server on a Unix socket """
+    import signal
+    from server import default_socket_fname, serve
+    logger = logging.getLogger('raw2nii')
+    parser = argparse.ArgumentParser(prog='raw2nii serve',
+        description='Keep warm conversion workers behind a Unix socket.')
+    _add_convert_arguments(parser)
+    parser.add_argument('--socket', default=None, help='socket path '
+        '(default: {0})'.format(default_socket_fname()))
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--timeout', type=float, default=None,
+        help='maximum number of seconds per conversion')
+    options = parser.parse_args(argv)
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    def _terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        serve(options.socket, _get_convert_options(options), options.jobs,
+            options.timeout)
+    except KeyboardInterrupt:
+        logger.info('Server stopped')
+    return 0
+
+def _client_main(argv):
+    """ raw2nii client: sends a request to a running raw2nii serve """
+    import json
+    from server import request
+    logger = logging.getLogger('raw2nii')
+    parser = argparse.ArgumentParser(prog='raw2nii client',
+        description='Convert a file with a running raw2nii server, or query '
+        'its statistics.')
+    _add_convert_arguments(parser)
+    parser.add_argument('--socket', default=None,
+        help='socket path of the server')
+    parser.add_argument('--stats', action='store_true',
+        help='print the request counters and latency histogram')
+    parser.add_argument('input_file', type=str, nargs='?')
+    parser.add_argument('output_file', type=str, nargs='?')
+    options = parser.parse_args(argv)
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    if options.stats:
+        message = {'op': 'stats'}
+    elif options.input_file and options.output_file:
+        #Only the options given on the command line, the others are left to
+        #the options of the server
+        convert_options = dict((key, val) for key, val in
+            _get_convert_options(options).items()
+            if val != parser.get_default(key))
+        if 'par_cache' in convert_options:
+            convert_options['par_cache'] = os.path.abspath(
+                convert_options['par_cache'])
+        message = {
+            'op': 'convert',
+            'input_file': os.path.abspath(options.input_file),
+            'output_file': os.path.abspath(options.output_file),
+            'options': convert_options,
+        }
+    else:
+        parser.error('input_file and output_file are required')
+    response = {}
+    for response in request(message, options.socket):
+        if options.stats:
+            print(json.dumps(response, indent=2, sort_keys=True))
+        elif response['status'] == 'accepted':
+            logger.info('Request {0} accepted'.format(response['id']))
+        elif response['status'] == 'error' and 'input_file' not in response:
+            #The server rejected the request itself
+            logger.error('Request failed: {0}'.format(response['error']))
+            return 1
+        else:
+            logger.info('{0}: {1} ({2:.2f} s)'.format(response['status'],
+                response['input_file'], response['seconds']))
+            if response['error']:
+                logger.error(response['error'])
+    return 0 if response.get('status') == 'ok' else 1
+
+def _index_main(argv):
+    """ raw2nii index <dir>: catalogs the PAR/REC files below a directory """
+    from par_index import DEFAULT_INDEX_NAME, update_index
+    parser = argparse.ArgumentParser(prog='raw2nii index',
+        description='Write a SQLite catalog of the PAR/REC files below a '
+        'directory. Re-running only parses files whose mtime changed.')
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument('--db', default=None, help='catalog file (default: '
+        '{0} in root_dir)'.format(DEFAULT_INDEX_NAME))
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+        help='number of parallel PAR readers (default: number of CPUs)')
+    parser.add_argument('root_dir', type=str)
+    options = parser.parse_args(argv)
+    if options.debug:
+        logging.getLogger('raw2nii').setLevel(logging.DEBUG)
+    db_fname = options.db or os.path.join(options.root_dir,
+        DEFAULT_INDEX_NAME)
+    update_index(options.root_dir, db_fname, options.jobs)
+    return 0
+
+def _dicom_scan_main(argv):
+    """ raw2nii dicom-scan <dir>: catalogs the DICOM series below a
+        directory """
+    from dicom_catalog import DEFAULT_CATALOG_NAME, list_series, \
+        update_catalog
+    parser = argparse.ArgumentParser(prog='raw2nii dicom-scan',
+        description='Write a nibabel.dft SQLite catalog of the DICOM studies '
+        'and series below a directory and list its series. Re-running only '
+        'reads the headers of files whose mtime changed. Convert a series '
+        'with: raw2nii <catalog> <output> --series <uid>')
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument('--db', default=None, help='catalog file (default: '
+        '{0} in root_dir)'.format(DEFAULT_CATALOG_NAME))
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+        help='number of threads reading headers (default: number of CPUs)')
+    parser.add_argument('root_dir', type=str)
+    options = parser.parse_args(argv)
+    if options.debug:
+        logging.getLogger('raw2nii').setLevel(logging.DEBUG)
+    db_fname = options.db or os.path.join(options.root_dir,
+        DEFAULT_CATALOG_NAME)
+    update_catalog(options.root_dir, db_fname, options.jobs)
+    for series in list_series(db_fname):
+        print('{series_uid}  {series_number:>4}  {description:<24}  '
+            '{columns}x{rows}  {images:>6} images  {patient_name} '
+            '{study_date}'.format(**series))
+    return 0
+
+def _repatch_main(argv):
+    """ raw2nii repatch <input>...: rewrites the headers of existing NIfTI
+        outputs """
+    from batch import find_inputs, make_jobs
+    logger = logging.getLogger('raw2nii')
+    parser = argparse.ArgumentParser(prog='raw2nii repatch',
+        description='Recompute the NIfTI headers from the PAR files and '
+        'overwrite only the headers of the existing outputs, e.g. after a '
+        'change of geometry, scaling or description. Outputs whose dims, '
+        'datatype or vox_offset do not match are left alone.')
+    _add_convert_arguments(parser)
+    parser.add_argument('--output-dir', '-o', default=None,
+        help='directory of the outputs (default: next to the inputs)')
+    parser.add_argument('--list', metavar='FILE', default=None,
+        help='file with one input file per line')
+    parser.add_argument('inputs', nargs='*',
+        help='input files, directories or glob patterns')
+    options = parser.parse_args(argv)
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    jobs = [job for job in make_jobs(find_inputs(options.inputs,
+        options.list), options.output_dir)
+        if get_file_format(job['output_file']) == 'nii']
+    if not jobs:
+        logger.error('No PAR files found')
+        return 1
+    statuses = {}
+    for job in sorted(jobs, key=lambda job: job['input_file']):
+        if not os.path.exists(job['output_file']):
+            status = 'missing'
+            logger.warning('Skipping {0}: {1} does not exist'.format(
+                job['input_file'], job['output_file']))
+        else:
+            try:
+                is_patched = repatch(job['input_file'], job['output_file'],
+                    **_get_convert_options(options))
+                status = 'patched' if is_patched else 'unchanged'
+            except (IOError, OSError, ValueError) as e:
+                status = 'failed'
+                logger.error(str(e))
+        statuses[status] = statuses.get(status, 0) + 1
+    logger.info('Repatched {0} files: {1}'.format(len(jobs), ', '.join(
+        '{0} {1}'.format(nr, status)
+        for status, nr in sorted(statuses.items()))))
+    return 1 if statuses.get('failed') else 0
+
+#Maps sub-command names -> functions that take the remaining arguments
+_COMMANDS = {
+    'batch': _batch_main,
+    'client': _client_main,
+    'dicom-scan': _dicom_scan_main,
+    'index': _index_main,
+    'repatch': _repatch_main,
+    'serve': _serve_main,
+    'watch': _watch_main,
+}
+
 def main():
     logger = logging.getLogger('raw2nii')
     logger.setLevel(logging.INFO)
@@ -134,11 +597,17 @@ def main():
     _stream_handler = logging.StreamHandler()
     _stream_handler.setFormatter(_formatter)
     logger.addHandler(_stream_handler)
+    #Sub-commands are picked by the first argument, anything else is a
+    #single input_file -> output_file conversion
+    if len(sys.argv) > 1 and sys.argv[1] in _COMMANDS:
+        sys.exit(_COMMANDS[sys.argv[1]](sys.argv[2:]))
     parser = argparse.ArgumentParser()
-    parser.add_argument('--debug', '-d', action='store_true')
-    parser.add_argument('--no-rescale', action='store_false')
-    parser.add_argument('--no-angulation', action='store_false')
-    parser.add_argument('--dti_revertb0', action='store_true')
+    _add_convert_arguments(parser)
+    parser.add_argument('--profile', metavar='FILE', default=None,
+        help='write the time, bytes, slices/s and peak memory of every '
+        'conversion stage as JSON')
+    parser.add_argument('--trace', metavar='FILE', default=None,
+        help='write the conversion stages as a Chrome trace')
     parser.add_argument('input_file', type=str)
     parser.add_argument('output_file', type=str)
     options = parser.parse_args()
@@ -146,7 +615,20 @@ def main():
         logger.setLevel(logging.DEBUG)
     options = vars(options)
     options.pop('debug', None)
-    sys.exit(raw_convert(**options))
+    profile_fname = options.pop('profile')
+    trace_fname = options.pop('trace')
+    if profile_fname is None and trace_fname is None:
+        sys.exit(raw_convert(**options))
+    import instrument
+    instrument.enable()
+    try:
+        status = raw_convert(**options)
+    finally:
+        if profile_fname is not None:
+            instrument.write_profile(profile_fname)
+        if trace_fname is not None:
+            instrument.write_chrome_trace(trace_fname)
+    sys.exit(status)
 
 if __name__ == '__main__':
     main()
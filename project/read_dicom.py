@@ -1,110 +1,271 @@
 from __future__ import division
-import nibabel
-import nibabel.dft
+import logging
+import multiprocessing
 import numpy as np
+import os
 import pprint
+import struct
 from decimal import Decimal
+from multiprocessing.pool import ThreadPool
+try:
+    import dicom
+except ImportError:
+    import pydicom as dicom
 
-from DICOMFile import DICOMFile, ImageFrame, MRFrame
+from DICOMFile import DICOMFile, FRAME_DTYPE, MRFrame
+from instrument import stage
 
-__all__ = ['read_dicom']
+__all__ = ['read_dicom', 'read_dicom_series', 'read_dicom_files',
+    'find_dicom_series']
 
 
-def _read_functional_group(dcm, fg, shared_fgs):
-    """ Reads a functional group from the DICOM file and returns a slice/frame
-        dcm: DICOMFile
-        fg: Per-Frame Functional Group
-        shared_fgs: Shared Functional Group Sequence
-    """
-    frame = ImageFrame()
-    #Main frame data
-    #Phillips-specific tag data is in tag 0x2005, 0x140f
-    private_tag = fg[0x2005140f][0]
-    frame.slice_num = np.int(private_tag[0x2001100a].value)
-    frame.echo_num = np.int(private_tag[0x00180086].value)
-    frame.dynamic = np.int(private_tag[0x00200100].value)
-    frame.cardiac_phase = np.int(private_tag[0x20011008].value)
-    frame.bvalue = np.int(private_tag[0x20051412].value)
-    frame.grad_orient = np.int(private_tag[0x20051413].value)
-    #If label type is not present, default to 1
-    label_type = private_tag.get(0x20051429)
-    if label_type:
-        frame.label_type = label_type.value
-    else:
-        frame.label_type = '-'
-    frame.img_type = private_tag[0x20051011].value
-    frame.img_seq = private_tag[0x2005106e].value
-    frame.px_size = dcm.px_size
+#Elements larger than this (in bytes) are left in the file by pydicom, so
+#the pixel data of large series is never loaded into memory
+_DEFER_SIZE = 16 * 2 ** 20
+#Philips private per-frame sequence
+_PRIVATE = 0x2005140f
+#Maps column -> candidate tag paths of the frame table values read from the
+#functional groups, tried in order. A path is (source, tags), source is
+#'frame' for the Per-Frame Functional Group or 'shared' for the Shared
+#Functional Groups, and every tag but the last is a sequence of which the
+#first item is used.
+_FRAME_TAG_PATHS = [
+    ('slice_num', [('frame', (_PRIVATE, 0x2001100a))]),
+    ('echo_num', [('frame', (_PRIVATE, 0x00180086))]),
+    ('dynamic', [('frame', (_PRIVATE, 0x00200100))]),
+    ('cardiac_phase', [('frame', (_PRIVATE, 0x20011008))]),
+    ('bvalue', [('frame', (_PRIVATE, 0x20051412))]),
+    ('grad_orient', [('frame', (_PRIVATE, 0x20051413))]),
+    ('label_type', [('frame', (_PRIVATE, 0x20051429))]),
+    ('img_type', [('frame', (_PRIVATE, 0x20051011))]),
+    ('img_seq', [('frame', (_PRIVATE, 0x2005106e))]),
+    #MRFOVGeometrySequence.PercentSampling
+    ('scan_prct', [('frame', (0x00189125, 0x00180093)),
+        ('shared', (0x00189125, 0x00180093))]),
+    #PixelValueTransformationSequence.RescaleIntercept/RescaleSlope
+    ('rescale_interc', [('frame', (0x00289145, 0x00281052))]),
+    ('rescale_slope', [('frame', (0x00289145, 0x00281053))]),
+    ('scale_slope', [('frame', (_PRIVATE, 0x2005100e))]),
+    #FrameVOILUTSequence.WindowCenter/WindowWidth
+    ('window_center', [('frame', (0x00289132, 0x00281050))]),
+    ('window_width', [('frame', (0x00289132, 0x00281051))]),
+    #PixelMeasuresSequence.SliceThickness/PixelSpacing
+    ('sl_thickness', [('frame', (0x00289110, 0x00180050)),
+        ('frame', (_PRIVATE, 0x00180050))]),
+    ('px_spacing', [('frame', (0x00289110, 0x00280030))]),
+    ('dsply_orient', [('frame', (_PRIVATE, 0x20051004))]),
+    ('fmri_stat_indication', [('frame', (_PRIVATE, 0x20051063))]),
+    ('img_type_ed_es', [('frame', (_PRIVATE, 0x20011007))]),
+    ('echo_t', [('frame', (_PRIVATE, 0x00180081))]),
+    ('dyn_scan_begin_t', [('frame', (_PRIVATE, 0x200510a0))]),
+    ('trigger_t', [('frame', (_PRIVATE, 0x00181060))]),
+    ('diff_b_factor', [('frame', (_PRIVATE, 0x20011003))]),
+    ('no_avgs', [('frame', (_PRIVATE, 0x00180083))]),
+    ('img_flip_ang', [('frame', (_PRIVATE, 0x00181314))]),
+    ('cardiac_freq', [('frame', (_PRIVATE, 0x00181088))]),
+    ('min_rr_interval', [('frame', (_PRIVATE, 0x00181081))]),
+    ('max_rr_interval', [('frame', (_PRIVATE, 0x00181082))]),
+    ('turbo_factor', [('frame', (_PRIVATE, 0x00180091))]),
+    ('inversion_delay', [('frame', (_PRIVATE, 0x00180082))]),
+    ('diff_anisotropy_type', [('frame', (_PRIVATE, 0x00189147))]),
+    #MRImageFrameTypeSequence.AcquisitionContrast
+    ('contrast_type', [('frame', (0x00189226, 0x00089209))]),
+    ('diff_ap', [('frame', (_PRIVATE, 0x200510b1))]),
+    ('diff_fh', [('frame', (_PRIVATE, 0x200510b2))]),
+    ('diff_rl', [('frame', (_PRIVATE, 0x200510b0))]),
+    #FrameContentSequence.StackID/TemporalPositionIndex
+    ('stack_id', [('frame', (0x00209111, 0x00209056))]),
+    ('temporal_pos', [('frame', (0x00209111, 0x00209128)),
+        ('frame', (_PRIVATE, 0x00200100))]),
+    #PlanePositionSequence.ImagePositionPatient
+    ('img_pos', [('frame', (0x00209113, 0x00200032))]),
+    #PlaneOrientationSequence.ImageOrientationPatient
+    ('img_orient', [('frame', (0x00209116, 0x00200037))]),
+]
+#Classic single-frame files hold the same elements at the top level of
+#their dataset instead of in the functional groups
+_FRAME_TAG_PATHS = [(column, paths + [('frame', (tag,)) for tag in
+    sorted(set(tags[-1] for source, tags in paths))])
+    for column, paths in _FRAME_TAG_PATHS]
+#Values of the columns whose tags may be missing
+_FRAME_DEFAULTS = {
+    'label_type': '-',
+    'stack_id': 1,
+    'trigger_t': 0.0,
+}
 
-    if hasattr(fg, 'MRFOVGeometrySequence'):
-        frame.scan_prct = Decimal(fg.MRFOVGeometrySequence[0].PercentSampling)
-    else:
-        frame.scan_prct = Decimal(shared_fgs[0].MRFOVGeometrySequence[0].PercentSampling)
-
-    frame.res_x = dcm.res_x
-    frame.res_y = dcm.res_y
-    pvts = fg.PixelValueTransformationSequence[0]
-    frame.rescale_interc = Decimal(pvts.RescaleIntercept)
-    frame.rescale_slope = Decimal(pvts.RescaleSlope)
-    frame.scale_slope = Decimal(private_tag[0x2005100e].value)
-    fvls = fg.FrameVOILUTSequence[0]
-    frame.window_center = np.int(fvls.WindowCenter)
-    frame.window_width = np.int(fvls.WindowWidth)
-
-    pms = fg.PixelMeasuresSequence[0]
-    if hasattr(pms, 'SliceThickness'):
-        frame.sl_thickness = Decimal(pms.SliceThickness)
-    else:
-        frame.sl_thickness = Decimal(private_tag.SliceThickness)
-
-    frame.sl_gap = dcm.space_bt_slices - frame.sl_thickness
-    frame.dsply_orient = private_tag[0x20051004].value
-    frame.fmri_stat_indication = np.int(private_tag[0x20051063].value)
-    frame.img_type_ed_es = private_tag[0x20011007].value
-    frame.px_spacing = np.array(pms.PixelSpacing, Decimal)
-    frame.echo_t = Decimal(private_tag[0x00180081].value)
-    frame.dyn_scan_begin_t = Decimal(private_tag[0x200510a0].value)
-    #If trigger time is not present, default to 0.0
-    trigger_t = private_tag.get(0x00181060)
-    if trigger_t:
-        frame.trigger_t = Decimal(trigger_t.value)
+#Maps binary VR -> dtype of the raw little endian values, decoded in bulk
+_RAW_DTYPES = {
+    'FL': '<f4',
+    'FD': '<f8',
+    'SS': '<i2',
+    'US': '<u2',
+    'SL': '<i4',
+    'UL': '<u4',
+}
+#Text VRs decoded in bulk, multiple values are separated by backslashes
+_RAW_TEXT_VRS = ('CS', 'DS', 'IS', 'LO', 'SH')
+
+def _get_tag_path(ds, tags):
+    for tag in tags[:-1]:
+        ds = ds[tag].value[0]
+    return ds[tags[-1]].value
+
+def _get_frame_value(fg, shared_fg, column):
+    """ Reads one value trying every candidate tag path """
+    for source, tags in dict(_FRAME_TAG_PATHS)[column]:
+        try:
+            return _get_tag_path(fg if source == 'frame' else shared_fg, tags)
+        except (KeyError, IndexError):
+            pass
+    if column in _FRAME_DEFAULTS:
+        return _FRAME_DEFAULTS[column]
+    raise KeyError('Tag of frame column {0} not found'.format(column))
+
+def _get_elements(ds):
+    """ The dict of the elements of a dataset, pydicom 1.0 and later keep it
+        in ds._dict, older versions subclass dict """
+    return getattr(ds, '_dict', ds)
+
+def _get_raw_vr(elem):
+    """ VR of a not yet converted element whose value can be decoded in
+        bulk, None otherwise """
+    #pydicom keeps the elements it did not convert yet as RawDataElement
+    #tuples holding the undecoded value
+    if not isinstance(elem, tuple) or not elem.value:
+        return None
+    if elem.VR in _RAW_TEXT_VRS or (elem.VR in _RAW_DTYPES and
+            elem.is_little_endian):
+        return elem.VR
+    return None
+
+def _get_frame_plan(fg, shared_fg):
+    """ Resolves the tag paths once per series, on its first frame. Returns
+        the constants (shared values and defaults) by column and the
+        per-frame paths grouped as (sequence tags, [(column, tag, VR)]), so
+        every sequence is looked up once per frame. VR is the VR of the
+        first frame's raw value, or None when it is read through pydicom. """
+    constants = {}
+    groups = {}
+    for column, paths in _FRAME_TAG_PATHS:
+        for source, tags in paths:
+            try:
+                if source == 'shared':
+                    constants[column] = _get_tag_path(shared_fg, tags)
+                    break
+                item = fg
+                for tag in tags[:-1]:
+                    item = item[tag].value[0]
+                elem = _get_elements(item)[tags[-1]]
+            except (KeyError, IndexError):
+                continue
+            groups.setdefault(tags[:-1], []).append((column, tags[-1],
+                _get_raw_vr(elem)))
+            break
+        else:
+            constants[column] = _get_frame_value(fg, shared_fg, column)
+    return constants, sorted(groups.items())
+
+def _decode_column(values, vr, converted):
+    """ Decodes the raw values of a column at once. converted holds the
+        indices of values pydicom already converted. """
+    if vr is None:
+        return values
+    if converted:
+        return [val if i in converted else _decode_column([val], vr, ())[0]
+            for i, val in enumerate(values)]
+    if vr in _RAW_DTYPES:
+        arr = np.frombuffer(b''.join(values), _RAW_DTYPES[vr])
     else:
-        frame.trigger_t = 0.0
-    frame.diff_b_factor = Decimal(private_tag[0x20011003].value)
-    frame.no_avgs = np.int(private_tag[0x00180083].value)
-    frame.img_flip_ang = Decimal(private_tag[0x00181314].value)
-    frame.cardiac_freq = np.int(private_tag[0x00181088].value)
-    frame.min_rr_interval = np.int(private_tag[0x00181081].value)
-    frame.max_rr_interval = np.int(private_tag[0x00181082].value)
-    frame.turbo_factor = np.int(private_tag[0x00180091].value)
-    frame.inversion_delay = Decimal(private_tag[0x00180082].value)
-    frame.diff_anisotropy_type = private_tag[0x00189147].value
-    frame.contrast_type = fg.MRImageFrameTypeSequence[0].AcquisitionContrast
-    frame.diff_ap = Decimal(private_tag[0x200510b1].value)
-    frame.diff_fh = Decimal(private_tag[0x200510b2].value)
-    frame.diff_rl = Decimal(private_tag[0x200510b0].value)
-    fcs = fg.FrameContentSequence[0]
-    frame.mr_stack_id = np.int(fcs[0x00209056].value) - 1
-    mr_frame = dcm.mr_stack[frame.mr_stack_id]
-    frame.ang_ap = mr_frame.ang_ap
-    frame.ang_fh = mr_frame.ang_fh
-    frame.ang_rl = mr_frame.ang_rl
-    img_pos = np.array(fg.PlanePositionSequence[0].ImagePositionPatient,
-        Decimal)
-    img_orient = np.array(fg.PlaneOrientationSequence[0]
-        .ImageOrientationPatient, Decimal)
-    frame.offcenter_ap = img_pos[1] + (
-        (dcm.res_y * frame.px_spacing[0] * img_orient[1]) +
-        (dcm.res_x * frame.px_spacing[1] * img_orient[4])) / 2
-    frame.offcenter_fh = img_pos[2] + (
-        (dcm.res_y * frame.px_spacing[0] * img_orient[2]) +
-        (dcm.res_x * frame.px_spacing[1] * img_orient[5])) / 2
-    frame.offcenter_rl = img_pos[0] + (
-        (dcm.res_y * frame.px_spacing[0] * img_orient[0]) +
-        (dcm.res_x * frame.px_spacing[1] * img_orient[3])) / 2
-    frame.slice_orient = mr_frame.view_axis
-    frame.temporal_pos_index = np.int(fcs[0x00209128].value) - 1
-    dcm.stacks[frame.temporal_pos_index].append(frame)
+        texts = b'\\'.join(values).split(b'\\')
+        if vr not in ('DS', 'IS'):
+            if len(texts) != len(values):
+                return [[_to_text(text.strip(b' \0'))
+                    for text in val.split(b'\\')] for val in values]
+            return [_to_text(text.strip(b' \0')) for text in texts]
+        arr = np.array(texts).astype(np.float64)
+    #Multi-valued columns get one row per frame
+    if arr.size != len(values):
+        arr = arr.reshape(len(values), -1)
+    return arr
+
+def _to_text(val):
+    if isinstance(val, bytes) and not isinstance(val, str):
+        return val.decode('ascii')
+    return val
+
+def _read_frame_table(dcm, fgs, shared_fg):
+    """ Reads the Per-Frame Functional Groups into the frame table
+        dcm.frames, a recarray with the FRAME_DTYPE columns in PAR order
+        dcm: DICOMFile
+        fgs: Per-Frame Functional Groups Sequence
+        shared_fg: first item of the Shared Functional Groups Sequence
+    """
+    nr_frames = len(fgs)
+    constants, groups = _get_frame_plan(fgs[0], shared_fg)
+    values = dict((column, [None] * nr_frames) for column, paths in
+        _FRAME_TAG_PATHS if column not in constants)
+    #Maps column -> indices of the values converted by pydicom
+    converted = dict((column, set()) for column in values)
+    for i, fg in enumerate(fgs):
+        for seq_tags, columns in groups:
+            try:
+                item = fg
+                for tag in seq_tags:
+                    item = item[tag].value[0]
+                elements = _get_elements(item)
+            except (KeyError, IndexError):
+                item = None
+            for column, tag, vr in columns:
+                elem = elements.get(tag) if item is not None else None
+                if elem is None:
+                    #Missing from this frame but not from the first one
+                    values[column][i] = _get_frame_value(fg, shared_fg,
+                        column)
+                    converted[column].add(i)
+                elif vr is not None and isinstance(elem, tuple) and \
+                        elem.VR == vr and elem.value:
+                    values[column][i] = elem.value
+                else:
+                    values[column][i] = item[tag].value
+                    if vr is not None:
+                        converted[column].add(i)
+    for seq_tags, columns in groups:
+        for column, tag, vr in columns:
+            values[column] = _decode_column(values[column], vr,
+                converted[column])
+    for column, value in constants.items():
+        values[column] = [value] * nr_frames
+    frames = np.recarray((nr_frames,), dtype=FRAME_DTYPE)
+    for name in frames.dtype.names:
+        if name in values:
+            frames[name] = values[name]
+    frames.frame_index = np.arange(nr_frames)
+    frames.sl_gap = float(dcm.space_bt_slices) - frames.sl_thickness
+    frames.mr_stack_id = np.asarray(values['stack_id'], np.int64) - 1
+    frames.temporal_pos_index = np.asarray(values['temporal_pos'],
+        np.int64) - 1
+    mr_stack = dcm.mr_stack
+    for name in ('ang_ap', 'ang_fh', 'ang_rl'):
+        frames[name] = np.array([float(getattr(mr, name))
+            for mr in mr_stack])[frames.mr_stack_id]
+    frames.slice_orient = np.array([mr.view_axis for mr in mr_stack],
+        object)[frames.mr_stack_id]
+    #Offcentre of the slice centre from the position of its first voxel
+    img_pos = np.asarray(values['img_pos'], np.float64)
+    img_orient = np.asarray(values['img_orient'], np.float64)
+    px_spacing = frames.px_spacing
+    offcenter = img_pos + (
+        dcm.res_y * px_spacing[:, 0:1] * img_orient[:, 0:3] +
+        dcm.res_x * px_spacing[:, 1:2] * img_orient[:, 3:6]) / 2
+    frames.offcenter_rl = offcenter[:, 0]
+    frames.offcenter_ap = offcenter[:, 1]
+    frames.offcenter_fh = offcenter[:, 2]
+    #The PAR file lists the frames stack by stack, in file order per stack
+    if np.any(frames.temporal_pos_index >= dcm.num_stacks):
+        raise IndexError('Temporal position index out of range')
+    order = np.argsort(frames.temporal_pos_index, kind='mergesort')
+    dcm.frames = frames[order]
 
 """
 $series_info_special_hash{"MRSeriesNrOfStacks"}{"Tag"}           = "0x20011060";
@@ -125,8 +286,182 @@ $frame_info_special_hash{"MFInstanceNumber"}{"Tag"}             = "0x00200013";
 """
 
 def read_dicom(dcm_fname):
+    with stage('read_dicom', fname=dcm_fname) as st:
+        dcm = _read_dicom(dcm_fname)
+        if st.enabled:
+            bytes_read = os.path.getsize(dcm_fname)
+            if dcm.raw_data is None:
+                bytes_read -= dcm.pixel_length
+            st.add(bytes_read=bytes_read, slices=len(dcm.frames))
+    return dcm
+
+def read_dicom_series(dcm_dir, series_uid=None, jobs=None):
+    """ Reads a series of classic single-frame DICOM files, one frame per
+        file, from a directory tree. The pixel data is left in the files,
+        dcm.frame_files says where it is.
+        series_uid: SeriesInstanceUID of the series to read, needed when
+              the directory holds more than one series
+        jobs: number of threads reading headers (default: CPU count) """
+    logger = logging.getLogger('raw2nii')
+    with stage('read_dicom_series', fname=dcm_dir) as st:
+        series = find_dicom_series(dcm_dir, jobs)
+        if series_uid is None:
+            if len(series) != 1:
+                raise ValueError('Found {0} DICOM series in "{1}", pick one '
+                    'of: {2}'.format(len(series), dcm_dir,
+                    ', '.join(sorted(series))))
+            series_uid = list(series)[0]
+        elif series_uid not in series:
+            raise ValueError('DICOM series {0} not found in "{1}"'.format(
+                series_uid, dcm_dir))
+        logger.info('Reading DICOM series {0}: {1} files'.format(series_uid,
+            len(series[series_uid])))
+        dcm = _read_dicom_series(dcm_dir, series[series_uid])
+        st.add(slices=len(dcm.frames))
+    return dcm
+
+def read_dicom_files(fnames, jobs=None):
+    """ Reads a series of classic single-frame DICOM files from a list of
+        file names, e.g. the files of a series in a dicom_catalog """
+    with stage('read_dicom_series', fname=os.path.commonprefix(fnames)) as st:
+        headers = [header for header in _read_headers(fnames, jobs)
+            if header is not None]
+        if not headers:
+            raise ValueError('No single-frame DICOM images found')
+        series_uids = set(str(ds.SeriesInstanceUID)
+            for fname, ds, offset, length in headers)
+        if len(series_uids) != 1:
+            raise ValueError('The files hold {0} DICOM series'.format(
+                len(series_uids)))
+        dcm = _read_dicom_series(os.path.dirname(headers[0][0]), headers)
+        st.add(slices=len(dcm.frames))
+    return dcm
+
+def find_dicom_series(dcm_dir, jobs=None):
+    """ Reads the headers of the single-frame DICOM files below dcm_dir in
+        a thread pool, stopping before the pixel data. Returns a dict
+        SeriesInstanceUID -> list of (file name, dataset, pixel data offset,
+        pixel data length). Other files are skipped. """
+    fnames = []
+    for dirpath, dirnames, filenames in os.walk(dcm_dir):
+        dirnames.sort()
+        fnames.extend(os.path.join(dirpath, fname)
+            for fname in sorted(filenames))
+    series = {}
+    for header in _read_headers(fnames, jobs):
+        if header is not None:
+            series.setdefault(str(header[1].SeriesInstanceUID), []).append(
+                header)
+    return series
+
+def _read_headers(fnames, jobs):
+    """ _read_header of every file, in a pool of jobs threads """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs == 1 or len(fnames) < 2:
+        return [_read_header(fname) for fname in fnames]
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(_read_header, fnames, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+
+def _read_header(fname):
+    """ (file name, dataset, pixel data offset, pixel data length) of a
+        single-frame DICOM file, or None for any other file """
+    logger = logging.getLogger('raw2nii')
+    try:
+        with open(fname, 'rb') as f:
+            ds = dicom.read_file(f, stop_before_pixels=True)
+            #SeriesInstanceUID, PerFrameFunctionalGroupsSequence
+            if 0x0020000e not in ds or 0x52009230 in ds:
+                logger.debug('Skipping "{0}": not a single-frame image'
+                    .format(fname))
+                return None
+            location = _get_pixel_location(f, ds)
+    except dicom.filereader.InvalidDicomError:
+        logger.debug('Skipping "{0}": not a DICOM file'.format(fname))
+        return None
+    except (IOError, ValueError) as e:
+        logger.warning('Skipping "{0}": {1}'.format(fname, e))
+        return None
+    if location is None:
+        logger.debug('Skipping "{0}": no pixel data'.format(fname))
+        return None
+    return (fname, ds) + location
+
+def _get_pixel_location(f, ds):
+    """ (offset, length) of the pixel data of a file read up to its pixel
+        data element, or None when it has none """
+    header = f.read(8)
+    if len(header) < 8 or struct.unpack('<HH', header[:4]) != (0x7fe0,
+            0x0010):
+        return None
+    if not ds.is_little_endian:
+        raise ValueError('Big endian pixel data is not supported')
+    if ds.is_implicit_VR:
+        length = struct.unpack('<I', header[4:])[0]
+    else:
+        #OB and OW have 2 reserved bytes after the VR and a 4 byte length
+        length = struct.unpack('<I', f.read(4))[0]
+    if length == 0xFFFFFFFF:
+        raise ValueError('Compressed pixel data is not supported')
+    return f.tell(), length
+
+def _get_frame_sort_key(header):
+    """ Orders the files of a series by temporal position, position along
+        the slice normal and instance number """
+    ds = header[1]
+    try:
+        orient = np.asarray(ds.ImageOrientationPatient, np.float64)
+        position = float(np.dot(np.cross(orient[:3], orient[3:]),
+            np.asarray(ds.ImagePositionPatient, np.float64)))
+    except AttributeError:
+        position = 0.0
+    return (int(ds.get('TemporalPositionIdentifier') or 0), position,
+        int(ds.get('InstanceNumber') or 0))
+
+def _read_dicom_series(dcm_dir, headers):
+    headers = sorted(headers, key=_get_frame_sort_key)
+    datasets = [ds for fname, ds, offset, length in headers]
+    dcm = DICOMFile()
+    _read_series_info(dcm, datasets[0], datasets[0], len(datasets))
+    _read_frame_table(dcm, datasets, datasets[0])
+    frame_bytes = dcm.res_x * dcm.res_y * dcm.px_size // 8
+    for fname, ds, offset, length in headers:
+        if length != frame_bytes:
+            raise ValueError('"{0}" has {1} bytes of pixel data, expected '
+                '{2}'.format(fname, length, frame_bytes))
+    dcm.fname = dcm_dir
+    dcm.raw_data = None
+    dcm.frame_files = [(fname, offset, length)
+        for fname, ds, offset, length in headers]
+    return dcm
+
+def _read_dicom(dcm_fname):
     dcm = DICOMFile()
-    ds = nibabel.dft.dicom.read_file(dcm_fname)
+    ds = dicom.read_file(dcm_fname, defer_size=_DEFER_SIZE)
+    fgs = ds.PerFrameFunctionalGroupsSequence
+    shared_fg = ds.SharedFunctionalGroupsSequence[0]
+    _read_series_info(dcm, ds, shared_fg, len(fgs))
+    _read_frame_table(dcm, fgs, shared_fg)
+    dcm.fname = dcm_fname
+    pixel_data = _get_elements(ds)[0x7fe00010]
+    if isinstance(pixel_data, tuple) and pixel_data.value is None:
+        #Deferred by pydicom: only the position of the pixels is kept, and
+        #write_parrec_from_dicom copies them from the file
+        dcm.raw_data = None
+        dcm.pixel_offset = pixel_data.value_tell
+        dcm.pixel_length = pixel_data.length
+    else:
+        dcm.raw_data = ds[0x7fe00010].value
+    return dcm
+
+def _read_series_info(dcm, ds, shared_fg, nr_frames):
+    """ Reads the series and MR stack information of the first dataset of
+        a series. Classic single-frame files have no functional groups,
+        shared_fg is then the dataset itself. """
     dcm.patient_name = ds.PatientName
     dcm.exam_name = ds.PerformedProcedureStepDescription
     dcm.protocol_name = ds.ProtocolName
@@ -147,8 +482,11 @@ def read_dicom(dcm_fname):
     dcm.patient_pos = ds.PatientPosition
     dcm.technique = ds[0x20011020].value
     dcm.scan_res_x = np.int(ds[0x2005101d].value)
-    sfgs = ds.SharedFunctionalGroupsSequence[0]
-    dcm.scan_res_y = np.int(sfgs[0x2005140e][0].NumberOfPhaseEncodingSteps)
+    try:
+        mr_fg = shared_fg[0x2005140e][0]
+    except KeyError:
+        mr_fg = ds
+    dcm.scan_res_y = np.int(mr_fg.NumberOfPhaseEncodingSteps)
     dcm.scan_mode = ds[0x2005106f].value
     dcm.rep_time = Decimal(ds[0x20051030].value)
     dcm.water_fat_shift = Decimal(ds[0x20011022].value)
@@ -205,12 +543,4 @@ def read_dicom(dcm_fname):
     dcm.offcenter_ap = last_mr.offcenter_ap
     dcm.offcenter_fh = last_mr.offcenter_fh
     dcm.offcenter_rl = last_mr.offcenter_rl
-    shared_fgs = ds.SharedFunctionalGroupsSequence
-    num_stack_slices = last_mr.num_stack_slices
-    num_fg = len(ds.PerFrameFunctionalGroupsSequence)
-    dcm.num_stacks = num_fg // num_stack_slices
-    dcm.stacks = [[] for i in range(dcm.num_stacks)]
-    for fg in ds.PerFrameFunctionalGroupsSequence:
-        _read_functional_group(dcm, fg, shared_fgs)
-    dcm.raw_data = ds[(0x7fe00010)].value
-    return dcm
+    dcm.num_stacks = nr_frames // last_mr.num_stack_slices
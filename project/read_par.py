@@ -7,19 +7,32 @@ versions. We now handle V3 and V4
 function read_par
     par_fname: string with complete par-file name (with path)
     rec_fname: string with complete rec-file name (with path)
+    lazy: when True, the slice table is only read on first access
+    cache_dir: optional directory of the persistent parsed-PAR cache
+    cache_size: optional size cap of cache_dir in bytes
 returns:
     par: A PARFile instance
+
+function read_par_from_dicom
+    dcm: A DICOMFile instance as returned by read_dicom
+returns:
+    par: A PARFile instance of the PAR/REC that write_parrec_from_dicom
+        would write, whose images are read from the DICOM pixel data
 """
 from __future__ import division
+import io
 import logging
 import numpy as np
+import os
 import re
 
 import par_defines
 from PARFile import PARFile
+from instrument import stage
+from par_cache import get_cache_key, load_par_cache, store_par_cache
 
 
-__all__ = ['read_par']
+__all__ = ['read_par', 'read_par_from_dicom', 'get_rec_fname']
 
 #Maps image def values that have multiple fields -> names of those fields
 _SUBVAR_NAMES = {
@@ -30,15 +43,52 @@ _SUBVAR_NAMES = {
     'diffusion': ('ap', 'fh', 'rl'),
 }
 
+#Memoized definition entries and slice table dtypes, see
+#_parse_definition_line and _get_slice_dtype
+_DEFINITION_LINE_CACHE = {}
+_SLICE_DTYPE_CACHE = {}
+
+#Number of bytes at the end of the PAR file searched for the last slice line
+_TAIL_SIZE = 8192
+
+_COMMENT_LINE_RE = re.compile(r'^[ \t]*#.*$', re.M)
+_DATA_LINE_RE = re.compile(r'^[ \t]*[^\s#]', re.M)
+
 _IMAGE_INFORMATION_LINE = ('# === IMAGE INFORMATION ==========================='
     '===============================')
 
-def read_par(par_fname, rec_fname):
+def read_par(par_fname, rec_fname, lazy=False, cache_dir=None,
+        cache_size=None):
+    """ lazy: when True, only the general information and definition sections
+              (plus the first and last slice line) are parsed. The slice
+              table, slices_sorted, the nr_* counts and the slice order
+              checks are computed on first access.
+        cache_dir: directory of the persistent parsed-PAR cache. A valid
+              entry is loaded instead of parsing the text PAR, and newly
+              parsed files are stored (see par_cache).
+        cache_size: size cap of cache_dir in bytes """
+    with stage('read_par', fname=par_fname, lazy=lazy) as st:
+        par = _read_par(par_fname, rec_fname, lazy, cache_dir, cache_size)
+        if st.enabled and not par.problem_reading:
+            if 'slices' in vars(par):
+                st.add(bytes_read=os.path.getsize(par_fname),
+                    slices=par.slices.shape[0])
+            else:
+                st.add(bytes_read=par.slices_offset)
+    return par
+
+def _read_par(par_fname, rec_fname, lazy, cache_dir, cache_size):
     logger = logging.getLogger('raw2nii')
     par = PARFile()
     par.par_fname = par_fname
     par.rec_fname = rec_fname
+    cache_key = None
     try:
+        if cache_dir:
+            cache_key = get_cache_key(par_fname)
+            entry = load_par_cache(cache_dir, cache_key)
+            if entry is not None:
+                return _read_par_from_cache(par, entry)
         with open(par_fname, 'rb') as parfile:
             _skip_lines(parfile, 7)  # Skip first 7 lines
             par.version = parfile.readline().split()[-1]
@@ -47,68 +97,187 @@ def read_par(par_fname, rec_fname):
                 raise NotImplementedError
             elif par.version in ('V4', 'V4.1', 'V4.2'):
                 _skip_lines(parfile, 5)
-                gen_info = _parse_general_info_V4X(par, parfile)
+                _parse_general_info_V4X(par, parfile)
                 logger.debug('Parameters name: {0}'.format(par.gen_info))
+                #Keep the general info as parsed for the cache, the checks
+                #below may adjust it
+                gen_info = dict((key, np.copy(val)
+                    if isinstance(val, np.ndarray) else val)
+                    for key, val in vars(par.gen_info).items())
                 _parse_definition_V4X(par, parfile)
                 _skip_comment_lines(parfile)
-                slices = _parse_slices_V4X(par, parfile)
-    except OSError as e:
+                if lazy:
+                    par.slices_offset = parfile.tell()
+                    first_row, last_row = _peek_slices_V4X(par, parfile)
+                else:
+                    slices = _read_slice_table_V4X(par, parfile)
+                    first_row, last_row = slices[0], slices[-1]
+    except (IOError, OSError) as e:
         par.problem_reading = True
         logger.error('Failed to read par file "{0}": {1}'.format(par_fname, e))
         return par
     if par.version in ('V4', 'V4.1', 'V4.2'):
-        first_row = slices[0]
-        last_row = slices[-1]
-        #If there is more than one slice, check the order of the
-        #slice numbers. 1 = ascending order, 2 = descending order
-        if slices.shape[0] > 1:
-            par.are_slices_sorted = (2, 1)[slices.slice_number[0] >
-                slices.slice_number[1]]
-        else:
-            par.are_slices_sorted = True
-        if gen_info.max_number_of_dynamics > 1:
-            #estimate scan-duration from dtime PAR file row
-            par.RT = (last_row.dyn_scan_begin_time -
-                first_row.dyn_scan_begin_time) / (
-                gen_info.max_number_of_dynamics - 1)
-        else:
-            par.RT = np.nan
-        par.sliceorient = first_row.slice_orientation
-        x = first_row.recon_resolution_x
-        y = first_row.recon_resolution_y
-        z = gen_info.max_number_of_slices_locations
-        par.dim = np.array([x, y, z])
-        par.multi_scaling_factors = (
-            np.product(np.unique(par.slices.scale_slope).shape) != 1
-            or np.product(np.unique(par.slices.rescale_intercept).shape) != 1
-            or np.product(np.unique(par.slices.rescale_slope).shape) != 1)
-        if par.multi_scaling_factors:
-            logger.warning('Multiple scaling factors detected. Switching to '
-                'float 32 nifti and rescaling')
-            par.rescale_slope = slices.rescale_slope
-            par.rescale_interc = slices.rescale_intercept
-            par.scale_slope = slices.scale_slope
+        _set_header_info_V4X(par, first_row, last_row)
+        if lazy:
+            par.defer(_load_slices_V4X)
         else:
-            par.rescale_slope = 1 / first_row.scale_slope
-            par.rescale_interc = first_row.rescale_intercept
-        par.bit = first_row.image_pixel_size
-        par.slth = first_row.slice_thickness
-        par.gap = first_row.slice_gap
-        voxx = first_row.pixel_spacing_x
-        voxy = first_row.pixel_spacing_y
-        voxz = par.slth + par.gap
-        par.vox = np.array([voxx, voxy, voxz])
-        fovz, fovx, fovy = gen_info.fov
-        par.fov = np.array([fovx, fovy, fovz])
-        par.fov_apfhrl = np.array([fovz, fovx, fovy])
-        par.angAP, par.angFH, par.angRL = gen_info.angulation_midslice
-        par.offAP, par.offFH, par.offRL = gen_info.off_centre_midslice
-    _check_number_of_volumes(par)
+            par.slices = slices
+            _set_slice_info_V4X(par)
+            if cache_key:
+                store_par_cache(cache_dir, cache_key, par, gen_info,
+                    cache_size)
+    #Formatting the whole slice table is expensive, only do it when needed
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('PARFile {0}'.format(par))
+    return par
+
+def read_par_from_dicom(dcm):
+    """ Builds the PARFile straight from the DICOM frame table, without
+        writing and parsing a PAR/REC. The slice table keeps the full
+        precision of the DICOM values and its index_in_rec_file column
+        points at the frames of the DICOM pixel data. """
+    with stage('read_par_from_dicom', fname=dcm.fname) as st:
+        par = _read_par_from_dicom(dcm)
+        st.add(slices=par.slices.shape[0])
+    return par
+
+def _read_par_from_dicom(dcm):
+    #Imported here so that PAR -> NIfTI runs do not load the DICOM tables
+    from write_parrec_from_dicom import (PAR_VERSION, _get_general_info,
+        _get_image_def_columns)
+    import d2p_defines
+    logger = logging.getLogger('raw2nii')
+    par = PARFile()
+    par.par_fname = dcm.fname
+    par.rec_fname = dcm.fname
+    par.version = PAR_VERSION
+    #The general info and definition sections are parsed from the text
+    #write_parrec_from_dicom writes, so they match a PAR file exactly
+    _parse_general_info_V4X(par, io.BytesIO(_get_general_info(dcm)))
+    _parse_definition_V4X(par, io.BytesIO(d2p_defines.PAR_MIDDLE_SECTION))
+    columns = _get_image_def_columns(dcm, dcm.frames, 0)
+    if len(columns) != par.field_len:
+        raise ValueError('Image definition has {0} columns, expected {1}'
+            .format(len(columns), par.field_len))
+    slices = np.empty((len(dcm.frames),), dtype=par.slice_dtype)
+    for (fmt, column), name in zip(columns, slices.dtype.names):
+        slices[name] = column
+    slices['index_in_rec_file'] = dcm.frames.frame_index
+    slices = slices.view(np.recarray)
+    if not slices.shape[0]:
+        raise ValueError('No frames found in DICOM file')
+    if dcm.frame_files is not None:
+        par.rec_files = [(fname, offset)
+            for fname, offset, length in dcm.frame_files]
+    elif dcm.raw_data is not None:
+        par.rec_data = dcm.raw_data
+    else:
+        par.rec_offset = dcm.pixel_offset
+        par.rec_size = dcm.pixel_length
+    _set_header_info_V4X(par, slices[0], slices[-1])
+    par.slices = slices
+    _set_slice_info_V4X(par)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('PARFile {0}'.format(par))
+    return par
+
+def _read_par_from_cache(par, entry):
+    """ Fills in the par from a par_cache entry instead of the text PAR """
+    logger = logging.getLogger('raw2nii')
+    par.version = entry['version']
+    for key, val in entry['gen_info'].items():
+        setattr(par.gen_info, key, val)
+    par.fields = entry['fields']
+    par.field_len = len(par.fields)
+    par.slice_dtype = _get_slice_dtype(par.fields)
+    par.slices = entry['slices']
+    par.sort_index = entry['sort_index']
+    _set_header_info_V4X(par, par.slices[0], par.slices[-1])
+    _set_slice_info_V4X(par)
+    #Formatting the whole slice table is expensive, only do it when needed
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('PARFile {0}'.format(par))
+    return par
+
+def _set_header_info_V4X(par, first_row, last_row):
+    _set_image_info_V4X(par, first_row, last_row)
     _check_slice_orientation(par)
-    _check_slice_order(par)
     _check_dti(par)
-    logger.debug('PARFile {0}'.format(par))
-    return par
+
+def get_rec_fname(par_fname):
+    """ Returns the name of the REC file that belongs to a PAR file """
+    rec_fname, ext = os.path.splitext(par_fname)
+    if '.par' == ext:
+        rec_fname += '.rec'
+    elif '.PAR' == ext:
+        rec_fname += '.REC'
+    return rec_fname
+
+def _set_image_info_V4X(par, first_row, last_row):
+    """ Sets the dimensions, orientation, timing and geometry which only need
+        the general info and the first and last slice lines """
+    gen_info = par.gen_info
+    if gen_info.max_number_of_dynamics > 1:
+        #estimate scan-duration from dtime PAR file row
+        par.RT = (last_row.dyn_scan_begin_time -
+            first_row.dyn_scan_begin_time) / (
+            gen_info.max_number_of_dynamics - 1)
+    else:
+        par.RT = np.nan
+    par.sliceorient = first_row.slice_orientation
+    x = first_row.recon_resolution_x
+    y = first_row.recon_resolution_y
+    z = gen_info.max_number_of_slices_locations
+    par.dim = np.array([x, y, z])
+    par.bit = first_row.image_pixel_size
+    par.slth = first_row.slice_thickness
+    par.gap = first_row.slice_gap
+    voxx = first_row.pixel_spacing_x
+    voxy = first_row.pixel_spacing_y
+    voxz = par.slth + par.gap
+    par.vox = np.array([voxx, voxy, voxz])
+    fovz, fovx, fovy = gen_info.fov
+    par.fov = np.array([fovx, fovy, fovz])
+    par.fov_apfhrl = np.array([fovz, fovx, fovy])
+    par.angAP, par.angFH, par.angRL = gen_info.angulation_midslice
+    par.offAP, par.offFH, par.offRL = gen_info.off_centre_midslice
+
+def _set_slice_info_V4X(par):
+    """ Sets everything that is derived from the whole slice table """
+    logger = logging.getLogger('raw2nii')
+    slices = par.slices
+    _parse_slices_V4X(par)
+    #If there is more than one slice, check the order of the
+    #slice numbers. 1 = ascending order, 2 = descending order
+    if slices.shape[0] > 1:
+        par.are_slices_sorted = (2, 1)[slices.slice_number[0] >
+            slices.slice_number[1]]
+    else:
+        par.are_slices_sorted = True
+    par.multi_scaling_factors = (
+        np.product(np.unique(slices.scale_slope).shape) != 1
+        or np.product(np.unique(slices.rescale_intercept).shape) != 1
+        or np.product(np.unique(slices.rescale_slope).shape) != 1)
+    if par.multi_scaling_factors:
+        logger.warning('Multiple scaling factors detected. Switching to '
+            'float 32 nifti and rescaling')
+        par.rescale_slope = slices.rescale_slope
+        par.rescale_interc = slices.rescale_intercept
+        par.scale_slope = slices.scale_slope
+    else:
+        par.rescale_slope = 1 / slices[0].scale_slope
+        par.rescale_interc = slices[0].rescale_intercept
+    _check_number_of_volumes(par)
+    _check_slice_order(par)
+
+def _load_slices_V4X(par):
+    """ Loads the slice table of a PAR file that was read with lazy=True """
+    logger = logging.getLogger('raw2nii')
+    logger.debug('Loading slice table of {0}'.format(par.par_fname))
+    with open(par.par_fname, 'rb') as parfile:
+        parfile.seek(par.slices_offset)
+        par.slices = _read_slice_table_V4X(par, parfile)
+    _set_slice_info_V4X(par)
 
 def _parse_general_info_V4X(par, parfile):
     """ Reads the GENERAL INFORMATION section from the PAR file """
@@ -146,15 +315,33 @@ def _parse_definition_V4X(par, parfile):
     while line != '':
         pos = parfile.tell()
         line = parfile.readline().strip()
-        #Parse the useful parts of the definition entry:
-        #the identifier-valid name, the number of columns, and the type
-        m = re.search(r'# ([^<>\(\)\[\]]*[a-zA-Z]).*\((\d+)?[\*]?(\w+)\)', line)
-        if not m:
+        fields = _parse_definition_line(line)
+        if fields is None:
             if not par.fields:
                 continue
             else:
                 parfile.seek(pos)
                 break
+        par.fields.extend(fields)
+    par.field_len = len(par.fields)
+    par.slice_dtype = _get_slice_dtype(par.fields)
+    return par.fields
+
+def _parse_definition_line(line):
+    """ Parses one definition entry into the fields it describes, or None if
+        the line is not a definition entry. Results are memoized since PAR
+        files from one scanner software release share identical definition
+        blocks. """
+    try:
+        return _DEFINITION_LINE_CACHE[line]
+    except KeyError:
+        pass
+    #Parse the useful parts of the definition entry:
+    #the identifier-valid name, the number of columns, and the type
+    m = re.search(r'# ([^<>\(\)\[\]]*[a-zA-Z]).*\((\d+)?[\*]?(\w+)\)', line)
+    if not m:
+        fields = None
+    else:
         var_descrip, type_len, type_descrip = m.group(1, 2, 3)
         var_name = _sanitize_to_identifer(var_descrip).lower()
         if type_len:
@@ -167,30 +354,73 @@ def _parse_definition_V4X(par, parfile):
         elif type_descrip == 'float':
             type_code = np.float64  # Same as MATLAB double
         else:
-            raise ValueError(descrip)
+            raise ValueError(type_descrip)
         #Sub variables exist for variables that have size > 1
         #We add an underscore plus the name of the sub variable
         #i.e. image_angulation_x, image_angulation_y, image_angulation_z
         if type_len > 1:
-            par.fields.extend(tuple((var_name + '_' + s, type_code)
-                for s in _SUBVAR_NAMES[var_name]))
+            fields = tuple((var_name + '_' + s, type_code)
+                for s in _SUBVAR_NAMES[var_name])
         else:
-            par.fields.append((var_name, type_code))
-    par.field_len = len(par.fields)
-    return par.fields
+            fields = ((var_name, type_code),)
+    _DEFINITION_LINE_CACHE[line] = fields
+    return fields
+
+def _get_slice_dtype(fields):
+    """ Returns the (memoized) structured dtype of the slice table """
+    key = tuple(fields)
+    try:
+        return _SLICE_DTYPE_CACHE[key]
+    except KeyError:
+        dtype = _SLICE_DTYPE_CACHE[key] = np.dtype(list(fields))
+        return dtype
+
+def _read_slice_table_V4X(par, parfile):
+    """ Reads all remaining image information lines of the PAR file as one
+        buffer and converts every column at once into a recarray with the
+        layout of par.fields """
+    slices = _parse_slice_table_V4X(par, parfile.read())
+    if not slices.shape[0]:
+        raise ValueError('No slices found in PAR file')
+    return slices
+
+def _parse_slice_table_V4X(par, buf):
+    """ Converts the text of image information lines to a recarray """
+    #Drop comment lines such as the END OF DATA DESCRIPTION FILE footer
+    buf = _COMMENT_LINE_RE.sub('', buf)
+    nr_lines = len(_DATA_LINE_RE.findall(buf))
+    values = np.fromstring(buf, dtype=np.float64, sep=' ')
+    if values.shape[0] != nr_lines * par.field_len:
+        for line in buf.splitlines():
+            if line.strip() and len(line.split()) != par.field_len:
+                raise ValueError('Slice tag format does not match the number '
+                    'of entries: expected {0} columns in line "{1}"'.format(
+                    par.field_len, line.strip()))
+        raise ValueError('Could not convert slice table values to numbers')
+    values = values.reshape(nr_lines, par.field_len)
+    slices = np.empty((nr_lines,), dtype=par.slice_dtype)
+    for i, name in enumerate(slices.dtype.names):
+        slices[name] = values[:,i]
+    return slices.view(np.recarray)
+
+def _peek_slices_V4X(par, parfile):
+    """ Parses only the first and the last slice line of the PAR file """
+    first_line = parfile.readline()
+    parfile.seek(0, os.SEEK_END)
+    parfile.seek(max(parfile.tell() - _TAIL_SIZE, 0))
+    #The first line of the tail may be cut off, but the last slice line is
+    #complete as long as the tail is longer than it plus the footer
+    tail_lines = [line for line in parfile.read().splitlines()
+        if _DATA_LINE_RE.match(line)]
+    if not first_line.strip() or not tail_lines:
+        raise ValueError('No slices found in PAR file')
+    first_row = _parse_slice_table_V4X(par, first_line)[0]
+    last_row = _parse_slice_table_V4X(par, tail_lines[-1])[0]
+    return first_row, last_row
 
-def _parse_slices_V4X(par, parfile):
-    """ Reads each slice line from the PAR file and calculates some metrics """
+def _parse_slices_V4X(par):
+    """ Calculates some metrics of the slice table and sorts the slices """
     logger = logging.getLogger('raw2nii')
-    par.slices = np.loadtxt(parfile, dtype=par.fields, ndmin=1).view(
-        np.recarray)
-    if not par.slices.shape:
-        logger.warning('par.slices has wrong shape: {0}, reshaping...'.format(
-            par.slices.shape))
-        par.slices = np.reshape(par.slices, (1,))
-    if len(par.slices[0]) != par.field_len:
-        raise ValueError('Slice tag format does not match the number of '
-            'entries')
     #Determine number of interleaved image sequences (was:types,
     #name kept for historic reasons) (e.g. angio)
     par.nr_mrtypes = np.unique(par.slices.scanning_sequence).shape[0]
@@ -220,7 +450,10 @@ def _parse_slices_V4X(par, parfile):
             sort_order[4:])  # Swap diffusion b value and gradient orientation
     else:
         pass  # B0 and B1 diffusion weighting
-    par.slices_sorted = par.slices[np.lexsort(sort_order)]
+    #The sort order may already be known from the PAR cache
+    if getattr(par, 'sort_index', None) is None:
+        par.sort_index = np.lexsort(sort_order)
+    par.slices_sorted = par.slices[par.sort_index]
     return par.slices
 
 def _check_number_of_volumes(par):
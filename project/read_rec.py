@@ -0,0 +1,90 @@
+""" Philips REC file reader. The REC file is memory-mapped as a stack of
+images so that whole volumes can be pulled out with a single fancy-index
+gather on the index_in_rec_file column of the PAR slice table, instead of
+seeking and reading every slice separately.
+
+function open_rec
+    par: A PARFile instance as returned by read_par
+returns:
+    rec: np.memmap of shape (number of images, recon_res_x, recon_res_y),
+        an array over par.rec_data when the images are held in memory, or
+        a stack of par.rec_files that reads the images on demand
+"""
+from __future__ import division
+import logging
+import numpy as np
+import os
+
+
+__all__ = ['open_rec', 'read_rec_slices', 'REC_DTYPE_TABLE']
+
+#Maps image pixel size (in bits) -> dtype of the pixel values in the REC file
+REC_DTYPE_TABLE = {
+    8: np.dtype('<i1'),
+    16: np.dtype('<i2'),
+    32: np.dtype('<i4'),
+}
+
+def open_rec(par):
+    """ Memory-map the REC file described by the par """
+    logger = logging.getLogger('raw2nii')
+    try:
+        dtype = REC_DTYPE_TABLE[par.bit]
+    except KeyError:
+        raise ValueError('Unsupported image pixel size: {0} bits'.format(
+            par.bit))
+    res_x, res_y = par.dim[0], par.dim[1]
+    image_bytes = res_x * res_y * dtype.itemsize
+    if par.rec_files is not None:
+        return _ImageFiles(par.rec_files, dtype, (res_x, res_y))
+    if par.rec_data is not None:
+        nr_bytes = len(par.rec_data)
+    elif par.rec_size is not None:
+        nr_bytes = par.rec_size
+    else:
+        nr_bytes = os.path.getsize(par.rec_fname) - par.rec_offset
+    nr_images = nr_bytes // image_bytes
+    max_index = np.max(par.slices.index_in_rec_file)
+    if max_index >= nr_images:
+        raise IOError('REC file "{0}" holds {1} images but the PAR file '
+            'refers to image {2}'.format(par.rec_fname, nr_images, max_index))
+    logger.debug('Mapping {0} images of {1}x{2} {3} from REC file'.format(
+        nr_images, res_x, res_y, dtype))
+    if par.rec_data is not None:
+        return np.frombuffer(par.rec_data, dtype=dtype,
+            count=nr_images * res_x * res_y).reshape(nr_images, res_x, res_y)
+    return np.memmap(par.rec_fname, dtype=dtype, mode='r',
+        offset=par.rec_offset, shape=(nr_images, res_x, res_y))
+
+def read_rec_slices(rec, slices, out=None):
+    """ Gathers the images for a block of slice rows (i.e. one volume of
+        par.slices_sorted) with a single fancy-index read. When out is given
+        the images are gathered into it instead of a new array. """
+    if isinstance(rec, _ImageFiles):
+        if out is None:
+            out = np.empty((slices.shape[0],) + rec.shape[1:], rec.dtype)
+        return rec.read(slices.index_in_rec_file, out)
+    if out is None:
+        return np.asarray(rec)[slices.index_in_rec_file]
+    #The indices were checked against the REC size in open_rec. 'clip' lets
+    #np.take write straight into out instead of buffering the result
+    return np.take(np.asarray(rec), slices.index_in_rec_file, axis=0, out=out,
+        mode='clip')
+
+class _ImageFiles(object):
+    """ Stack of images stored one per file at the given offsets, such as a
+        classic DICOM series. Images are read when they are gathered. """
+    def __init__(self, rec_files, dtype, shape):
+        self.rec_files = rec_files
+        self.dtype = dtype
+        self.shape = (len(rec_files),) + tuple(shape)
+
+    def read(self, indices, out):
+        for image, index in zip(out, indices):
+            fname, offset = self.rec_files[index]
+            with open(fname, 'rb') as f:
+                f.seek(offset)
+                if f.readinto(image) != image.nbytes:
+                    raise IOError('Unexpected end of file in "{0}"'.format(
+                        fname))
+        return out
@@ -0,0 +1,247 @@
+""" Conversion server on a local Unix socket. The server keeps a ConversionPool
+of worker processes that have already imported NumPy, nibabel and the
+conversion modules, so a request only pays for the conversion itself.
+
+The protocol is one JSON object per line in both directions. Requests:
+    {"op": "convert", "input_file": ..., "output_file": ...,
+        "options": {raw_convert keyword arguments}}
+    {"op": "stats"}
+    {"op": "ping"}
+A convert request is answered with {"status": "accepted", "id": ...} as
+soon as it is queued, followed by the result of the conversion (the job
+keys plus status, seconds, mb_per_s and error) once it finished.
+
+function serve
+    socket_fname: path of the Unix socket (default: default_socket_fname())
+    options: default keyword arguments passed to raw_convert
+    nr_workers: number of worker processes (default: CPU count)
+    timeout: maximum number of seconds per conversion
+
+function request
+    message: request dict
+    socket_fname: path of the Unix socket
+returns:
+    iterator over the response dicts
+"""
+from __future__ import division
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+__all__ = ['serve', 'request', 'default_socket_fname']
+
+#Modules the workers import before their first request
+_PRELOAD = ('numpy', 'nibabel', 'read_par', 'nii', 'read_dicom',
+    'write_parrec_from_dicom', 'd2p_defines')
+#Upper bounds (in seconds) of the latency histogram buckets
+_LATENCY_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60)
+#Seconds between checks of running conversions
+_POLL_INTERVAL = 0.05
+
+def default_socket_fname():
+    """ Per-user socket in $XDG_RUNTIME_DIR, or the temp directory """
+    socket_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(socket_dir, 'raw2nii-{0}.sock'.format(os.getuid()))
+
+def serve(socket_fname=None, options=None, nr_workers=None, timeout=None):
+    from batch import ConversionPool
+    logger = logging.getLogger('raw2nii')
+    if socket_fname is None:
+        socket_fname = default_socket_fname()
+    if os.path.exists(socket_fname):
+        if _is_listening(socket_fname):
+            raise IOError('A server is already listening on "{0}"'.format(
+                socket_fname))
+        os.remove(socket_fname)
+    pool = ConversionPool(options or {}, nr_workers, timeout, _PRELOAD)
+    dispatcher = _Dispatcher(pool)
+    server = _Server(socket_fname, _RequestHandler)
+    server.dispatcher = dispatcher
+    server.stats = _Stats()
+    os.chmod(socket_fname, 0o600)
+    logger.info('Serving on {0} with {1} workers'.format(socket_fname,
+        pool.nr_workers))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        dispatcher.close()
+        if os.path.exists(socket_fname):
+            os.remove(socket_fname)
+
+def request(message, socket_fname=None):
+    """ Sends one request and yields the responses as they arrive """
+    if socket_fname is None:
+        socket_fname = default_socket_fname()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_fname)
+        f = sock.makefile('rwb')
+        f.write(json.dumps(message).encode('utf-8') + b'\n')
+        f.flush()
+        sock.shutdown(socket.SHUT_WR)
+        for line in f:
+            yield json.loads(line.decode('utf-8'))
+        f.close()
+    finally:
+        sock.close()
+
+def _is_listening(socket_fname):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_fname)
+    except (IOError, OSError):
+        return False
+    finally:
+        sock.close()
+    return True
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """ Handles the requests of one connection, one JSON object per line """
+    def handle(self):
+        logger = logging.getLogger('raw2nii')
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            start = time.time()
+            try:
+                message = json.loads(line.decode('utf-8'))
+                op = message.get('op')
+                if op == 'convert':
+                    status = self._convert(message)
+                elif op == 'stats':
+                    status = 'ok'
+                    self._send(self.server.stats.get())
+                elif op == 'ping':
+                    status = 'ok'
+                    self._send({'status': 'ok'})
+                else:
+                    raise ValueError('Unknown op: {0}'.format(op))
+            except Exception as e:
+                logger.warning('Bad request: {0}'.format(e))
+                op, status = 'invalid', 'error'
+                self._send({'status': 'error', 'error': str(e)})
+            self.server.stats.add(op, status, time.time() - start)
+
+    def _convert(self, message):
+        job = {
+            'input_file': message['input_file'],
+            'output_file': message['output_file'],
+            'options': message.get('options') or {},
+        }
+        #The size of the converted data, the REC file for PAR input, as in
+        #batch.make_jobs
+        data_fname = job['input_file']
+        if os.path.splitext(data_fname)[1].lower() == '.par':
+            from read_par import get_rec_fname
+            data_fname = get_rec_fname(data_fname)
+        try:
+            job['size'] = os.path.getsize(data_fname)
+        except OSError:
+            job['size'] = 0
+        dispatcher = self.server.dispatcher
+        tag, done = dispatcher.submit(job)
+        self._send({'status': 'accepted', 'id': tag})
+        result = dispatcher.get_result(tag, done)
+        self._send(result)
+        return result['status']
+
+    def _send(self, response):
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+class _Dispatcher:
+    """ Runs the ConversionPool in a background thread and hands the results
+        back to the handler threads that wait for them """
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.next_tag = 0
+        #tag -> [threading.Event, result]
+        self.waiting = {}
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, job):
+        with self.lock:
+            tag = self.next_tag
+            self.next_tag += 1
+            done = threading.Event()
+            self.waiting[tag] = [done, None]
+            self.pool.submit(job, tag)
+        #Start the job right away if a worker is idle
+        self._collect()
+        return tag, done
+
+    def get_result(self, tag, done):
+        done.wait()
+        with self.lock:
+            return self.waiting.pop(tag)[1]
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+        with self.lock:
+            self.pool.close()
+
+    def _run(self):
+        while not self.stopped:
+            self.pool.wait(_POLL_INTERVAL)
+            self._collect()
+
+    def _collect(self):
+        with self.lock:
+            for tag, result in self.pool.poll(wait=0):
+                entry = self.waiting[tag]
+                entry[1] = result
+                entry[0].set()
+
+class _Stats:
+    """ Request counters per op and status, and a latency histogram """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = {}
+        self.histogram = [0] * (len(_LATENCY_BUCKETS) + 1)
+        self.total_latency = 0
+
+    def add(self, op, status, latency):
+        bucket = len(_LATENCY_BUCKETS)
+        for i, upper in enumerate(_LATENCY_BUCKETS):
+            if latency <= upper:
+                bucket = i
+                break
+        with self.lock:
+            counts = self.requests.setdefault(op, {})
+            counts[status] = counts.get(status, 0) + 1
+            self.histogram[bucket] += 1
+            self.total_latency += latency
+
+    def get(self):
+        with self.lock:
+            nr_requests = sum(self.histogram)
+            return {
+                'status': 'ok',
+                'uptime': time.time() - self.start_time,
+                'requests': nr_requests,
+                'requests_by_op': dict((op, dict(counts))
+                    for op, counts in self.requests.items()),
+                'latency_buckets': list(_LATENCY_BUCKETS) + [None],
+                'latency_histogram': list(self.histogram),
+                'mean_latency': (self.total_latency / nr_requests
+                    if nr_requests else None),
+            }
@@ -0,0 +1,243 @@
+""" Watch-folder ingestion: converts PAR/REC pairs as soon as they have been
+completely written to a directory tree. The tree is rescanned every
+interval seconds, and on Linux inotify wakes the scan up as soon as files
+change. A pair is converted when the sizes of both files have not changed
+for settle seconds and the REC file is as large as the slice table of the
+PAR file requires. Conversions run in a ConversionPool, and every finished
+pair is recorded in a JSON state file so that a restart does not redo it.
+
+function watch
+    watch_dir: directory that is watched recursively for PAR/REC pairs
+    options: keyword arguments passed to raw_convert
+    output_dir: directory the outputs are written to (default: next to
+        the input)
+    state_fname: JSON state file (default: DEFAULT_STATE_NAME in
+        output_dir or watch_dir)
+    nr_workers: number of worker processes (default: CPU count)
+    timeout: maximum number of seconds per conversion
+    interval: maximum number of seconds between scans
+    settle: number of seconds the file sizes must be stable
+    stop: callable, watching ends when it returns True (default: never)
+"""
+from __future__ import division
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import numpy as np
+import os
+import select
+import sys
+import tempfile
+import time
+
+from batch import ConversionPool, make_jobs
+from read_par import get_rec_fname, read_par
+from read_rec import REC_DTYPE_TABLE
+
+
+__all__ = ['watch', 'DEFAULT_STATE_NAME']
+
+DEFAULT_STATE_NAME = 'raw2nii_watch_state.json'
+#inotify event masks from <sys/inotify.h>. Plain writes are not watched,
+#a file that is being written is only picked up once its size settles
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_NONBLOCK = os.O_NONBLOCK
+_INOTIFY_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+
+def watch(watch_dir, options, output_dir=None, state_fname=None,
+        nr_workers=None, timeout=None, interval=5, settle=2, stop=None):
+    logger = logging.getLogger('raw2nii')
+    if state_fname is None:
+        state_fname = os.path.join(output_dir or watch_dir,
+            DEFAULT_STATE_NAME)
+    state = _load_state(state_fname)
+    #par_fname -> [(par size, rec size), time the sizes were first seen,
+    #required REC size]
+    candidates = {}
+    #job tag -> (par_fname, (par mtime, rec mtime))
+    running = {}
+    next_tag = 0
+    waiter = _DirectoryWaiter()
+    pool = ConversionPool(options, nr_workers, timeout)
+    logger.info('Watching {0} ({1})'.format(watch_dir,
+        'inotify' if waiter.fd is not None else 'polling'))
+    #Scan at once, then on inotify events and every interval seconds
+    changed = True
+    last_scan = 0
+    try:
+        while stop is None or not stop():
+            now = time.time()
+            scan_interval = min(interval, settle) if candidates else interval
+            if changed or now - last_scan >= scan_interval:
+                last_scan = now
+                busy = set(par_fname for par_fname, mtimes in
+                    running.values())
+                for par_fname in _find_par_files(watch_dir, waiter):
+                    if par_fname in busy:
+                        continue
+                    rec_fname = get_rec_fname(par_fname)
+                    try:
+                        par_st, rec_st = os.stat(par_fname), os.stat(rec_fname)
+                    except OSError:
+                        candidates.pop(par_fname, None)
+                        continue
+                    mtimes = (par_st.st_mtime, rec_st.st_mtime)
+                    entry = state.get(par_fname)
+                    if entry is not None and tuple(entry['mtimes']) == mtimes:
+                        continue
+                    sizes = (par_st.st_size, rec_st.st_size)
+                    seen = candidates.get(par_fname)
+                    if seen is None or seen[0] != sizes:
+                        candidates[par_fname] = [sizes, now, None]
+                        continue
+                    if now - seen[1] < settle:
+                        continue
+                    if seen[2] is None:
+                        try:
+                            seen[2] = _get_rec_size(par_fname, rec_fname)
+                        except Exception as e:
+                            logger.warning('Skipping "{0}": {1}'.format(
+                                par_fname, e))
+                            del candidates[par_fname]
+                            _set_state(state, state_fname, par_fname, mtimes,
+                                'invalid', error=str(e))
+                            continue
+                    if rec_st.st_size < seen[2]:
+                        continue
+                    del candidates[par_fname]
+                    job = make_jobs([par_fname], output_dir)[0]
+                    logger.info('Converting "{0}"'.format(par_fname))
+                    pool.submit(job, next_tag)
+                    running[next_tag] = (par_fname, mtimes)
+                    next_tag += 1
+            for tag, result in pool.poll(wait=0):
+                par_fname, mtimes = running.pop(tag)
+                logger.info('{0}: {1} ({2:.1f} s)'.format(result['status'],
+                    par_fname, result['seconds']))
+                _set_state(state, state_fname, par_fname, mtimes,
+                    result['status'], result['output_file'], result['error'])
+            #Wake up for directory changes, finished conversions, the next
+            #scan and the next conversion timeout
+            scan_interval = min(interval, settle) if candidates else interval
+            timeout = max(0, last_scan + scan_interval - time.time())
+            time_left = pool.time_left()
+            if time_left is not None:
+                timeout = min(timeout, time_left)
+            changed = waiter.wait(timeout, pool.busy_conns())
+    finally:
+        pool.close()
+        waiter.close()
+
+def _find_par_files(watch_dir, waiter):
+    """ Lists the PAR files below watch_dir and adds inotify watches for all
+        directories that are found """
+    par_fnames = []
+    for dirpath, dirnames, filenames in os.walk(watch_dir):
+        waiter.add(dirpath)
+        par_fnames.extend(os.path.join(dirpath, fname)
+            for fname in filenames if fname.lower().endswith('.par'))
+    return sorted(par_fnames)
+
+def _get_rec_size(par_fname, rec_fname):
+    """ Returns the number of bytes the REC file must have for the slice
+        table of the PAR file """
+    par = read_par(par_fname, rec_fname)
+    if par.problem_reading:
+        raise IOError('Failed to read PAR file')
+    dtype = REC_DTYPE_TABLE[par.bit]
+    nr_images = int(np.max(par.slices.index_in_rec_file)) + 1
+    return nr_images * int(par.dim[0]) * int(par.dim[1]) * dtype.itemsize
+
+def _load_state(state_fname):
+    logger = logging.getLogger('raw2nii')
+    if not os.path.exists(state_fname):
+        return {}
+    try:
+        with open(state_fname) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning('Ignoring invalid state file "{0}": {1}'.format(
+            state_fname, e))
+        return {}
+
+def _set_state(state, state_fname, par_fname, mtimes, status,
+        output_file=None, error=None):
+    """ Records a finished pair and rewrites the state file. The file is
+        replaced atomically, so it is never left half written. """
+    logger = logging.getLogger('raw2nii')
+    state[par_fname] = {
+        'mtimes': list(mtimes),
+        'status': status,
+        'output_file': output_file,
+        'error': error,
+        'finished': time.time(),
+    }
+    state_dir = os.path.dirname(os.path.abspath(state_fname))
+    try:
+        fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=state_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.rename(tmp_fname, state_fname)
+    except (IOError, OSError) as e:
+        logger.warning('Failed to write state file "{0}": {1}'.format(
+            state_fname, e))
+
+class _DirectoryWaiter:
+    """ Sleeps until a watched directory changes (inotify) or the timeout
+        expires. Without inotify it simply sleeps. """
+    def __init__(self):
+        self.fd = None
+        self.watched = set()
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                use_errno=True)
+            fd = self.libc.inotify_init1(_IN_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+        if fd >= 0:
+            self.fd = fd
+
+    def add(self, path):
+        if self.fd is None or path in self.watched:
+            return
+        self.watched.add(path)
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        self.libc.inotify_add_watch(self.fd, path, _INOTIFY_MASK)
+
+    def wait(self, timeout, conns=()):
+        """ Sleeps until a watched directory changes, one of conns (e.g.
+            worker pipes) is readable or the timeout expires. Returns True
+            when a directory changed. """
+        fds = list(conns)
+        if self.fd is not None:
+            fds.append(self.fd)
+        if not fds:
+            time.sleep(timeout)
+            return False
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except (ValueError, select.error, IOError, OSError):
+            #A worker pipe was closed while waiting, the next poll sorts it
+            #out
+            return False
+        if self.fd is None or self.fd not in readable:
+            return False
+        #Drain the events, they only serve to wake up the scan
+        while True:
+            try:
+                os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                break
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
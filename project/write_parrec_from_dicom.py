@@ -1,22 +1,30 @@
 from __future__ import division
-import itertools
+import logging
 import numpy as np
+import os
 import pprint
 import re
 from decimal import Decimal
 
 import d2p_defines
 import raw2nii_version
+from instrument import stage
 
 
 __all__ = ['write_parrec_from_dicom']
 
+PAR_VERSION = 'V4.2'
+#Number of image definition lines formatted at once
+_IMAGE_DEF_CHUNK = 4096
+#Number of bytes of pixel data copied at once
+_COPY_CHUNK = 8 * 2 ** 20
+
 def _get_header(dataset_name):
     info = {
         'dataset_name': dataset_name,
         #'tool_info': 'raw2nii {0}'.format(raw2nii_version.VERSION),
         'tool_info': 'convert_dicom_to_xmlrec.pl v0.4',
-        'par_version': 'V4.2',
+        'par_version': PAR_VERSION,
     }
     return d2p_defines.PAR_HEADER.format(**info)
 
@@ -109,99 +117,126 @@ def _get_general_info(dcm):
     return d2p_defines.PAR_GEN_INFO.format(**gen_info)
 
 
-def _get_image_def(frame, index):
-    return ' '.join([
+def _get_image_def_columns(dcm, frames, start):
+    """ Returns the (format, column) pairs of the image definition lines of
+        frames, the rows of dcm.frames from row start on """
+    return [
     #  slice number                             (integer)
-        '{0:3d}'.format(frame.slice_num),
+        ('%3d', frames.slice_num),
     #  echo number                              (integer)
-        '{0:3d}'.format(frame.echo_num),
+        ('%3d', frames.echo_num),
     #  dynamic scan number                      (integer)
-        '{0:4d}'.format(frame.dynamic),
+        ('%4d', frames.dynamic),
     #  cardiac phase number                     (integer)
-        '{0:2d}'.format(frame.cardiac_phase),
+        ('%2d', frames.cardiac_phase),
     #  image_type_mr                            (integer)
-        str(d2p_defines.IMG_TYPE_ENUM[frame.img_type]),
+        ('%s', _map_enum(frames.img_type, d2p_defines.IMG_TYPE_ENUM)),
     #  scanning sequence                        (integer)
-        str(d2p_defines.IMG_SEQ_ENUM[frame.img_seq]),
+        ('%s', _map_enum(frames.img_seq, d2p_defines.IMG_SEQ_ENUM)),
     #  index in REC file (in images)            (integer)
-        '{0:5d}'.format(index),
+        ('%5d', np.arange(start, start + len(frames))),
     #  image pixel size (in bits)               (integer)
-        '{0:3d}'.format(frame.px_size),
+        ('%3d', dcm.px_size),
     #  scan percentage                          (integer)
-        '{0:5d}'.format(np.int(frame.scan_prct)),
-        #str(frame.scan_prct),
+        ('%5d', frames.scan_prct.astype(np.int64)),
     #  recon resolution (x y)                   (2*integer)
-        '{0:4d}'.format(frame.res_x), '{0:4d}'.format(frame.res_y),
+        ('%4d', dcm.res_x), ('%4d', dcm.res_y),
     #  rescale intercept                        (float)
-        '{0:11.5f}'.format(frame.rescale_interc),
+        ('%11.5f', frames.rescale_interc),
     #  rescale slope                            (float)
-        '{0:9.5f}'.format(frame.rescale_slope),
+        ('%9.5f', frames.rescale_slope),
     #  scale slope                              (float)
-        '{0:.5e}'.format(np.float(frame.scale_slope)),
+        ('%.5e', frames.scale_slope),
     #  window center                            (integer)
-        '{0:5d}'.format(frame.window_center),
+        ('%5d', frames.window_center),
     #  window width                             (integer)
-        '{0:5d}'.format(frame.window_width),
+        ('%5d', frames.window_width),
     #  image angulation (ap,fh,rl in degrees )  (3*float)
-        '{0:6.2f}'.format(frame.ang_ap), '{0:6.2f}'.format(frame.ang_fh),
-        '{0:6.2f}'.format(frame.ang_rl),
+        ('%6.2f', frames.ang_ap), ('%6.2f', frames.ang_fh),
+        ('%6.2f', frames.ang_rl),
     #  image offcentre (ap,fh,rl in mm )        (3*float)
-        '{0:7.2f}'.format(frame.offcenter_ap),
-        '{0:7.2f}'.format(frame.offcenter_fh),
-        '{0:7.2f}'.format(frame.offcenter_rl),
+        ('%7.2f', frames.offcenter_ap),
+        ('%7.2f', frames.offcenter_fh),
+        ('%7.2f', frames.offcenter_rl),
     #  slice thickness (in mm )                 (float)
-        '{0:.3f}'.format(frame.sl_thickness),
+        ('%.3f', frames.sl_thickness),
     #  slice gap (in mm )                       (float)
-        '{0:.3f}'.format(frame.sl_gap),
+        ('%.3f', frames.sl_gap),
     #  image_display_orientation                (integer)
-        str(d2p_defines.DISPLAY_ORIENT_ENUM.get(frame.dsply_orient)),
+        ('%s', _map_enum(frames.dsply_orient,
+            d2p_defines.DISPLAY_ORIENT_ENUM, None)),
     #  slice orientation ( TRA/SAG/COR )        (integer)
-        str(d2p_defines.SLICE_ORIENT_ENUM[frame.slice_orient]),
+        ('%s', _map_enum(frames.slice_orient,
+            d2p_defines.SLICE_ORIENT_ENUM)),
     #  fmri_status_indication                   (integer)
-        str(frame.fmri_stat_indication),
+        ('%d', frames.fmri_stat_indication),
     #  image_type_ed_es  (end diast/end syst)   (integer)
-        str(d2p_defines.IMG_TYPE_ED_ES_ENUM[frame.img_type_ed_es]),
+        ('%s', _map_enum(frames.img_type_ed_es,
+            d2p_defines.IMG_TYPE_ED_ES_ENUM)),
     #  pixel spacing (x,y) (in mm)              (2*float)
-        '{0:6.3f}'.format(frame.px_spacing[0]),
-        '{0:6.3f}'.format(frame.px_spacing[1]),
+        ('%6.3f', frames.px_spacing[:, 0]),
+        ('%6.3f', frames.px_spacing[:, 1]),
     #  echo_time                                (float)
-        '{0:6.2f}'.format(frame.echo_t),
+        ('%6.2f', frames.echo_t),
     #  dyn_scan_begin_time                      (float)
-        '{0:7.2f}'.format(frame.dyn_scan_begin_t),
+        ('%7.2f', frames.dyn_scan_begin_t),
     #  trigger_time                             (float)
-        '{0:8.2f}'.format(frame.trigger_t),
+        ('%8.2f', frames.trigger_t),
     #  diffusion_b_factor                       (float)
-        '{0:7.2f}'.format(frame.diff_b_factor),
+        ('%7.2f', frames.diff_b_factor),
     #  number of averages                       (integer)
-        '{0:3}'.format(frame.no_avgs),
+        ('%3d', frames.no_avgs),
     #  image_flip_angle (in degrees)            (float)
-        '{0:7.2f}'.format(frame.img_flip_ang),
+        ('%7.2f', frames.img_flip_ang),
     #  cardiac frequency   (bpm)                (integer)
-        '{0:5d}'.format(frame.cardiac_freq),
+        ('%5d', frames.cardiac_freq),
     #  minimum RR-interval (in ms)              (integer)
-        '{0:4d}'.format(frame.min_rr_interval),
+        ('%4d', frames.min_rr_interval),
     #  maximum RR-interval (in ms)              (integer)
-        '{0:4d}'.format(frame.max_rr_interval),
+        ('%4d', frames.max_rr_interval),
     #  TURBO factor  <0=no turbo>               (integer)
-        '{0:5d}'.format(frame.turbo_factor),
+        ('%5d', frames.turbo_factor),
     #  Inversion delay (in ms)                  (float)
-        '{0:5.1f}'.format(frame.inversion_delay),
+        ('%5.1f', frames.inversion_delay),
     #  diffusion b value number    (imagekey!)  (integer)
-        '{0:2d}'.format(frame.bvalue),
+        ('%2d', frames.bvalue),
     #  gradient orientation number (imagekey!)  (integer)
-        '{0:3d}'.format(frame.grad_orient),
+        ('%3d', frames.grad_orient),
     #  contrast type                            (string)
-        '{0:4d}'.format(d2p_defines.CONTRAST_TYPE_ENUM[frame.contrast_type]),
+        ('%4d', _map_enum(frames.contrast_type,
+            d2p_defines.CONTRAST_TYPE_ENUM)),
     #  diffusion anisotropy type                (string)
-        '{0:4d}'.format(d2p_defines.DIFF_ANISOTROPY_TYPE_ENUM.get(
-            frame.diff_anisotropy_type,
+        ('%4d', _map_enum(frames.diff_anisotropy_type,
+            d2p_defines.DIFF_ANISOTROPY_TYPE_ENUM,
             d2p_defines.DIFF_ANISOTROPY_TYPE_DEFAULT)),
     #  diffusion (ap, fh, rl)                   (3*float)
-        '{0:7.3f}'.format(frame.diff_ap), '{0:8.3f}'.format(frame.diff_fh),
-        '{0:8.3f}'.format(frame.diff_rl),
+        ('%7.3f', frames.diff_ap), ('%8.3f', frames.diff_fh),
+        ('%8.3f', frames.diff_rl),
     #  label type (ASL)            (imagekey!)  (integer)
-        '{0:2d}'.format(d2p_defines.LABEL_TYPE_ENUM[frame.label_type]),
-    ]) + '\n'
+        ('%2d', _map_enum(frames.label_type, d2p_defines.LABEL_TYPE_ENUM)),
+    ]
+
+def _get_image_defs(dcm, chunk_size=_IMAGE_DEF_CHUNK):
+    """ Yields the image definition lines of dcm.frames, formatted with one
+        % operation per chunk of chunk_size frames """
+    for start in range(0, len(dcm.frames), chunk_size):
+        frames = dcm.frames[start:start + chunk_size]
+        columns = _get_image_def_columns(dcm, frames, start)
+        line_format = ' '.join(fmt for fmt, column in columns) + '\n'
+        #Python ints and floats in row order, so the whole chunk is
+        #formatted by repeating the line format
+        table = np.empty((len(frames), len(columns)), dtype=object)
+        for i, (fmt, column) in enumerate(columns):
+            table[:, i] = column
+        yield (line_format * len(frames)) % tuple(table.ravel().tolist())
+
+def _map_enum(values, enum, *default):
+    """ Maps a column through enum, looking every distinct value up once.
+        Without a default unknown values raise KeyError like enum[value]. """
+    codes = {}
+    for value in set(values):
+        codes[value] = enum.get(value, *default) if default else enum[value]
+    return [codes[value] for value in values]
 
 def _sanitize_field_names(*field_names):
     new_fields = list(field_names)
@@ -217,13 +252,86 @@ def write_parrec_from_dicom(par_fname, rec_fname, dcm):
     dataset_name = _sanitize_field_names(dcm.patient_name,
         '{0:02d}'.format(dcm.acquisition_nr), '{0:02d}'.format(dcm.recon_nr),
         series_time, '({0})'.format(dcm.protocol_name))
-    with open(par_fname, 'wb') as f:
-        f.write(_get_header(dataset_name))
-        f.write(_get_general_info(dcm))
-        f.write(d2p_defines.PAR_MIDDLE_SECTION)
-        index = itertools.count(0)
-        f.writelines(_get_image_def(frame, next(index)) for stack in dcm.stacks
-            for frame in stack)
-        f.write(d2p_defines.PAR_FOOTER)
-    with open(rec_fname, 'wb') as f:
-        f.write(dcm.raw_data)
+    nr_frames = len(dcm.frames)
+    with stage('write_par', fname=par_fname) as st:
+        with open(par_fname, 'wb') as f:
+            f.write(_get_header(dataset_name))
+            f.write(_get_general_info(dcm))
+            f.write(d2p_defines.PAR_MIDDLE_SECTION)
+            f.writelines(_get_image_defs(dcm))
+            f.write(d2p_defines.PAR_FOOTER)
+            st.add(bytes_written=f.tell(), slices=nr_frames)
+    with stage('write_rec', fname=rec_fname) as st:
+        st.add(bytes_written=_write_rec(rec_fname, dcm), slices=nr_frames)
+
+def _write_rec(rec_fname, dcm):
+    """ Writes the frames to the REC file in the order of the PAR file,
+        copying runs of consecutive frames at once, or file by file for a
+        series stored one frame per file. The pixels are copied from the
+        DICOM file(s) when read_dicom left them there, so the memory use
+        does not depend on the size of the series. Returns the number of
+        bytes written. """
+    logger = logging.getLogger('raw2nii')
+    frames = dcm.frames
+    frame_bytes = dcm.res_x * dcm.res_y * dcm.px_size // 8
+    if dcm.frame_files is not None:
+        #One file per frame, checked by read_dicom_series
+        with open(rec_fname, 'wb', 0) as f:
+            for frame_index in frames.frame_index:
+                fname, offset, length = dcm.frame_files[frame_index]
+                with open(fname, 'rb') as src:
+                    _copy_range(src, f, offset, length)
+        return len(frames) * frame_bytes
+    if dcm.raw_data is not None:
+        nr_bytes = len(dcm.raw_data)
+    else:
+        nr_bytes = dcm.pixel_length
+    if nr_bytes == len(frames) * frame_bytes:
+        #Start of every run of frames stored consecutively in the DICOM
+        frame_index = frames.frame_index
+        starts = np.flatnonzero(np.diff(frame_index) != 1) + 1
+        starts = np.concatenate(([0], starts, [len(frames)]))
+        runs = [(int(frame_index[start]) * frame_bytes,
+            int(end - start) * frame_bytes)
+            for start, end in zip(starts[:-1], starts[1:])]
+    else:
+        logger.warning('Pixel data has {0} bytes, expected {1} frames of '
+            '{2} bytes. Copying it unchanged.'.format(nr_bytes, len(frames),
+            frame_bytes))
+        runs = [(0, nr_bytes)]
+    #Unbuffered, os.copy_file_range writes at the position of the descriptor
+    with open(rec_fname, 'wb', 0) as f:
+        if dcm.raw_data is not None:
+            raw_data = memoryview(dcm.raw_data)
+            for offset, length in runs:
+                f.write(raw_data[offset:offset + length])
+        else:
+            with open(dcm.fname, 'rb') as src:
+                for offset, length in runs:
+                    _copy_range(src, f, dcm.pixel_offset + offset, length)
+    return nr_bytes
+
+def _copy_range(src, dst, offset, length):
+    """ Copies length bytes from offset in src to the position of dst, in
+        the kernel with os.copy_file_range where available, else in chunks
+        of _COPY_CHUNK bytes """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is not None:
+        try:
+            while length > 0:
+                copied = copy_file_range(src.fileno(), dst.fileno(), length,
+                    offset)
+                if copied == 0:
+                    break
+                offset += copied
+                length -= copied
+        except OSError:
+            #E.g. not supported between these file systems
+            pass
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(length, _COPY_CHUNK))
+        if not chunk:
+            raise IOError('Unexpected end of file in "{0}"'.format(src.name))
+        dst.write(chunk)
+        length -= len(chunk)
@@ -1,14 +1,13 @@
 import argparse
 import glob
 import logging
-import numpy as np
 import os
 import pprint
-import subprocess
 import tempfile
 
 from project.raw2nii import raw_convert
-from tools.nii_info import read_nii
+from tools.nii_diff import diff_nii, log_diff
+from tools.nii_verify import log_report, verify_pairs
 
 
 DEFAULT_TEST_DATA = [
@@ -19,7 +18,7 @@ DEFAULT_TEST_DATA = [
 ]
 
 
-def run_test(canon_data_folder, trial_folder, rtol, atol):
+def run_test(canon_data_folder, trial_folder, rtol, atol, nr_workers=None):
     """ Runs convert_raw2nii on a folder containing PARREC test data and
         compares the NIFTI output """
     logger = logging.getLogger('raw2nii_test')
@@ -46,39 +45,19 @@ def run_test(canon_data_folder, trial_folder, rtol, atol):
             'Output niftis: {1}'.format(pprint.pformat(canon_niftis),
             pprint.pformat(test_niftis)))
     file_pairs = zip(canon_niftis, test_niftis)
-    for canon_nifti, test_nifti in file_pairs:
-        logger.info('File pair: {0} -> {1}'.format(canon_nifti, test_nifti))
-        canon_header, canon_body = read_nii(canon_nifti)
-        test_header, test_body = read_nii(test_nifti)
-        #First compare the headers of the two niftis
-        for canon_key, canon_val in canon_header.items():
-            test_val = test_header[canon_key]
-            #logger.debug('Compare header.{0} : {1} -> {2}'.format(canon_key,
-            #   canon_val, test_val))
-            if isinstance(canon_val, np.ndarray):
-                is_different = not np.allclose(canon_val, test_val, rtol, atol)
-            elif isinstance(canon_val, float):
-                is_different = abs(canon_val - test_val) > (atol + rtol *
-                    abs(test_val))
-            else:
-                is_different = (canon_val != test_val)
-            if is_different:
-                logger.warning('header.{0} are different: {1} -> {2}'.format(
-                    canon_key, canon_val, test_val))
-        #Then compare the bodies of the niftis
-        if canon_body['dtype'] != test_body['dtype']:
-            logger.warning('Body dtypes are different: {0} -> {1}'.format(
-                canon_body['dtype'], test_body['dtype']))
-        elif canon_body['data'].shape != test_body['data'].shape:
-            logger.warning('Body shapes are different: {0} -> {1}'.format(
-                canon_body['data'].shape, test_body['data'].shape))
-        elif not np.allclose(canon_body['data'], test_body['data'], rtol, atol):
-            logger.warning('Body data is different')
-            #diff_output, err_output = subprocess.Popen([
-            #    './tools/nii_body_diff.sh', canon_nifti, test_nifti],
-            #    stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-            #logger.warning('Body data is different:\n{0}{1}'.format(
-            #    diff_output, err_output))
+    #Headers and bodies are compared in parallel, with the bodies
+    #memory-mapped and compared in chunks
+    reports = verify_pairs(file_pairs, rtol, atol, nr_workers)
+    for report in reports:
+        logger.info('File pair: {0} -> {1} ({2:.2f} s)'.format(
+            report['canon_file'], report['test_file'], report['seconds']))
+        log_report(report, logger)
+        if report['is_different'] and not report['body_error']:
+            #Locate the differences per slice
+            diff_report = diff_nii(report['canon_file'], report['test_file'],
+                rtol=rtol, atol=atol, jobs=nr_workers)
+            diff_report['header_diffs'] = []  # Already logged above
+            log_diff(diff_report, logger)
     return 0
 
 if __name__ == '__main__':
@@ -94,6 +73,8 @@ if __name__ == '__main__':
     parser.add_argument('trial_folder', nargs='?')
     parser.add_argument('--rel-tolerance', '-r', type=float, default=1e-05)
     parser.add_argument('--abs-tolerance', '-a', type=float, default=1e-08)
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+        help='number of file pairs compared in parallel (default: CPU count)')
     options = parser.parse_args()
     if options.canon_data_folder and options.trial_folder:
         test_args = [(options.canon_data_folder, options.trial_folder)]
@@ -107,4 +88,4 @@ if __name__ == '__main__':
     raw2nii_logger.addHandler(_stream_handler)
     for canon_data_folder, trial_folder in test_args:
         run_test(canon_data_folder, trial_folder, options.rel_tolerance,
-            options.abs_tolerance)
+            options.abs_tolerance, options.jobs)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+""" Compares two NIFTI files without loading them into memory. Both bodies
+are memory-mapped and compared in slabs of whole slices by a thread pool, so
+memory use is bounded by the number of threads times the chunk size. A voxel
+differs when |b - a| > atol + rtol * |b|, NaN values always differ.
+
+function diff_nii
+    a_fname, b_fname: NIFTI file names
+    diff_fname: optional NIFTI file the float32 difference b - a is
+        written to, with the header of a_fname
+    rtol, atol: relative and absolute tolerance
+    jobs: number of threads (default: CPU count)
+    chunk_size: number of voxels compared at once by a thread
+returns:
+    report dict with the header differences, the body error (dtype or shape
+    mismatch) and per volume and per slice of every volume the max and mean
+    abs error and the number of differing voxels
+"""
+from __future__ import division, print_function
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+from nii_info import (DEFAULT_CHUNK_SIZE, NII_HEADER_DTYPE, map_nii_body,
+    read_nii_header)
+from nii_verify import compare_headers
+
+
+__all__ = ['diff_nii', 'log_diff']
+
+_DIFF_DATATYPE = 16  # float32
+_DIFF_VOX_OFFSET = 352
+
+def diff_nii(a_fname, b_fname, diff_fname=None, rtol=0.0, atol=0.0,
+        jobs=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    logger = logging.getLogger('raw2nii')
+    start = time.time()
+    report = {
+        'a_file': a_fname,
+        'b_file': b_fname,
+        'diff_file': None,
+        'header_diffs': [],
+        'body_error': None,
+        'volumes': [],
+    }
+    try:
+        a_header = read_nii_header(a_fname)
+        b_header = read_nii_header(b_fname)
+        report['header_diffs'] = compare_headers(a_header, b_header, rtol,
+            atol)
+        a_data = map_nii_body(a_fname, a_header)
+        b_data = map_nii_body(b_fname, b_header)
+    except (IOError, OSError, RuntimeError, ValueError) as e:
+        report['body_error'] = str(e)
+    else:
+        if a_data.shape != b_data.shape:
+            report['body_error'] = 'Body shapes are different: {0} -> {1}'\
+                .format(a_data.shape, b_data.shape)
+    if report['body_error'] is None:
+        a_body = _to_slices(a_data)
+        b_body = _to_slices(b_data)
+        if a_body.dtype != b_body.dtype:
+            #Compared as values, but still reported
+            report['header_diffs'].append(('body dtype', str(a_body.dtype),
+                str(b_body.dtype)))
+        diff_body = None
+        if diff_fname:
+            diff_body = _create_diff_file(a_fname, diff_fname, a_data.shape)
+            report['diff_file'] = diff_fname
+        report['volumes'] = _diff_bodies(a_body, b_body, diff_body, rtol,
+            atol, jobs, chunk_size)
+        if diff_body is not None:
+            diff_body.flush()
+        del a_data, b_data, a_body, b_body, diff_body
+    report['is_different'] = bool(report['header_diffs'] or
+        report['body_error'] or
+        any(v['nr_different'] for v in report['volumes']))
+    report['seconds'] = time.time() - start
+    logger.debug('Compared {0} and {1} in {2:.2f} s'.format(a_fname,
+        b_fname, report['seconds']))
+    return report
+
+def log_diff(report, logger, all_slices=False):
+    """ Logs the differences of a report as warnings, per slice only for
+        the slices that differ unless all_slices """
+    for key, a_val, b_val in report['header_diffs']:
+        logger.warning('header.{0} are different: {1} -> {2}'.format(key,
+            a_val, b_val))
+    if report['body_error']:
+        logger.warning(report['body_error'])
+    for v in report['volumes']:
+        log = logger.warning if v['nr_different'] else logger.info
+        log('Volume {0}: {1} voxels different, max abs error {2:g}, mean abs '
+            'error {3:g}'.format(v['volume'], v['nr_different'],
+            v['max_abs_error'], v['mean_abs_error']))
+        for s in v['slices']:
+            if s['nr_different'] or all_slices:
+                log('  slice {0}: {1} voxels different, max abs error {2:g}, '
+                    'mean abs error {3:g}'.format(s['slice'],
+                    s['nr_different'], s['max_abs_error'],
+                    s['mean_abs_error']))
+    if report['diff_file']:
+        logger.info('Difference map written to {0}'.format(
+            report['diff_file']))
+
+def _to_slices(data):
+    """ View of a mapped body with shape (voxels per slice, slices,
+        volumes) """
+    shape = data.shape + (1,) * (3 - len(data.shape))
+    return data.reshape((shape[0] * shape[1], shape[2], -1), order='F')
+
+def _create_diff_file(a_fname, diff_fname, shape):
+    """ Writes the header of the difference map, little endian, and maps
+        its body """
+    with open(a_fname, 'rb') as f:
+        header_bytes = f.read(348).ljust(NII_HEADER_DTYPE.itemsize, b'\0')
+    header = np.frombuffer(header_bytes, NII_HEADER_DTYPE)
+    if header['HdrSz'][0] != 348:
+        header = np.frombuffer(header_bytes, NII_HEADER_DTYPE.newbyteorder(
+            '>'))
+    header = header.astype(NII_HEADER_DTYPE)
+    header['datatype'] = _DIFF_DATATYPE
+    header['bitpix'] = 32
+    header['vox_offset'] = _DIFF_VOX_OFFSET
+    header['scl_slope'] = 1
+    header['scl_inter'] = 0
+    header['cal_maxmin'] = 0
+    header['glmaxmin'] = 0
+    header['magic'] = np.frombuffer(b'n+1\0', '<i4')[0]
+    header['extension'] = 0
+    with open(diff_fname, 'wb') as f:
+        f.write(header.tobytes())
+        f.truncate(_DIFF_VOX_OFFSET + 4 * int(np.prod(shape)))
+    diff_body = np.memmap(diff_fname, dtype=np.float32, mode='r+',
+        offset=_DIFF_VOX_OFFSET, shape=shape, order='F')
+    return _to_slices(diff_body)
+
+def _diff_bodies(a_body, b_body, diff_body, rtol, atol, jobs, chunk_size):
+    """ Per-volume and per-slice statistics, one task per slab of slices """
+    nr_pixels, nr_slices, nr_volumes = a_body.shape
+    slab = max(1, chunk_size // max(1, nr_pixels))
+    tasks = [(a_body, b_body, diff_body, volume, z, min(z + slab, nr_slices),
+        rtol, atol) for volume in range(nr_volumes)
+        for z in range(0, nr_slices, slab)]
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs == 1 or len(tasks) < 2:
+        results = [_diff_slab(task) for task in tasks]
+    else:
+        pool = ThreadPool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(_diff_slab, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    volumes = [{'volume': volume, 'slices': []}
+        for volume in range(nr_volumes)]
+    for volume, slices in results:
+        volumes[volume]['slices'].extend(slices)
+    for v in volumes:
+        slices = v['slices']
+        v['nr_different'] = sum(s['nr_different'] for s in slices)
+        v['max_abs_error'] = max(s['max_abs_error'] for s in slices)
+        v['mean_abs_error'] = (sum(s['sum_abs_error'] for s in slices) /
+            max(1, sum(s['nr_valid'] for s in slices)))
+    return volumes
+
+def _diff_slab(task):
+    """ Compares the slices z0 <= z < z1 of one volume """
+    a_body, b_body, diff_body, volume, z0, z1, rtol, atol = task
+    a = np.asarray(a_body[:, z0:z1, volume], dtype=np.float64)
+    b = np.asarray(b_body[:, z0:z1, volume], dtype=np.float64)
+    diff = b - a
+    if diff_body is not None:
+        diff_body[:, z0:z1, volume] = diff
+    abs_error = np.abs(diff, out=diff)
+    #Written as "not <=" so that NaN values count as different
+    nr_different = np.count_nonzero(~(abs_error <= atol + rtol * np.abs(b)),
+        axis=0)
+    #NaN errors are counted as different but left out of the statistics
+    valid = ~np.isnan(abs_error)
+    nr_valid = np.count_nonzero(valid, axis=0)
+    abs_error[~valid] = 0
+    sum_abs_error = abs_error.sum(axis=0)
+    max_abs_error = abs_error.max(axis=0)
+    slices = []
+    for i, z in enumerate(range(z0, z1)):
+        slices.append({
+            'slice': z,
+            'nr_different': int(nr_different[i]),
+            'max_abs_error': float(max_abs_error[i]),
+            'mean_abs_error': float(sum_abs_error[i] / max(1, nr_valid[i])),
+            'sum_abs_error': float(sum_abs_error[i]),
+            'nr_valid': int(nr_valid[i]),
+        })
+    return volume, slices
+
+if __name__ == '__main__':
+    logger = logging.getLogger('raw2nii')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('a_fname')
+    parser.add_argument('b_fname')
+    parser.add_argument('--diff-map', '-o', default=None,
+        help='write the difference b - a as a float32 NIFTI file')
+    parser.add_argument('--rel-tolerance', '-r', type=float, default=0.0)
+    parser.add_argument('--abs-tolerance', '-a', type=float, default=0.0)
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+        help='number of threads (default: CPU count)')
+    parser.add_argument('--all-slices', action='store_true',
+        help='also report the slices without differences')
+    parser.add_argument('--debug', '-d', action='store_true')
+    options = parser.parse_args()
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    report = diff_nii(options.a_fname, options.b_fname, options.diff_map,
+        options.rel_tolerance, options.abs_tolerance, options.jobs)
+    log_diff(report, logger, options.all_slices)
+    print('{0}: {1}'.format(options.b_fname,
+        'different' if report['is_different'] else 'same'))
+    sys.exit(int(report['is_different']))
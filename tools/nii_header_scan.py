@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+""" Scans the headers of many NIFTI files into a table. Only the first 352
+bytes (the header and the extension flag) of every file are read, in a
+thread pool, and all headers are decoded at once through one structured
+numpy dtype. Files are grouped into studies (by default their directory)
+and fields that differ from the most common value of the study are flagged.
+
+function scan_headers
+    fnames: NIFTI file names
+    jobs: number of reading threads (default: CPU count)
+returns:
+    list of row dicts, one per file, in the order of fnames. Rows of files
+    that could not be read have an 'error' and no header columns.
+
+function flag_inconsistent
+    rows: rows as returned by scan_headers
+    study_of: function file name -> study key (default: directory)
+    fields: row columns that should be the same within a study
+returns:
+    rows, with 'study' set and 'inconsistent' listing the fields that
+    differ from the most common value of the study
+
+function write_rows
+    rows: rows to write
+    out_fname: output file name, '-' is stdout (not for SQLite)
+    fmt: 'csv', 'json' or 'sqlite'
+"""
+from __future__ import division, print_function
+import argparse
+import collections
+import csv
+import gzip
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import sqlite3
+import sys
+from multiprocessing.pool import ThreadPool
+
+from nii_info import NII_HEADER_DTYPE
+
+
+__all__ = ['scan_headers', 'flag_inconsistent', 'write_rows', 'find_nii_files',
+    'COLUMNS', 'CONSISTENT_FIELDS']
+
+NII_EXTENSIONS = ('.nii', '.nii.gz', '.hdr')
+_READ_SIZE = NII_HEADER_DTYPE.itemsize
+_MAGICS = (b'n+1\0', b'ni1\0')
+
+#Output columns, array fields are split into one column per element
+COLUMNS = (['filename', 'study', 'error', 'inconsistent', 'HdrSz',
+    'datatype', 'bitpix'] +
+    ['dim{0}'.format(i) for i in range(8)] +
+    ['pixdim{0}'.format(i) for i in range(8)] +
+    ['vox_offset', 'scl_slope', 'scl_inter', 'slice_code', 'xyzt_units',
+    'slice_duration', 'toffset', 'qform_code', 'sform_code'] +
+    ['quatern_{0}'.format(c) for c in 'bcd'] +
+    ['qoffset_{0}'.format(c) for c in 'xyz'] +
+    ['srow_{0}{1}'.format(c, i) for c in 'xyz' for i in range(4)] +
+    ['descrip', 'intent_name', 'magic', 'extension'])
+#Fields that are expected to be the same for all files of a study
+CONSISTENT_FIELDS = (['datatype'] + ['dim{0}'.format(i) for i in range(1, 4)] +
+    ['pixdim{0}'.format(i) for i in range(1, 4)])
+_SQL_TYPES = {'filename': 'TEXT PRIMARY KEY', 'study': 'TEXT',
+    'error': 'TEXT', 'inconsistent': 'TEXT', 'descrip': 'TEXT',
+    'intent_name': 'TEXT', 'magic': 'TEXT'}
+
+def find_nii_files(paths):
+    """ The NIFTI files of paths, directories are searched recursively """
+    fnames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            fnames.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            fnames.extend(os.path.join(dirpath, fname) for fname in
+                sorted(filenames) if fname.endswith(NII_EXTENSIONS))
+    return fnames
+
+def scan_headers(fnames, jobs=None):
+    logger = logging.getLogger('raw2nii')
+    fnames = list(fnames)
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs == 1 or len(fnames) < 2:
+        blocks = [_read_header_block(fname) for fname in fnames]
+    else:
+        pool = ThreadPool(jobs)
+        try:
+            blocks = pool.map(_read_header_block, fnames, chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+    rows = [{'filename': fname} for fname in fnames]
+    little, big = [], []
+    for i, (block, error) in enumerate(blocks):
+        if error is not None:
+            rows[i]['error'] = error
+        elif np.frombuffer(block, '<i4', 1)[0] == 348:
+            little.append(i)
+        elif np.frombuffer(block, '>i4', 1)[0] == 348:
+            big.append(i)
+        else:
+            rows[i]['error'] = 'not a NIFTI file (sizeof_hdr)'
+    for indices, dtype in ((little, NII_HEADER_DTYPE),
+            (big, NII_HEADER_DTYPE.newbyteorder('>'))):
+        if not indices:
+            continue
+        #One decode of all headers with the same byte order
+        headers = np.frombuffer(b''.join(blocks[i][0] for i in indices),
+            dtype=dtype)
+        for i, header in zip(indices, headers):
+            rows[i].update(_header_to_row(header))
+    logger.debug('Scanned {0} headers ({1} big endian, {2} unreadable)'
+        .format(len(fnames), len(big), len(fnames) - len(little) - len(big)))
+    return rows
+
+def flag_inconsistent(rows, study_of=os.path.dirname,
+        fields=CONSISTENT_FIELDS):
+    studies = collections.defaultdict(list)
+    for row in rows:
+        row['study'] = study_of(row['filename'])
+        row['inconsistent'] = ''
+        if not row.get('error'):
+            studies[row['study']].append(row)
+    for study_rows in studies.values():
+        for field in fields:
+            counts = collections.Counter(row[field] for row in study_rows)
+            if len(counts) < 2:
+                continue
+            usual = counts.most_common(1)[0][0]
+            for row in study_rows:
+                if row[field] != usual:
+                    row['inconsistent'] = ' '.join(filter(None,
+                        [row['inconsistent'], field]))
+    return rows
+
+def write_rows(rows, out_fname, fmt):
+    if fmt == 'sqlite':
+        _write_sqlite(rows, out_fname)
+        return
+    f = sys.stdout if out_fname == '-' else open(out_fname, 'w')
+    try:
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, COLUMNS, restval='')
+            writer.writeheader()
+            writer.writerows(rows)
+        elif fmt == 'json':
+            json.dump([dict((c, row[c]) for c in COLUMNS if c in row)
+                for row in rows], f, indent=1, sort_keys=True)
+            f.write('\n')
+        else:
+            raise ValueError('Unknown output format: {0}'.format(fmt))
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+def _read_header_block(fname):
+    """ (first 352 bytes, None) or (None, error message) """
+    try:
+        opener = gzip.open if fname.endswith('.gz') else open
+        with opener(fname, 'rb') as f:
+            block = f.read(_READ_SIZE)
+    except (IOError, OSError) as e:
+        return None, str(e)
+    if len(block) < 348:
+        return None, 'file is too short for a NIFTI header'
+    if block[344:348] not in _MAGICS:
+        return None, 'not a NIFTI file (magic)'
+    #.hdr/.img pairs may end right after the header
+    return block.ljust(_READ_SIZE, b'\0'), None
+
+def _header_to_row(header):
+    row = {
+        'error': '',
+        'HdrSz': int(header['HdrSz']),
+        'datatype': int(header['datatype']),
+        'bitpix': int(header['bitpix']),
+        'slice_code': int(header['slice_code']),
+        'xyzt_units': int(header['xyzt_units']),
+        'qform_code': int(header['qform_code']),
+        'sform_code': int(header['sform_code']),
+        'descrip': _to_text(header['descrip']),
+        'intent_name': _to_text(header['intent_name']),
+        'magic': _to_text(header['magic']),
+        'extension': int(header['extension'][0]),
+    }
+    for name in ('vox_offset', 'scl_slope', 'scl_inter', 'slice_duration',
+            'toffset'):
+        row[name] = _to_float(header[name])
+    for i in range(8):
+        row['dim{0}'.format(i)] = int(header['dim'][i])
+        row['pixdim{0}'.format(i)] = _to_float(header['pixdim'][i])
+    for i, c in enumerate('bcd'):
+        row['quatern_' + c] = _to_float(header['quatern_bcd'][i])
+    for i, c in enumerate('xyz'):
+        row['qoffset_' + c] = _to_float(header['qoffset_xyz'][i])
+        for j in range(4):
+            row['srow_{0}{1}'.format(c, j)] = _to_float(
+                header['srow_xyz'][i][j])
+    return row
+
+def _to_float(val):
+    #Through the float32 repr, so that 2.2 is not written as 2.2000000477
+    return float(repr(np.float32(val)))
+
+def _to_text(val):
+    if isinstance(val, (int, np.integer)):
+        val = np.array(val, '<i4').tobytes()
+    return val.split(b'\0', 1)[0].decode('latin-1')
+
+def _write_sqlite(rows, db_fname):
+    if db_fname == '-':
+        raise ValueError('SQLite output needs a file name')
+    conn = sqlite3.connect(db_fname)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS nii_header ({0})'.format(
+            ', '.join('{0} {1}'.format(c, _SQL_TYPES.get(c, 'NUMERIC'))
+            for c in COLUMNS)))
+        conn.executemany('INSERT OR REPLACE INTO nii_header VALUES ({0})'
+            .format(', '.join('?' * len(COLUMNS))),
+            [[row.get(c) for c in COLUMNS] for row in rows])
+        conn.commit()
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    logger = logging.getLogger('raw2nii')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    parser = argparse.ArgumentParser(description='Writes the headers of NIFTI '
+        'files as a table and flags files whose datatype, dims or pixdims '
+        'differ from the rest of their study.')
+    parser.add_argument('paths', nargs='+', help='NIFTI files or directories '
+        '(searched recursively)')
+    parser.add_argument('--format', '-f', choices=['csv', 'json', 'sqlite'],
+        default='csv')
+    parser.add_argument('--output', '-o', default='-',
+        help='output file (default: stdout)')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+        help='number of reading threads (default: CPU count)')
+    parser.add_argument('--study-depth', type=int, default=1,
+        help='number of directory levels above a file that name its study '
+        '(default: 1, its directory)')
+    parser.add_argument('--debug', '-d', action='store_true')
+    options = parser.parse_args()
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    study_of = lambda fname: os.path.join(
+        *([os.path.dirname(fname)] + [os.pardir] * (options.study_depth - 1)))
+    rows = flag_inconsistent(scan_headers(find_nii_files(options.paths),
+        options.jobs), lambda fname: os.path.normpath(study_of(fname)))
+    write_rows(rows, options.output, options.format)
+    nr_flagged = sum(1 for row in rows if row.get('error') or
+        row['inconsistent'])
+    if nr_flagged:
+        logger.warning('{0} of {1} files are unreadable or inconsistent with '
+            'their study'.format(nr_flagged, len(rows)))
+    sys.exit(int(bool(nr_flagged)))
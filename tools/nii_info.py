@@ -1,44 +1,50 @@
+""" NIFTI-1 file reader. The body is memory-mapped at vox_offset, so
+volumes and slices are only read from disk when they are accessed and
+files of any size can be inspected in constant memory.
+
+function read_nii
+    filename: NIFTI file name
+returns:
+    header: dict of the header fields
+    body: dict with 'data', an np.memmap of shape dim[1:dim[0] + 1] in
+        Fortran order (data[..., t] is volume t, data[:, :, z, t] a slice),
+        and 'dtype'
+
+function summarize_volumes
+    data: the body data as returned by read_nii
+    chunk_size: number of voxels read at once
+returns:
+    list of dicts with the min, max, mean, std and number of NaN voxels of
+    every volume
+"""
 import logging
 import numpy as np
+import os
+import sys
 
-from nii_header_field_info import NiiHdrFieldInfo
+try:
+    from project.NiiFile import HEADER_SIZE, NII_HEADER_DTYPE, unpack_header
+except ImportError:
+    #Run as a script from tools/, the header layout is the one of the writer
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+    from project.NiiFile import HEADER_SIZE, NII_HEADER_DTYPE, unpack_header
 
 
-HEADER = [
-    NiiHdrFieldInfo('HdrSz', 0, 'i'),
-    NiiHdrFieldInfo('DataType', 4, 's', 10),
-    NiiHdrFieldInfo('db_name', 14, 's', 18),
-    NiiHdrFieldInfo('extents', 32, 'i'),
-    NiiHdrFieldInfo('session_error', 36, 'h'),
-    NiiHdrFieldInfo('regular', 38, 'B'),
-    NiiHdrFieldInfo('dim_info', 39, 'B'),
-    NiiHdrFieldInfo('dim', 40, 'h', (8,)),
-    NiiHdrFieldInfo('intent_p123', 56, 'f', (3,)),
-    NiiHdrFieldInfo('intent_code', 68, 'h'),
-    NiiHdrFieldInfo('datatype', 70, 'h'),
-    NiiHdrFieldInfo('bitpix', 72, 'h'),
-    NiiHdrFieldInfo('slice_start', 74, 'h'),
-    NiiHdrFieldInfo('pixdim', 76, 'f', (8,)),
-    NiiHdrFieldInfo('vox_offset', 108, 'f'),
-    NiiHdrFieldInfo('scl_slope', 112, 'f'),
-    NiiHdrFieldInfo('scl_inter', 116, 'f'),
-    NiiHdrFieldInfo('slice_end', 120, 'h'),
-    NiiHdrFieldInfo('slice_code', 122, 'B'),
-    NiiHdrFieldInfo('xyzt_units', 123, 'B'),
-    NiiHdrFieldInfo('cal_maxmin', 124, 'f', (2,)),
-    NiiHdrFieldInfo('slice_duration', 132, 'f'),
-    NiiHdrFieldInfo('toffset', 136, 'f'),
-    NiiHdrFieldInfo('glmaxmin', 140, 'i', (2,)),
-    NiiHdrFieldInfo('descrip', 148, 's', 80),
-    NiiHdrFieldInfo('aux_file', 228, 's', 24),
-    NiiHdrFieldInfo('qform_code', 252, 'h'),
-    NiiHdrFieldInfo('sform_code', 254, 'h'),
-    NiiHdrFieldInfo('quatern_bcd', 256, 'f', (3,)),
-    NiiHdrFieldInfo('qoffset_xyz', 268, 'f', (3,)),
-    NiiHdrFieldInfo('srow_xyz', 280, 'f', (4, 3)),
-    NiiHdrFieldInfo('intent_name', 328, 's', 16),
-    NiiHdrFieldInfo('magic', 344, 'i'),
-]
+#Maps NIFTI datatype code -> numpy dtype
+NII_DTYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64,
+}
+DEFAULT_CHUNK_SIZE = 2 ** 20
 
 def read_nii_header(filename):
     logger = logging.getLogger('raw2nii')
@@ -50,41 +56,86 @@ def read_nii_body(filename):
     logger = logging.getLogger('raw2nii')
     with open(filename, 'rb') as f:
         header = _read_nii_header(f, logger)
-        body = _read_nii_body(f, header, logger)
+    body = _read_nii_body(filename, header, logger)
     return header, body
 
 def read_nii(filename):
-    logger = logging.getLogger('raw2nii')
-    with open(filename, 'rb') as f:
-        header = _read_nii_header(f, logger)
-        body = _read_nii_body(f, header, logger)
-    return header, body
+    return read_nii_body(filename)
+
+def map_nii_body(filename, header):
+    """ Memory-maps the body of a NIFTI file described by header """
+    datatype = header['datatype']
+    if datatype not in NII_DTYPES:
+        raise ValueError('Unsupported NIFTI datatype {0} in "{1}"'.format(
+            datatype, filename))
+    dtype = np.dtype(NII_DTYPES[datatype])
+    dim = header['dim']
+    nr_dims = max(1, min(int(dim[0]), 7))
+    shape = tuple(max(1, int(d)) for d in dim[1:nr_dims + 1])
+    offset = int(header['vox_offset'])
+    nr_bytes = int(np.prod(shape)) * dtype.itemsize
+    if os.path.getsize(filename) < offset + nr_bytes:
+        raise ValueError('"{0}" is shorter than its header says'.format(
+            filename))
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+        shape=shape, order='F')
+
+def summarize_volumes(data, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Per-volume statistics, read chunk by chunk """
+    nr_voxels = int(np.prod(data.shape[:3]))
+    #A view with one column per volume, columns are contiguous
+    columns = data.reshape((nr_voxels, -1), order='F')
+    summaries = []
+    for volume in range(columns.shape[1]):
+        column = columns[:, volume]
+        minimum = maximum = None
+        total = total_sq = 0.0
+        nr_nan = 0
+        for start in range(0, nr_voxels, chunk_size):
+            chunk = np.asarray(column[start:start + chunk_size],
+                dtype=np.float64)
+            nan = np.isnan(chunk)
+            if nan.any():
+                nr_nan += int(np.count_nonzero(nan))
+                chunk = chunk[~nan]
+                if not chunk.size:
+                    continue
+            chunk_min, chunk_max = float(chunk.min()), float(chunk.max())
+            minimum = chunk_min if minimum is None else min(minimum,
+                chunk_min)
+            maximum = chunk_max if maximum is None else max(maximum,
+                chunk_max)
+            total += float(chunk.sum())
+            total_sq += float(np.dot(chunk, chunk))
+        nr_values = nr_voxels - nr_nan
+        mean = total / nr_values if nr_values else float('nan')
+        std = (np.sqrt(max(total_sq / nr_values - mean ** 2, 0.0))
+            if nr_values else float('nan'))
+        summaries.append({
+            'volume': volume,
+            'min': minimum,
+            'max': maximum,
+            'mean': mean,
+            'std': float(std),
+            'nr_nan': nr_nan,
+        })
+    return summaries
 
 def _read_nii_header(f, logger=None):
-    header = {}
-    header_bytes = f.read(348)
-    if len(header_bytes) == 348:
+    header_bytes = f.read(HEADER_SIZE)
+    if len(header_bytes) == HEADER_SIZE:
         magic = header_bytes[-4:]
     else:
         magic = None
-    if magic not in (bytes('n+1\0'), bytes('ni1\0')):
+    if magic not in (b'n+1\0', b'ni1\0'):
         if logger:
             logger.info('magic number: {0}'.format(magic))
         raise RuntimeError('This is not a NIFTI file!')
-    for info in HEADER:
-        header[info.name] = info.read_value(header_bytes)
-    return header 
+    return unpack_header(header_bytes)
 
-def _read_nii_body(f, header, logger):
-    dim = header['dim'][1:5]
-    bitpix = header['bitpix']
-    datatype = header['datatype']
-    unsigned_prefix = ('', 'u')[datatype ==
-        {8: 2, 16: 512, 32: 768, 64: 1280}[bitpix]]
-    dtype = '{0}int{1}'.format(unsigned_prefix, bitpix)
-    data_shape = (dim[0], dim[1], dim[2] * dim[3])
-    arr = np.fromstring(f.read(), dtype=dtype, count=np.product(data_shape))
-    data = arr.reshape(data_shape[::-1]).T
-    body = {'data': data, 'dtype': dtype}
+def _read_nii_body(filename, header, logger):
+    data = map_nii_body(filename, header)
+    logger.debug('Mapped body of {0}: {1} {2}'.format(filename, data.dtype,
+        data.shape))
+    body = {'data': data, 'dtype': str(data.dtype)}
     return body
-
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+""" Compares NIFTI files against canonical NIFTI files without loading them
+into memory. The headers are compared field by field, the bodies are
+memory-mapped and compared one volume at a time, in chunks, with the
+semantics of numpy.allclose: a voxel differs when
+|canon - test| > atol + rtol * |test|. File pairs are compared in parallel
+worker processes.
+
+function verify_pairs
+    file_pairs: list of (canonical NIFTI, test NIFTI) file names
+    rtol, atol: relative and absolute tolerance
+    nr_workers: number of worker processes (default: CPU count)
+    chunk_size: number of voxels compared at once
+returns:
+    list of reports (see verify_pair), in the order of file_pairs
+
+function verify_pair
+    canon_fname, test_fname: NIFTI file names
+    rtol, atol: relative and absolute tolerance
+    chunk_size: number of voxels compared at once
+returns:
+    report dict with the header differences, the body error (dtype or shape
+    mismatch) and per volume the number of differing voxels, the max
+    abs/rel error and the first differing voxel
+"""
+from __future__ import division, print_function
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+import sys
+import time
+
+from nii_info import DEFAULT_CHUNK_SIZE, map_nii_body, read_nii_header
+
+
+__all__ = ['verify_pairs', 'verify_pair', 'compare_headers', 'log_report']
+
+def verify_pairs(file_pairs, rtol=1e-05, atol=1e-08, nr_workers=None,
+        chunk_size=DEFAULT_CHUNK_SIZE):
+    file_pairs = list(file_pairs)
+    if nr_workers is None:
+        nr_workers = multiprocessing.cpu_count()
+    nr_workers = max(1, min(nr_workers, len(file_pairs)))
+    args = [(canon_fname, test_fname, rtol, atol, chunk_size)
+        for canon_fname, test_fname in file_pairs]
+    if nr_workers == 1:
+        return [_verify_pair_star(a) for a in args]
+    pool = multiprocessing.Pool(nr_workers)
+    try:
+        return pool.map(_verify_pair_star, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def verify_pair(canon_fname, test_fname, rtol=1e-05, atol=1e-08,
+        chunk_size=DEFAULT_CHUNK_SIZE):
+    start = time.time()
+    report = {
+        'canon_file': canon_fname,
+        'test_file': test_fname,
+        'header_diffs': [],
+        'body_error': None,
+        'volumes': [],
+    }
+    try:
+        canon_header = read_nii_header(canon_fname)
+        test_header = read_nii_header(test_fname)
+        report['header_diffs'] = compare_headers(canon_header, test_header,
+            rtol, atol)
+        canon_body = _map_body(canon_fname, canon_header)
+        test_body = _map_body(test_fname, test_header)
+    except (IOError, OSError, RuntimeError, ValueError) as e:
+        report['body_error'] = str(e)
+    else:
+        if canon_body.dtype != test_body.dtype:
+            report['body_error'] = 'Body dtypes are different: {0} -> {1}'\
+                .format(canon_body.dtype, test_body.dtype)
+        elif canon_body.shape != test_body.shape:
+            report['body_error'] = 'Body shapes are different: {0} -> {1}'\
+                .format(canon_body.shape, test_body.shape)
+        else:
+            for volume in range(canon_body.shape[0]):
+                result = _compare_volume(canon_body[volume],
+                    test_body[volume], canon_header['dim'][1:4], rtol, atol,
+                    chunk_size)
+                result['volume'] = volume
+                report['volumes'].append(result)
+        del canon_body, test_body
+    report['is_different'] = bool(report['header_diffs'] or
+        report['body_error'] or
+        any(v['nr_different'] for v in report['volumes']))
+    report['seconds'] = time.time() - start
+    return report
+
+def compare_headers(canon_header, test_header, rtol, atol):
+    """ Returns a list of (field name, canonical value, test value) of the
+        header fields that are different """
+    diffs = []
+    for key in sorted(canon_header):
+        canon_val = canon_header[key]
+        test_val = test_header[key]
+        if isinstance(canon_val, np.ndarray):
+            is_different = not np.allclose(canon_val, test_val, rtol, atol)
+        elif isinstance(canon_val, float):
+            is_different = abs(canon_val - test_val) > (atol + rtol *
+                abs(test_val))
+        else:
+            is_different = (canon_val != test_val)
+        if is_different:
+            diffs.append((key, canon_val, test_val))
+    return diffs
+
+def log_report(report, logger):
+    """ Logs the differences found in a report as warnings """
+    for key, canon_val, test_val in report['header_diffs']:
+        logger.warning('header.{0} are different: {1} -> {2}'.format(key,
+            canon_val, test_val))
+    if report['body_error']:
+        logger.warning(report['body_error'])
+    for v in report['volumes']:
+        if v['nr_different']:
+            logger.warning('Body data is different in volume {0}: {1} voxels, '
+                'max abs error {2:g}, max rel error {3:g}, first at {4}'
+                .format(v['volume'], v['nr_different'], v['max_abs_error'],
+                v['max_rel_error'], v['first_different']))
+        else:
+            logger.debug('Volume {0}: max abs error {1:g}, max rel error '
+                '{2:g}'.format(v['volume'], v['max_abs_error'],
+                v['max_rel_error']))
+
+def _verify_pair_star(args):
+    return verify_pair(*args)
+
+def _map_body(fname, header):
+    """ Memory-maps the body as an array of shape (volumes, voxels) """
+    data = map_nii_body(fname, header)
+    nr_voxels = int(np.prod(data.shape[:3]))
+    return data.reshape((nr_voxels, -1), order='F').T
+
+def _compare_volume(canon, test, dim, rtol, atol, chunk_size):
+    """ Compares one volume chunk by chunk """
+    result = {
+        'nr_different': 0,
+        'max_abs_error': 0.0,
+        'max_rel_error': 0.0,
+        'first_different': None,
+    }
+    for start in range(0, canon.shape[0], chunk_size):
+        a = np.asarray(canon[start:start + chunk_size], dtype=np.float64)
+        b = np.asarray(test[start:start + chunk_size], dtype=np.float64)
+        abs_error = np.abs(b - a)
+        #Written as "not <=" so that NaN values count as different
+        different = ~(abs_error <= atol + rtol * np.abs(b))
+        nr_different = int(np.count_nonzero(different))
+        if nr_different:
+            if result['first_different'] is None:
+                index = start + int(np.argmax(different))
+                result['first_different'] = tuple(int(i) for i in
+                    np.unravel_index(index, [max(1, int(d)) for d in dim],
+                    order='F'))
+            result['nr_different'] += nr_different
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel_error = np.where(b != 0, abs_error / np.abs(b), abs_error)
+        #NaN errors are counted as different above but left out of the maxima
+        if not np.isnan(abs_error).all():
+            result['max_abs_error'] = max(result['max_abs_error'],
+                float(np.nanmax(abs_error)))
+            result['max_rel_error'] = max(result['max_rel_error'],
+                float(np.nanmax(rel_error)))
+    return result
+
+if __name__ == '__main__':
+    logger = logging.getLogger('raw2nii')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('canon_fname')
+    parser.add_argument('test_fname')
+    parser.add_argument('--rel-tolerance', '-r', type=float, default=1e-05)
+    parser.add_argument('--abs-tolerance', '-a', type=float, default=1e-08)
+    parser.add_argument('--debug', '-d', action='store_true')
+    options = parser.parse_args()
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    report = verify_pair(options.canon_fname, options.test_fname,
+        options.rel_tolerance, options.abs_tolerance)
+    log_report(report, logger)
+    print('{0}: {1}'.format(options.test_fname,
+        'different' if report['is_different'] else 'same'))
+    sys.exit(int(report['is_different']))
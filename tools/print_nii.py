@@ -5,11 +5,34 @@ import logging
 import numpy as np
 import pprint
 
-from nii_info import read_nii
+from nii_info import read_nii, summarize_volumes
+
+
+def print_summaries(data):
+    """ Prints the statistics of every volume, one line per volume """
+    for s in summarize_volumes(data):
+        print('volume {volume:4d}: min {min} max {max} mean {mean:g} std '
+            '{std:g} NaN {nr_nan}'.format(**s))
+
+def print_slices(data, slices, volumes):
+    """ Prints the chosen slices of the chosen volumes """
+    nr_volumes = int(np.prod(data.shape[3:]))
+    volume_data = data.reshape(data.shape[:3] + (nr_volumes,), order='F')
+    for volume in volumes:
+        for z in slices:
+            print('volume {0} slice {1}:'.format(volume, z))
+            pprint.pprint(np.asarray(volume_data[:, :, z, volume]))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('--summary', '-s', action='store_true',
+        help='print the min, max, mean and std of every volume')
+    parser.add_argument('--slice', '-z', type=int, action='append',
+        default=[], help='print this slice (can be repeated)')
+    parser.add_argument('--volume', '-t', type=int, action='append',
+        default=[], help='volume of the printed slices (can be repeated, '
+        'default: 0)')
     parser.add_argument('filenames', nargs='+')
     options = parser.parse_args()
     is_many = len(options.filenames) > 1
@@ -17,8 +40,14 @@ if __name__ == '__main__':
         if is_many:
             print('{0}\n-----------------------------'.format(filename))
         header, body = read_nii(filename)
-        pprint.pformat('dtype: {0}'.format(body['dtype']))
-        #np.set_printoptions(threshold=np.nan)
-        pprint.pprint(body['data'])
+        print('dtype: {0} shape: {1}'.format(body['dtype'],
+            body['data'].shape))
+        if options.summary:
+            print_summaries(body['data'])
+        if options.slice:
+            print_slices(body['data'], options.slice, options.volume or [0])
+        if not options.summary and not options.slice:
+            #numpy only reads the voxels it shows of large arrays
+            pprint.pprint(body['data'])
         if is_many:
             print('\n')
@@ -4,18 +4,26 @@ import argparse
 import logging
 import pprint
 
-from nii_info import read_nii_header
+from nii_info import read_nii_body, read_nii_header
+from print_nii import print_summaries
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('--summary', '-s', action='store_true',
+        help='also print the min, max, mean and std of every volume')
     parser.add_argument('filenames', nargs='+')
     options = parser.parse_args()
     is_many = len(options.filenames) > 1
     for filename in options.filenames:
         if is_many:
             print('{0}\n-----------------------------'.format(filename))
-        header = read_nii_header(filename)
+        if options.summary:
+            header, body = read_nii_body(filename)
+        else:
+            header = read_nii_header(filename)
         pprint.pprint(header)
+        if options.summary:
+            print_summaries(body['data'])
         if is_many:
             print('\n')